@@ -0,0 +1,214 @@
+from src.data.universal_dataset import UniversalDataset, add_quant_special_token, get_file_digest
+from src.config import Config
+from src.model.universal_model import load_inference_model
+from transformers import AutoTokenizer
+import argparse
+import csv
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import shutil
+import time
+import torch
+import torch.nn as nn
+from src.eval.answer_cache import get_decoding_settings, get_model_id
+from src.eval.utils import get_num_matrix, compute_values_for_batched_equations
+from typing import Dict, List
+import logging
+from universal_main import parse_arguments, class_name_2_model, get_batched_prediction_consider_multiple_m0, get_task_constants, get_dataset
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(
+	format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+	datefmt="%m/%d/%Y %H:%M:%S",
+	level=logging.INFO,
+)
+
+
+def get_shard_file(shard_dir: str, shard_idx: int, num_shards: int) -> str:
+    return os.path.join(shard_dir, f"shard-{shard_idx:05d}-of-{num_shards:05d}.jsonl")
+
+
+def read_shard_predictions(shard_file: str) -> Dict[str, str]:
+    """
+    :return: the id -> prediction of the completed instances of a shard, a line cut by a crash is ignored
+    """
+    predictions = {}
+    if not os.path.exists(shard_file):
+        return predictions
+    with open(shard_file, "r", encoding="utf-8") as read_file:
+        for line in read_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                break
+            predictions[record["id"]] = record["prediction"]
+    return predictions
+
+
+def truncate_incomplete_line(shard_file: str) -> None:
+    ## drop the end of a line cut by a crash, so that the appended lines start on a new line
+    if not os.path.exists(shard_file):
+        return
+    with open(shard_file, "rb+") as shard:
+        content = shard.read()
+        shard.truncate(content.rfind(b"\n") + 1)
+
+
+def prepare_shard_dir(shard_dir: str, meta: Dict) -> None:
+    """
+    Keep the completed shards only if they were produced by the same model, data and number of shards.
+    """
+    meta_file = os.path.join(shard_dir, "meta.json")
+    if os.path.exists(meta_file):
+        with open(meta_file, "r", encoding="utf-8") as read_file:
+            if json.load(read_file) == meta:
+                return
+        logger.info(f"[batch inference] {shard_dir} was produced by another model, data or number of shards, starting over")
+        shutil.rmtree(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    with open(meta_file, "w", encoding="utf-8") as write_file:
+        json.dump(meta, write_file)
+
+
+def run_shard(dataset: UniversalDataset, model: nn.Module, shard_idx: int, num_shards: int, shard_dir: str, batch_size: int,
+              uni_labels: List[str], constant_values: List[float], early_exit: bool = False, num_threads: int = 1) -> None:
+    """
+    Predict the contiguous shard `shard_idx` of the dataset, skipping the instances already in its shard file, the
+    predictions of each batch are appended (and synced) to the shard file as json lines.
+    """
+    torch.set_num_threads(num_threads)
+    start, end = len(dataset) * shard_idx // num_shards, len(dataset) * (shard_idx + 1) // num_shards
+    shard_file = get_shard_file(shard_dir, shard_idx, num_shards)
+    truncate_incomplete_line(shard_file)
+    done_ids = set(read_shard_predictions(shard_file))
+    insts = dataset.insts
+    indices = [idx for idx in range(start, end) if f"{insts[idx]['id']}" not in done_ids]
+    logger.info(f"[batch inference] shard {shard_idx}: {end - start} instances, {len(indices)} to predict")
+    model.eval()
+    with open(shard_file, "a", encoding="utf-8") as write_file, torch.no_grad():
+        for batch_start in range(0, len(indices), batch_size):
+            batch_indices = indices[batch_start:batch_start + batch_size]
+            feature = dataset.collate_function([dataset[idx] for idx in batch_indices])
+            output = model(input_ids=feature.input_ids, attention_mask=feature.attention_mask,
+                           token_type_ids=feature.token_type_ids,
+                           variable_indexs_start=feature.variable_indexs_start,
+                           variable_indexs_end=feature.variable_indexs_end,
+                           num_variables=feature.num_variables,
+                           variable_index_mask=feature.variable_index_mask,
+                           return_dict=True, is_eval=True, early_exit=early_exit)
+            predictions, prediction_lengths = get_batched_prediction_consider_multiple_m0(predictions=output.predictions)
+            batch_insts = [insts[idx] for idx in batch_indices]
+            num_matrix = get_num_matrix([inst["num_list"] for inst in batch_insts])
+            values, _ = compute_values_for_batched_equations(predictions, prediction_lengths, num_matrix, uni_labels, constant_values)
+            write_file.write("".join(json.dumps({"id": f"{inst['id']}", "prediction": f"{value}"}) + "\n"
+                                     for inst, value in zip(batch_insts, values.tolist())))
+            write_file.flush()
+            os.fsync(write_file.fileno())
+
+
+def run_shards(dataset: UniversalDataset, model: nn.Module, num_shards: int, shard_dir: str, batch_size: int,
+               uni_labels: List[str], constant_values: List[float], early_exit: bool = False, num_workers: int = None) -> None:
+    """
+    Run the shards in forked worker processes, at most `num_workers` at a time. The workers share the model weights
+    (in shared memory) and the memory-mapped features of the parent instead of loading their own copies, and split the
+    cpu cores between them.
+    """
+    num_workers = min(num_shards, num_workers or os.cpu_count())
+    num_threads = max(1, torch.get_num_threads() // num_workers)
+    if num_workers == 1:
+        for shard_idx in range(num_shards):
+            run_shard(dataset, model, shard_idx, num_shards, shard_dir, batch_size, uni_labels, constant_values, early_exit,
+                      num_threads=torch.get_num_threads())
+        return
+    ## the packed weights of the quantized Linear layers are not parameters, the pages of the fork are shared until written
+    model.share_memory()
+    ## the workers do not tokenize, the features are already in the dataset
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    context = multiprocessing.get_context("fork")
+    pending = list(range(num_shards))
+    running = []
+    failed = []
+    while len(pending) > 0 or len(running) > 0:
+        while len(pending) > 0 and len(running) < num_workers:
+            shard_idx = pending.pop(0)
+            process = context.Process(target=run_shard, args=(dataset, model, shard_idx, num_shards, shard_dir, batch_size, uni_labels,
+                                                              constant_values, early_exit, num_threads))
+            process.start()
+            running.append((shard_idx, process))
+        ## a new worker starts as soon as any of the running ones is done
+        ready = multiprocessing.connection.wait([process.sentinel for _, process in running])
+        for shard_idx, process in [(shard_idx, process) for shard_idx, process in running if process.sentinel in ready]:
+            process.join()
+            running.remove((shard_idx, process))
+            if process.exitcode != 0:
+                failed.append(shard_idx)
+    if len(failed) > 0:
+        raise RuntimeError(f"shards {sorted(failed)} failed, run again to resume them")
+
+
+def merge_shards(dataset: UniversalDataset, num_shards: int, shard_dir: str, submission_file: str) -> None:
+    """
+    Write the predictions of all the shards to `submission_file` as the "id,prediction" csv, in the order of the data file.
+    """
+    predictions = {}
+    for shard_idx in range(num_shards):
+        predictions.update(read_shard_predictions(get_shard_file(shard_dir, shard_idx, num_shards)))
+    answers = [['id', 'prediction']]
+    for inst in dataset.insts:
+        _id = f"{inst['id']}"
+        if _id not in predictions:
+            raise RuntimeError(f"no prediction for {_id}, run again to resume the shards")
+        answers.append([_id, predictions[_id]])
+    with open(submission_file, 'w', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerows(answers)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="offline batch inference")
+    parser.add_argument('--num_shards', type=int, default=os.cpu_count(), help="the number of shards of the test file")
+    parser.add_argument('--num_inference_workers', type=int, default=0, help="the number of worker processes, 0 means one per cpu core")
+    parser.add_argument('--shard_dir', type=str, default="results/shards", help="the folder of the predictions of the shards")
+    parser.add_argument('--submission_file', type=str, default="data/submission.csv")
+    opt = parse_arguments(parser)
+    conf = Config(opt)
+    bert_model_name = conf.bert_model_name if conf.bert_folder == "" or conf.bert_folder == "none" else f"{conf.bert_folder}/{conf.bert_model_name}"
+    tokenizer = AutoTokenizer.from_pretrained(bert_model_name, use_fast=True)
+    if conf.quant_special_token:
+        add_quant_special_token(tokenizer)
+    uni_labels, constant2id, constant_values = get_task_constants(conf.train_file)
+    model_dir = f"model_files/{conf.model_folder}"
+
+    logger.info("Initializing model.")
+    model_kwargs = dict(num_labels=len(uni_labels),
+                        height=conf.height,
+                        constant_num=len(constant_values) if constant_values is not None else 0,
+                        var_update_mode=conf.var_update_mode,
+                        factorized_scoring=conf.factorized_scoring,
+                        incremental_scoring=conf.incremental_scoring,
+                        quant_special_token=conf.quant_special_token)
+    model = load_inference_model(class_name_2_model[bert_model_name], model_dir, quantize=conf.quantize,
+                                 quantized_cache_dir=conf.quantized_cache_dir, **model_kwargs)
+
+    logger.info("Reading questions")
+    ## the forked workers share the features of the parent (memory-mapped with --feature_cache_dir), they do not copy them
+    conf.streaming = False
+    questions = get_dataset(conf, file=conf.test_file, number=conf.test_num, filtered_steps=opt.test_filtered_steps, data_max_height=conf.height,
+                            tokenizer=tokenizer, uni_labels=uni_labels, constant2id=constant2id, constant_values=constant_values,
+                            pretrained_model_name=bert_model_name)
+
+    prepare_shard_dir(opt.shard_dir, meta={"model": get_model_id(model_dir, tokenizer, uni_labels, constant_values, **get_decoding_settings(conf)),
+                                           "file": get_file_digest(conf.test_file), "number": conf.test_num, "num_shards": opt.num_shards})
+    start_time = time.time()
+    run_shards(questions, model, opt.num_shards, opt.shard_dir, conf.batch_size, uni_labels, constant_values, early_exit=conf.early_exit,
+               num_workers=opt.num_inference_workers)
+    elapsed = time.time() - start_time
+    logger.info(f"[batch inference] {len(questions)} instances in {elapsed:.1f}s ({len(questions) / elapsed:.1f} instances/s)")
+    merge_shards(questions, opt.num_shards, opt.shard_dir, opt.submission_file)
+    logger.info(f"[batch inference] predictions written to {opt.submission_file}")
+
+if __name__ == "__main__":
+    main()
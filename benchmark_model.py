@@ -0,0 +1,107 @@
+from src.model.universal_model import UniversalModel, GRAD_CHECKPOINT_MODES, get_label_rep, enable_grad_checkpoint
+from tests.sync_counter import count_training_step_syncs
+import time
+import torch
+from transformers import BertConfig
+from typing import List
+
+
+def benchmark_label_rep(hidden_size: int = 768, num_labels: int = 8, batch_size: int = 30, num_repeats: int = 10,
+                        num_variable_list: List[int] = (5, 10, 20, 30), device: str = "cpu"):
+    """
+    FLOPs/latency of the factorized pair scoring against the concatenation version as the number of variables
+    grows, with the max difference for reference (the parity is asserted in tests/test_factorized_scoring.py).
+    """
+    config = BertConfig(hidden_size=hidden_size, num_labels=num_labels, num_hidden_layers=1, num_attention_heads=12)
+    model = UniversalModel(config, height=1, constant_num=0, var_update_mode='gru').to(device).eval()
+    for num_variables in num_variable_list:
+        var_hidden_states = torch.randn(batch_size, num_variables, hidden_size, device=device)
+        combination = torch.combinations(torch.arange(0, num_variables, device=device), r=2, with_replacement=True)
+        num_combinations, _ = combination.size()
+        results = {}
+        with torch.no_grad():
+            for factorized_scoring in [False, True]:
+                model.factorized_scoring = factorized_scoring
+                label_rep = get_label_rep(model, var_hidden_states, combination)
+                start = time.time()
+                for _ in range(num_repeats):
+                    get_label_rep(model, var_hidden_states, combination)
+                if device != "cpu":
+                    torch.cuda.synchronize()
+                results[factorized_scoring] = (label_rep, (time.time() - start) / num_repeats * 1000)
+        ## multiply-adds of the 3h -> h projections over all labels
+        full_flops = 2 * batch_size * num_combinations * num_labels * 3 * hidden_size * hidden_size
+        factorized_flops = 2 * batch_size * num_labels * hidden_size * hidden_size * (2 * num_variables + num_combinations)
+        max_diff = (results[False][0] - results[True][0]).abs().max().item()
+        print(f"num_variables: {num_variables}, num_combinations: {num_combinations}, max diff: {max_diff:.2e}, "
+              f"full: {full_flops / 1e9:.2f} GFLOPs {results[False][1]:.2f}ms, "
+              f"factorized: {factorized_flops / 1e9:.2f} GFLOPs {results[True][1]:.2f}ms")
+
+
+def benchmark_grad_checkpoint(batch_sizes: List[int] = (4, 8, 16), hidden_size: int = 768, num_hidden_layers: int = 2,
+                              seq_len: int = 64, num_variables: int = 8, height: int = 4, num_repeats: int = 3,
+                              device: str = "cpu") -> None:
+    """
+    Activation memory and throughput of a training step (forward and backward) for each `--grad_checkpoint` mode and
+    batch size. The activation memory is the size of the tensors (weights excluded) kept for backward, plus the peak
+    allocated memory on cuda. The gradients are checked against the mode "none".
+    """
+    config = BertConfig(hidden_size=hidden_size, num_labels=8, num_hidden_layers=num_hidden_layers, num_attention_heads=12,
+                        intermediate_size=4 * hidden_size, vocab_size=1000)
+    torch.manual_seed(0)
+    model = UniversalModel(config, height=height, constant_num=2, var_update_mode='gru').to(device).train()
+    weight_storages = {param.untyped_storage().data_ptr() for param in model.parameters()}
+    for batch_size in batch_sizes:
+        generator = torch.Generator().manual_seed(batch_size)
+        input_ids = torch.randint(1, 1000, (batch_size, seq_len), generator=generator)
+        variable_indexs_start = torch.stack([torch.randperm(seq_len - 2, generator=generator)[:num_variables] + 1 for _ in range(batch_size)])
+        ## left, right, label, stop: each height combines the previous intermediate variable (index 0) with a variable
+        labels = torch.zeros((batch_size, height, 4), dtype=torch.long)
+        labels[:, :, 1] = torch.randint(0, num_variables + 2, (batch_size, height), generator=generator)
+        labels[:, :, 2] = torch.randint(0, 8, (batch_size, height), generator=generator)
+        labels[:, -1, 3] = 1
+        batch = dict(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), token_type_ids=torch.zeros_like(input_ids),
+                     variable_indexs_start=variable_indexs_start, variable_indexs_end=variable_indexs_start,
+                     num_variables=torch.full((batch_size,), num_variables), variable_index_mask=torch.ones((batch_size, num_variables)),
+                     labels=labels, label_height_mask=torch.ones((batch_size, height), dtype=torch.long))
+        batch = {name: tensor.to(device) for name, tensor in batch.items()}
+        base_grads = None
+        for mode in GRAD_CHECKPOINT_MODES:
+            enable_grad_checkpoint(model, mode)
+            saved_storages = {}
+
+            def pack(tensor: torch.Tensor) -> torch.Tensor:
+                storage = tensor.untyped_storage()
+                if storage.data_ptr() not in weight_storages:
+                    saved_storages[storage.data_ptr()] = storage.nbytes()
+                return tensor
+
+            if device != "cpu":
+                torch.cuda.reset_peak_memory_stats()
+            ## the same dropout masks in every mode
+            torch.manual_seed(0)
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                loss = model(**batch, return_dict=True).loss
+            loss.backward()
+            grads = [param.grad.clone() for param in model.parameters() if param.grad is not None]
+            base_grads = grads if base_grads is None else base_grads
+            grad_diff = max((grad - base_grad).abs().max().item() for grad, base_grad in zip(grads, base_grads))
+            model.zero_grad()
+            peak_memory = f", cuda peak: {torch.cuda.max_memory_allocated() / 2 ** 20:.0f}MB" if device != "cpu" else ""
+            start = time.time()
+            for _ in range(num_repeats):
+                model(**batch, return_dict=True).loss.backward()
+                model.zero_grad()
+            if device != "cpu":
+                torch.cuda.synchronize()
+            elapsed = (time.time() - start) / num_repeats
+            print(f"batch_size: {batch_size}, grad_checkpoint: {mode}, activations: {sum(saved_storages.values()) / 2 ** 20:.0f}MB{peak_memory}, "
+                  f"step: {elapsed * 1000:.0f}ms ({batch_size / elapsed:.1f} instances/s), grad diff: {grad_diff:.2e}")
+    enable_grad_checkpoint(model, "none")
+
+
+if __name__ == "__main__":
+    benchmark_label_rep()
+    benchmark_grad_checkpoint()
+    for mode in ['gru', 'attn', 'none']:
+        print(f"var_update_mode: {mode}, host syncs per training step: {count_training_step_syncs(var_update_mode=mode)}")
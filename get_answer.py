@@ -1,24 +1,28 @@
-from src.data.universal_dataset import UniversalDataset
+from src.data.universal_dataset import UniFeature, add_quant_special_token
+from src.eval.answer_cache import AnswerCache, get_decoding_settings, get_model_id, pad_steps
 from src.config import Config
 from torch.utils.data import DataLoader
 from transformers import AutoTokenizer, PreTrainedTokenizerFast
 from tqdm import tqdm
 import argparse
-from src.utils import get_optimizers, write_data
+from src.utils import StartupProfiler
 import torch
 import torch.nn as nn
 import numpy as np
 import os
 import random
-from src.model.universal_model import UniversalModel
+from src.model.universal_model import UniversalModel, load_inference_model
 from collections import Counter
 from src.eval.utils import *
-from typing import List, Tuple
+from typing import Dict, List, Tuple
 import logging
 from transformers import set_seed
-from universal_main import parse_arguments, class_name_2_model
+from universal_main import parse_arguments, class_name_2_model, get_batched_prediction_consider_multiple_m0, concat_padded_steps, get_dataset
 import csv
+import itertools
+import concurrent.futures
 import json
+import time
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -29,74 +33,75 @@ logging.basicConfig(
 )
 
 
-def get_batched_prediction_consider_multiple_m0(feature, all_logits: torch.FloatTensor, constant_num: int):
-    batch_size, max_num_variable = feature.variable_indexs_start.size()
-    device = feature.variable_indexs_start.device
-    batched_prediction = [[] for _ in range(batch_size)]
-    for k, logits in enumerate(all_logits):
-        current_max_num_variable = max_num_variable + constant_num + k
-        num_var_range = torch.arange(0, current_max_num_variable, device=feature.variable_indexs_start.device)
-        combination = torch.combinations(num_var_range, r=2, with_replacement=True)  ##number_of_combinations x 2
-        num_combinations, _ = combination.size()
-
-        best_temp_logits, best_temp_stop_label = logits.max(dim=-1)  ## batch_size, num_combinations/num_m0, num_labels
-        best_temp_score, best_temp_label = best_temp_logits.max(dim=-1)  ## batch_size, num_combinations
-        best_m0_score, best_comb = best_temp_score.max(dim=-1)  ## batch_size
-        best_label = torch.gather(best_temp_label, 1, best_comb.unsqueeze(-1)).squeeze(-1)  ## batch_size
-        b_idxs = [bidx for bidx in range(batch_size)]
-        best_stop_label = best_temp_stop_label[b_idxs, best_comb, best_label] ## batch size
-
-        # batch_size x 2
-        best_comb_var_idxs = torch.gather(combination.unsqueeze(0).expand(batch_size, num_combinations, 2), 1,
-                                          best_comb.unsqueeze(1).unsqueeze(2).expand(batch_size, 1, 2).to(device)).squeeze(1)
-        best_comb_var_idxs = best_comb_var_idxs.cpu().numpy()
-        best_labels = best_label.cpu().numpy()
-        curr_best_stop_labels = best_stop_label.cpu().numpy()
-        for b_idx, (best_comb_idx, best_label, stop_label) in enumerate(zip(best_comb_var_idxs, best_labels, curr_best_stop_labels)):  ## within each instances:
-            left, right = best_comb_idx
-            curr_label = [left, right, best_label, stop_label]
-            batched_prediction[b_idx].append(curr_label)
-    return batched_prediction
+def select_batch(feature: UniFeature, indices: List[int]) -> UniFeature:
+    """
+    Some instances of a collated batch, with the padding cut to the longest of them.
+    """
+    indices = torch.tensor(indices, dtype=torch.long)
+    max_length = int(feature.attention_mask[indices].sum(dim=1).max())
+    max_num_variable = int(feature.num_variables[indices].max())
+    return UniFeature(input_ids=feature.input_ids[indices, :max_length],
+                      attention_mask=feature.attention_mask[indices, :max_length],
+                      token_type_ids=feature.token_type_ids[indices, :max_length],
+                      variable_indexs_start=feature.variable_indexs_start[indices, :max_num_variable],
+                      variable_indexs_end=feature.variable_indexs_end[indices, :max_num_variable],
+                      num_variables=feature.num_variables[indices],
+                      variable_index_mask=feature.variable_index_mask[indices, :max_num_variable])
 
 
 def get_ans(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device, fp16:bool, constant_values: List, uni_labels:List,
-             res_file: str= None, err_file:str = None) -> float:
+             res_file: str= None, err_file:str = None, early_exit: bool = False, answer_cache: AnswerCache = None) -> float:
+    """
+    With `answer_cache`, only the instances whose text is not in the cache go through the model, the equations of the
+    others are taken from the cache and executed with their own numbers.
+    """
 
     model.eval()
     predictions = []
+    all_prediction_lengths = []
     answers = []
     answers.append(['id', 'prediction'])
 
     constant_num = len(constant_values) if constant_values else 0
+    insts = iter(valid_dataloader.dataset.insts)
     with torch.no_grad():
         for index, feature in tqdm(enumerate(valid_dataloader), desc="--validation", total=len(valid_dataloader)):
+            if answer_cache is not None:
+                keys = answer_cache.get_keys(list(itertools.islice(insts, len(feature.num_variables))))
+                batch_steps = answer_cache.get_many(keys)
+                miss_indices = [idx for idx, steps in enumerate(batch_steps) if steps is None]
+                if len(miss_indices) == 0:
+                    batched_prediction, prediction_lengths = pad_steps(batch_steps)
+                    predictions.append(batched_prediction)
+                    all_prediction_lengths.append(prediction_lengths)
+                    continue
+                if len(miss_indices) < len(batch_steps):
+                    feature = select_batch(feature, miss_indices)
             with torch.cuda.amp.autocast(enabled=fp16):
                 module = model.module if hasattr(model, 'module') else model
-                all_logits = module(input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
-                             token_type_ids=feature.token_type_ids.to(dev),
-                             variable_indexs_start=feature.variable_indexs_start.to(dev),
-                             variable_indexs_end=feature.variable_indexs_end.to(dev),
-                             num_variables = feature.num_variables.to(dev),
-                             variable_index_mask= feature.variable_index_mask.to(dev),
-                             return_dict=True, is_eval=True).all_logits
-                batched_prediction = get_batched_prediction_consider_multiple_m0(feature=feature, all_logits=all_logits, constant_num=constant_num)
-                for b, inst_predictions in enumerate(batched_prediction):
-                    for p, prediction_step in enumerate(inst_predictions):
-                        left, right, op_id, stop_id = prediction_step
-                        if stop_id == 1:
-                            batched_prediction[b] = batched_prediction[b][:(p+1)]
-                            break
-
-                predictions.extend(batched_prediction)
+                output = module(input_ids=feature.input_ids.to(dev, non_blocking=True), attention_mask=feature.attention_mask.to(dev, non_blocking=True),
+                             token_type_ids=feature.token_type_ids.to(dev, non_blocking=True),
+                             variable_indexs_start=feature.variable_indexs_start.to(dev, non_blocking=True),
+                             variable_indexs_end=feature.variable_indexs_end.to(dev, non_blocking=True),
+                             num_variables = feature.num_variables.to(dev, non_blocking=True),
+                             variable_index_mask= feature.variable_index_mask.to(dev, non_blocking=True),
+                             return_dict=True, is_eval=True, early_exit=early_exit)
+                batched_prediction, prediction_lengths = get_batched_prediction_consider_multiple_m0(predictions=output.predictions)
+            if answer_cache is not None:
+                new_steps = [steps[:length] for steps, length in zip(batched_prediction, prediction_lengths)]
+                answer_cache.put_many([keys[idx] for idx in miss_indices], new_steps)
+                for idx, steps in zip(miss_indices, new_steps):
+                    batch_steps[idx] = steps
+                batched_prediction, prediction_lengths = pad_steps(batch_steps)
+            predictions.append(batched_prediction)
+            all_prediction_lengths.append(prediction_lengths)
     
-        total = len(predictions)
         insts = valid_dataloader.dataset.insts
-
-        for inst_predictions, inst in zip(predictions, insts):
-            
-            num_list = inst["num_list"]
+        predictions, prediction_lengths = concat_padded_steps(predictions), np.concatenate(all_prediction_lengths)
+        num_matrix = get_num_matrix([inst["num_list"] for inst in insts])
+        pred_vals, _ = compute_values_for_batched_equations(predictions, prediction_lengths, num_matrix, uni_labels, constant_values)
+        for pred_val, inst in zip(pred_vals.tolist(), insts):
             _id = inst["id"]
-            pred_val, incremental_equations = compute_value_for_incremental_equations(inst_predictions, num_list, constant_num, uni_labels, constant_values)
             answers.append([f'{_id}', f'{pred_val}'])
 
         return answers
@@ -104,15 +109,47 @@ def get_ans(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device, f
 
 
 
+def get_quantization_report(valid_dataloader: DataLoader, fp32_model: nn.Module, quantized_model: nn.Module, constant_values: List,
+                            uni_labels: List, early_exit: bool = False) -> Dict[str, Dict[str, float]]:
+    """
+    Latency and answers of the quantized model against the fp32 model on cpu: the agreement of the answers and, when the
+    instances have an "answer", the value accuracy of both.
+    """
+    insts = valid_dataloader.dataset.insts
+    gold_values = [inst.get("answer") for inst in insts]
+    has_answers = all(value is not None for value in gold_values)
+    results = {}
+    for name, model in [("fp32", fp32_model), ("int8", quantized_model)]:
+        start = time.time()
+        answers = get_ans(valid_dataloader, model, torch.device("cpu"), fp16=False, constant_values=constant_values, uni_labels=uni_labels,
+                          early_exit=early_exit)
+        elapsed = time.time() - start
+        values = [float(value) for _, value in answers[1:]]
+        results[name] = {"values": values, "latency_ms": elapsed / len(values) * 1000}
+        if has_answers:
+            results[name]["value_acc"] = float(np.mean([is_value_correct(value, float(gold)) for value, gold in zip(values, gold_values)])) * 100
+    agreement = float(np.mean([is_value_correct(fp32_value, int8_value) or fp32_value == int8_value
+                               for fp32_value, int8_value in zip(results["fp32"]["values"], results["int8"]["values"])])) * 100
+    for name in results:
+        results[name].pop("values")
+    logger.info(f"[quantization] {'model':<6}{'latency (ms/instance)':>24}{'value acc':>12}")
+    for name, result in results.items():
+        value_acc = f"{result['value_acc']:.2f}" if has_answers else "-"
+        logger.info(f"[quantization] {name:<6}{result['latency_ms']:>24.2f}{value_acc:>12}")
+    logger.info(f"[quantization] speedup: {results['fp32']['latency_ms'] / results['int8']['latency_ms']:.2f}x, "
+                f"same answer as fp32: {agreement:.2f}%")
+    results["agreement"] = agreement
+    return results
+
+
 def main():
+    profiler = StartupProfiler()
     parser = argparse.ArgumentParser(description="classificaton")
     opt = parse_arguments(parser)
     set_seed(opt.seed)
     conf = Config(opt)
 
     bert_model_name = "hfl/chinese-bert-wwm-ext"
-    tokenizer = AutoTokenizer.from_pretrained(bert_model_name, use_fast=True)
-
 
     uni_labels = [
         '+', '-', '-_rev', '*', '/', '/_rev'
@@ -126,20 +163,58 @@ def main():
     constant_number = len(constant_values)
 
     logger.info("Initializing model.")
-    model = UniversalModel.from_pretrained(model_path,
-                                            num_labels=num_labels,
-                                            height = conf.height,
-                                            constant_num = constant_number,
-                                        var_update_mode=conf.var_update_mode).to(conf.device)
+    if conf.quantize != "none" and conf.device.type != "cpu":
+        logger.info("The quantized model only runs on cpu.")
+        conf.device = torch.device("cpu")
+    model_kwargs = dict(num_labels=num_labels,
+                        height = conf.height,
+                        constant_num = constant_number,
+                        var_update_mode=conf.var_update_mode,
+                        factorized_scoring=conf.factorized_scoring,
+                        incremental_scoring=conf.incremental_scoring,
+                        quant_special_token=conf.quant_special_token)
+    ## the model is loaded in the background while the tokenizer and the questions are loaded
+    def load_model() -> nn.Module:
+        with profiler.stage("model (background)"):
+            return load_inference_model(UniversalModel, model_path, quantize=conf.quantize,
+                                        quantized_cache_dir=conf.quantized_cache_dir, **model_kwargs).to(conf.device)
+    model_loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    model_future = model_loader.submit(load_model)
+
+    with profiler.stage("tokenizer"):
+        tokenizer = AutoTokenizer.from_pretrained(bert_model_name, use_fast=True)
+        if conf.quant_special_token:
+            add_quant_special_token(tokenizer)
 
     logger.info("Reading questions")
-    questions = UniversalDataset(file=conf.test_file, tokenizer=tokenizer, uni_labels=conf.uni_labels, number=conf.dev_num, filtered_steps=opt.test_filtered_steps,
-                                    constant2id=constant2id, constant_values=constant_values, data_max_height=conf.height, pretrained_model_name=bert_model_name)
-    questions_dataloader = DataLoader(questions, batch_size=conf.batch_size, shuffle=False, num_workers=0,
+    with profiler.stage("questions"):
+        questions = get_dataset(conf, file=conf.test_file, number=conf.dev_num, filtered_steps=opt.test_filtered_steps, data_max_height=conf.height,
+                                tokenizer=tokenizer, uni_labels=conf.uni_labels, constant2id=constant2id, constant_values=constant_values,
+                                pretrained_model_name=bert_model_name)
+    questions.pin_memory = conf.pin_memory
+    questions_dataloader = DataLoader(questions, batch_size=conf.batch_size, shuffle=False, num_workers=0, pin_memory=conf.pin_memory,
                                   collate_fn=questions.collate_function)
-
-    res = get_ans(questions_dataloader, model, conf.device, uni_labels=conf.uni_labels, fp16=bool(conf.fp16), constant_values=constant_values
-                        )
+    with profiler.stage("wait for the model"):
+        model = model_future.result()
+    model_loader.shutdown()
+    if conf.profile_startup:
+        logger.info(f"[startup]\n{profiler.report()}")
+
+    if conf.quantize_report and conf.quantize != "none":
+        fp32_model = load_inference_model(UniversalModel, model_path, **model_kwargs)
+        get_quantization_report(questions_dataloader, fp32_model, model, constant_values=constant_values, uni_labels=conf.uni_labels,
+                                early_exit=conf.early_exit)
+
+    answer_cache = None
+    if conf.answer_cache_size > 0:
+        answer_cache = AnswerCache(get_model_id(model_path, tokenizer, conf.uni_labels, constant_values, **get_decoding_settings(conf)),
+                                   max_size=conf.answer_cache_size, ttl=conf.answer_cache_ttl, disk_file=conf.answer_cache_file)
+
+    res = get_ans(questions_dataloader, model, conf.device, uni_labels=conf.uni_labels, fp16=bool(conf.fp16), constant_values=constant_values,
+                  early_exit=conf.early_exit, answer_cache=answer_cache)
+    if answer_cache is not None:
+        logger.info(f"[answer cache] {answer_cache.stats()}")
+        answer_cache.close()
 
     with open('data/submission.csv', 'w', encoding='utf-8') as f:
         writer = csv.writer(f)
@@ -0,0 +1,79 @@
+from src.utils import iter_data
+import argparse
+import asyncio
+import itertools
+import json
+import time
+import numpy as np
+from typing import Dict, List, Tuple
+
+
+async def post_json(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, host: str, path: str, obj: Dict = None) -> Tuple[int, Dict]:
+    method = "GET" if obj is None else "POST"
+    body = b"" if obj is None else json.dumps(obj, ensure_ascii=False).encode("utf-8")
+    writer.write((f"{method} {path} HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n"
+                  f"Content-Length: {len(body)}\r\n\r\n").encode("latin-1") + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    return status, json.loads(await reader.readexactly(int(headers["content-length"])))
+
+
+async def run_client(host: str, port: int, problems: List[Dict], counter: itertools.count, num_requests: int,
+                     latencies: List[float], errors: List[str]) -> None:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for idx in counter:
+            if idx >= num_requests:
+                break
+            inst = problems[idx % len(problems)]
+            start_time = time.perf_counter()
+            status, response = await post_json(reader, writer, host, "/solve", {"ori_text": inst["ori_text"], "num_list": inst["num_list"]})
+            latencies.append(time.perf_counter() - start_time)
+            if status != 200:
+                errors.append(f"{status}: {response.get('error')}")
+    finally:
+        writer.close()
+
+
+async def load_test(host: str, port: int, problems: List[Dict], concurrency: int, num_requests: int) -> None:
+    latencies, errors = [], []
+    counter = itertools.count()
+    start_time = time.perf_counter()
+    await asyncio.gather(*[run_client(host, port, problems, counter, num_requests, latencies, errors) for _ in range(concurrency)])
+    total_time = time.perf_counter() - start_time
+    latencies = np.asarray(latencies) * 1000
+    print(f"[load test] requests: {len(latencies)}, concurrency: {concurrency}, errors: {len(errors)}, "
+          f"throughput: {len(latencies) / total_time:.1f} req/s, "
+          f"latency p50: {np.percentile(latencies, 50):.1f}ms, p99: {np.percentile(latencies, 99):.1f}ms")
+    for error in errors[:5]:
+        print(f"[load test] error {error}")
+    reader, writer = await asyncio.open_connection(host, port)
+    _, metrics = await post_json(reader, writer, host, "/metrics")
+    writer.close()
+    print(f"[server metrics] {json.dumps(metrics)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="load test of the inference server")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--file', type=str, default="data/task_dataset/math23k_test.json", help="the problems sent to the server")
+    parser.add_argument('--num_problems', type=int, default=1000, help="the number of problems read from the file")
+    parser.add_argument('--concurrency', type=int, default=32, help="the number of concurrent clients")
+    parser.add_argument('--num_requests', type=int, default=2000)
+    args = parser.parse_args()
+    for k in args.__dict__:
+        print(k + ": " + str(args.__dict__[k]))
+    ## the server rejects the problems without any quantity
+    problems = [inst for inst in itertools.islice(iter_data(args.file), args.num_problems) if len(inst["num_list"]) > 0]
+    asyncio.run(load_test(args.host, args.port, problems, args.concurrency, args.num_requests))
+
+if __name__ == "__main__":
+    main()
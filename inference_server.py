@@ -0,0 +1,321 @@
+from src.data.universal_dataset import UniversalDataset, tokenize_instances, get_feature, add_quant_special_token, QUANT_PATTERN
+from src.config import Config
+from src.model.universal_model import load_inference_model
+from transformers import AutoTokenizer, PreTrainedTokenizerFast
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import json
+import math
+import time
+import torch
+import torch.nn as nn
+import numpy as np
+from src.eval.answer_cache import AnswerCache, get_decoding_settings, get_model_id, pad_steps
+from src.eval.utils import get_num_matrix, compute_values_for_batched_equations, get_grounded_equations
+from typing import Dict, List, Tuple
+import logging
+from universal_main import parse_arguments, class_name_2_model, get_batched_prediction_consider_multiple_m0, get_task_constants
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logging.basicConfig(
+	format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+	datefmt="%m/%d/%Y %H:%M:%S",
+	level=logging.INFO,
+)
+
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error"}
+
+
+class InferenceMetrics:
+    """
+    Counters and the latencies/batch sizes of the most recent requests and batches.
+    """
+
+    def __init__(self, window: int = 10000):
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_batches = 0
+
+    def record_batch(self, batch_size: int) -> None:
+        self.num_batches += 1
+        self.batch_sizes.append(batch_size)
+
+    def record_request(self, latency: float, is_error: bool) -> None:
+        self.num_requests += 1
+        self.num_errors += 1 if is_error else 0
+        self.latencies.append(latency)
+
+    def snapshot(self, queue_depth: int) -> Dict:
+        latencies = np.asarray(self.latencies) * 1000 if len(self.latencies) > 0 else np.zeros(1)
+        batch_sizes = np.asarray(self.batch_sizes) if len(self.batch_sizes) > 0 else np.zeros(1)
+        return {
+            "queue_depth": queue_depth,
+            "requests": self.num_requests,
+            "errors": self.num_errors,
+            "batches": self.num_batches,
+            "mean_batch_size": float(batch_sizes.mean()),
+            "max_batch_size": int(batch_sizes.max()),
+            "latency_ms_p50": float(np.percentile(latencies, 50)),
+            "latency_ms_p99": float(np.percentile(latencies, 99)),
+        }
+
+
+class DeductiveSolver:
+    """
+    Tokenize a batch of problems, decode the equations with the deductive model and execute them.
+    """
+
+    def __init__(self, model: nn.Module, tokenizer: PreTrainedTokenizerFast, uni_labels: List[str], constant_values: List[float],
+                 dev: torch.device, fp16: bool = False, early_exit: bool = True, answer_cache: AnswerCache = None):
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.uni_labels = uni_labels
+        self.constant_values = constant_values
+        self.dev = dev
+        self.fp16 = fp16
+        self.early_exit = early_exit
+        self.pin_memory = False
+        self.quant_ids = UniversalDataset.get_quant_ids(tokenizer)
+        self.answer_cache = answer_cache
+
+    collate_function = UniversalDataset.collate_function
+
+    @staticmethod
+    def validate(inst: Dict) -> Dict:
+        """
+        :return: the problem with the fields used by the model, raise ValueError if it cannot be solved
+        """
+        if not isinstance(inst, dict) or not isinstance(inst.get("ori_text"), str) or not isinstance(inst.get("num_list"), list):
+            raise ValueError('a problem is {"ori_text": str, "num_list": [number, ...]}')
+        num_list = [float(num) for num in inst["num_list"]]
+        num_quants = len(QUANT_PATTERN.findall(inst["ori_text"]))
+        if num_quants == 0 or num_quants != len(num_list):
+            raise ValueError(f"the text has {num_quants} quantities (temp_a, temp_b, ...) but num_list has {len(num_list)} numbers")
+        return {"ori_text": inst["ori_text"], "num_list": num_list}
+
+    def predict_steps(self, insts: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+        arrays = tokenize_instances(self.tokenizer, self.quant_ids, insts)
+        feature = self.collate_function([get_feature(arrays, idx) for idx in range(len(insts))])
+        dev = self.dev
+        with torch.no_grad(), torch.cuda.amp.autocast(enabled=self.fp16):
+            output = self.model(input_ids=feature.input_ids.to(dev, non_blocking=True), attention_mask=feature.attention_mask.to(dev, non_blocking=True),
+                                token_type_ids=feature.token_type_ids.to(dev, non_blocking=True),
+                                variable_indexs_start=feature.variable_indexs_start.to(dev, non_blocking=True),
+                                variable_indexs_end=feature.variable_indexs_end.to(dev, non_blocking=True),
+                                num_variables=feature.num_variables.to(dev, non_blocking=True),
+                                variable_index_mask=feature.variable_index_mask.to(dev, non_blocking=True),
+                                return_dict=True, is_eval=True, early_exit=self.early_exit)
+        return get_batched_prediction_consider_multiple_m0(predictions=output.predictions)
+
+    def solve(self, insts: List[Dict]) -> List[Dict]:
+        if self.answer_cache is None:
+            predictions, prediction_lengths = self.predict_steps(insts)
+        else:
+            ## only the problems with a new text go through the model
+            keys = self.answer_cache.get_keys(insts)
+            batch_steps = self.answer_cache.get_many(keys)
+            miss_indices = [idx for idx, steps in enumerate(batch_steps) if steps is None]
+            if len(miss_indices) > 0:
+                new_predictions, new_lengths = self.predict_steps([insts[idx] for idx in miss_indices])
+                new_steps = [steps[:length] for steps, length in zip(new_predictions, new_lengths)]
+                self.answer_cache.put_many([keys[idx] for idx in miss_indices], new_steps)
+                for idx, steps in zip(miss_indices, new_steps):
+                    batch_steps[idx] = steps
+            predictions, prediction_lengths = pad_steps(batch_steps)
+        num_matrix = get_num_matrix([inst["num_list"] for inst in insts])
+        values, step_results = compute_values_for_batched_equations(predictions, prediction_lengths, num_matrix, self.uni_labels, self.constant_values)
+        results = []
+        for idx in range(len(insts)):
+            equations = get_grounded_equations(step_results[idx], predictions[idx], prediction_lengths[idx], self.uni_labels)
+            ## inf/nan are not valid json
+            results.append({
+                "answer": to_json_number(values[idx]),
+                "equations": [[to_json_number(left), to_json_number(right), op, to_json_number(value)] for left, right, op, value in equations],
+            })
+        return results
+
+
+def to_json_number(value: float):
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+class MicroBatcher:
+    """
+    Collect the requests for at most `batch_window_ms` after the first one (or until `max_batch_size`), and solve them
+    as one batch in a single model thread, the next batch is collected while the current one runs.
+    """
+
+    def __init__(self, solver: DeductiveSolver, metrics: InferenceMetrics, max_batch_size: int = 32, batch_window_ms: float = 5.0):
+        self.solver = solver
+        self.metrics = metrics
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window_ms / 1000
+        self.queue = asyncio.Queue()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, inst: Dict) -> Dict:
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((inst, future))
+        return await future
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.batch_window
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            self.metrics.record_batch(len(batch))
+            insts = [inst for inst, _ in batch]
+            results = await loop.run_in_executor(self.executor, self.solve_batch, insts)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def solve_batch(self, insts: List[Dict]) -> List:
+        try:
+            return self.solver.solve(insts)
+        except Exception:
+            if len(insts) == 1:
+                logger.exception("failed to solve the problem")
+                return [RuntimeError("failed to solve the problem")]
+            ## find the failing problems, without failing the whole batch
+            return [self.solve_batch([inst])[0] for inst in insts]
+
+
+class InferenceServer:
+    """
+    Minimal HTTP/1.1 (keep-alive) server on asyncio streams:
+        POST /solve     {"ori_text": "... temp_a ... temp_b ...", "num_list": [..]} -> {"answer": .., "equations": [[left, right, op, value], ..]}
+        GET  /metrics   queue depth, batch sizes, p50/p99 latencies and the answer cache counters
+        GET  /health
+    """
+
+    def __init__(self, batcher: MicroBatcher, metrics: InferenceMetrics):
+        self.batcher = batcher
+        self.metrics = metrics
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode("latin-1").partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                status, response = await self.route(method, path, body)
+                keep_alive = headers.get("connection", "keep-alive").lower() != "close"
+                payload = json.dumps(response, ensure_ascii=False).encode("utf-8")
+                writer.write((f"HTTP/1.1 {status} {HTTP_REASONS[status]}\r\nContent-Type: application/json\r\n"
+                              f"Content-Length: {len(payload)}\r\nConnection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1") + payload)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, body: bytes) -> Tuple[int, Dict]:
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/metrics":
+            metrics = self.metrics.snapshot(queue_depth=self.batcher.queue.qsize())
+            if self.batcher.solver.answer_cache is not None:
+                metrics["answer_cache"] = self.batcher.solver.answer_cache.stats()
+            return 200, metrics
+        if path != "/solve":
+            return 404, {"error": f"unknown path {path}"}
+        if method != "POST":
+            return 405, {"error": "use POST"}
+        start_time = time.perf_counter()
+        try:
+            inst = self.batcher.solver.validate(json.loads(body))
+        except (ValueError, TypeError) as error:
+            self.metrics.record_request(time.perf_counter() - start_time, is_error=True)
+            return 400, {"error": str(error)}
+        try:
+            result = await self.batcher.submit(inst)
+        except Exception as error:
+            self.metrics.record_request(time.perf_counter() - start_time, is_error=True)
+            return 500, {"error": str(error)}
+        self.metrics.record_request(time.perf_counter() - start_time, is_error=False)
+        return 200, result
+
+
+async def serve(solver: DeductiveSolver, host: str, port: int, max_batch_size: int, batch_window_ms: float) -> None:
+    metrics = InferenceMetrics()
+    batcher = MicroBatcher(solver, metrics, max_batch_size=max_batch_size, batch_window_ms=batch_window_ms)
+    server = InferenceServer(batcher, metrics)
+    batcher_task = asyncio.create_task(batcher.run())
+    http_server = await asyncio.start_server(server.handle_connection, host, port)
+    logger.info(f"Serving on http://{host}:{port} (max batch size: {max_batch_size}, batch window: {batch_window_ms}ms)")
+    try:
+        async with http_server:
+            await http_server.serve_forever()
+    finally:
+        batcher_task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="inference server")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max_batch_size', type=int, default=32, help="the maximum number of requests in a batch")
+    parser.add_argument('--batch_window_ms', type=float, default=5.0, help="how long a batch waits for more requests after its first one")
+    opt = parse_arguments(parser)
+    conf = Config(opt)
+    bert_model_name = conf.bert_model_name if conf.bert_folder == "" or conf.bert_folder == "none" else f"{conf.bert_folder}/{conf.bert_model_name}"
+    tokenizer = AutoTokenizer.from_pretrained(bert_model_name, use_fast=True)
+    if conf.quant_special_token:
+        add_quant_special_token(tokenizer)
+    uni_labels, constant2id, constant_values = get_task_constants(conf.train_file)
+
+    logger.info("Initializing model.")
+    MODEL_CLASS = class_name_2_model[bert_model_name]
+    if conf.quantize != "none" and conf.device.type != "cpu":
+        logger.info("The quantized model only runs on cpu.")
+        conf.device = torch.device("cpu")
+    model = load_inference_model(MODEL_CLASS, f"model_files/{conf.model_folder}",
+                                 quantize=conf.quantize,
+                                 quantized_cache_dir=conf.quantized_cache_dir,
+                                 num_labels=len(uni_labels),
+                                 height=conf.height,
+                                 constant_num=len(constant_values) if constant_values is not None else 0,
+                                 var_update_mode=conf.var_update_mode,
+                                 factorized_scoring=conf.factorized_scoring,
+                                 incremental_scoring=conf.incremental_scoring,
+                                 quant_special_token=conf.quant_special_token).to(conf.device)
+    answer_cache = None
+    if conf.answer_cache_size > 0:
+        answer_cache = AnswerCache(get_model_id(f"model_files/{conf.model_folder}", tokenizer, uni_labels, constant_values, **get_decoding_settings(conf)),
+                                   max_size=conf.answer_cache_size, ttl=conf.answer_cache_ttl, disk_file=conf.answer_cache_file)
+    solver = DeductiveSolver(model, tokenizer, uni_labels, constant_values, conf.device, fp16=bool(conf.fp16), early_exit=True,
+                             answer_cache=answer_cache)
+    asyncio.run(serve(solver, opt.host, opt.port, opt.max_batch_size, opt.batch_window_ms))
+
+if __name__ == "__main__":
+    main()
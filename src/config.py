@@ -11,8 +11,15 @@ class Config:
         self.train_num = args.train_num
         self.dev_num = args.dev_num
         self.test_num = args.test_num
+        self.bucket_batches = bool(args.bucket_batches)
+        self.max_batch_tokens = args.max_batch_tokens
+        self.max_batch_combinations = args.max_batch_combinations
+        self.gradient_accumulation_steps = args.gradient_accumulation_steps
+        self.step_tokens = args.step_tokens
+        self.step_combinations = args.step_combinations
 
         self.num_workers = 8 ## workers
+        self.pin_memory = bool(args.pin_memory)
 
         # optimizer hyperparameter
         self.learning_rate = args.learning_rate
@@ -29,11 +36,29 @@ class Config:
         self.bert_folder = args.bert_folder
         self.height = args.height
         self.var_update_mode = args.var_update_mode
+        self.factorized_scoring = bool(args.factorized_scoring)
+        self.incremental_scoring = bool(args.incremental_scoring)
+        self.quantize = args.quantize
+        self.quantized_cache_dir = args.quantized_cache_dir
+        self.early_exit = bool(args.early_exit)
+        self.quant_special_token = bool(args.quant_special_token)
+        self.quant_subword_ids = None ## set when "<quant>" is added to the tokenizer
 
 
         self.train_file = args.train_file
         self.dev_file = args.dev_file
         self.test_file = args.test_file
+        self.feature_cache_dir = args.feature_cache_dir
+        self.streaming = bool(args.streaming)
+        self.freeze_encoder = bool(args.freeze_encoder)
+        self.grad_checkpoint = args.grad_checkpoint
+        self.hidden_state_cache_dir = args.hidden_state_cache_dir
+        self.gzip_results = bool(args.gzip_results)
+        self.answer_cache_size = args.answer_cache_size
+        self.answer_cache_ttl = args.answer_cache_ttl
+        self.answer_cache_file = args.answer_cache_file
+        self.quantize_report = bool(args.quantize_report)
+        self.profile_startup = bool(args.profile_startup)
 
 
         self.uni_labels = []
\ No newline at end of file
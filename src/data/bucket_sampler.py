@@ -0,0 +1,160 @@
+import math
+import logging
+from typing import Dict, Iterator, List, Tuple
+
+import numpy as np
+from torch.utils.data import Sampler
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+def get_num_combinations(num_variables: np.ndarray) -> np.ndarray:
+    ## the number of (left, right) pairs with left <= right scored at the first height
+    return num_variables * (num_variables + 1) // 2
+
+
+def get_instance_costs(lengths: np.ndarray, num_variables: np.ndarray, heights: np.ndarray, constant_num: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :return: the tokens and the (pair x height) of each instance, without padding
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    combinations = get_num_combinations(np.asarray(num_variables, dtype=np.int64) + constant_num) * np.maximum(np.asarray(heights, dtype=np.int64), 1)
+    return lengths, combinations
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batch sampler that groups instances with similar (sequence length, number of variables, equation height).
+
+    Every epoch the instances are shuffled and split into pools of `batch_size * pool_multiplier` instances, each pool is
+    sorted by the three keys and cut into batches, and the batches are shuffled again, so that the epochs stay random
+    while the instances of a batch are padded to similar sizes.
+    With `max_tokens`/`max_combinations` the batches are cut by cost instead of a fixed size: a batch stops growing
+    when `batch size x max sequence length` or `batch size x max (pairs x height)` over its instances (pairs of the
+    variables and constants, height at least 1) exceeds the budget, `batch_size` is still the maximum number of instances.
+    """
+
+    def __init__(self, lengths: np.ndarray,
+                 num_variables: np.ndarray,
+                 heights: np.ndarray,
+                 batch_size: int,
+                 constant_num: int = 0,
+                 max_tokens: int = 0,
+                 max_combinations: int = 0,
+                 pool_multiplier: int = 50,
+                 length_bucket_width: int = 8,
+                 shuffle: bool = True,
+                 seed: int = 42) -> None:
+        """
+        :param lengths: the wordpiece length of each instance
+        :param num_variables: the number of variables of each instance, without the constants
+        :param heights: the number of equation steps of each instance, 0 if unknown
+        :param max_tokens: the maximum padded tokens in a batch, 0 means no limit
+        :param max_combinations: the maximum padded (pair x height) in a batch, 0 means no limit
+        :param length_bucket_width: lengths within the same width are considered the same when sorting
+        """
+        super().__init__()
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.num_variables = np.asarray(num_variables, dtype=np.int64)
+        self.heights = np.asarray(heights, dtype=np.int64)
+        self.batch_size = batch_size
+        self.constant_num = constant_num
+        self.max_tokens = max_tokens
+        self.max_combinations = max_combinations
+        self.pool_multiplier = pool_multiplier
+        self.length_bucket_width = length_bucket_width
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch: int) -> None:
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._batches = None
+
+    def get_batches(self) -> List[np.ndarray]:
+        if self._batches is not None:
+            return self._batches
+        rng = np.random.default_rng(self.seed + self.epoch)
+        num_instances = len(self.lengths)
+        order = rng.permutation(num_instances) if self.shuffle else np.arange(num_instances)
+        pool_size = self.batch_size * self.pool_multiplier
+        batches = []
+        for pool_start in range(0, num_instances, pool_size):
+            pool = order[pool_start:pool_start + pool_size]
+            ## np.lexsort uses the last key as the primary key
+            pool = pool[np.lexsort((self.lengths[pool], self.heights[pool], self.num_variables[pool],
+                                    self.lengths[pool] // self.length_bucket_width))]
+            batches.extend(self.split_pool(pool))
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        self._batches = batches
+        return batches
+
+    def split_pool(self, pool: np.ndarray) -> List[np.ndarray]:
+        if self.max_tokens <= 0 and self.max_combinations <= 0:
+            return [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+        batches = []
+        start = 0
+        max_length = max_combination = 0
+        for end, idx in enumerate(pool.tolist()):
+            length = int(self.lengths[idx])
+            combination = int(get_num_combinations(self.num_variables[idx] + self.constant_num)) * max(int(self.heights[idx]), 1)
+            new_max_length = max(max_length, length)
+            new_max_combination = max(max_combination, combination)
+            new_size = end - start + 1
+            exceeded = new_size > self.batch_size or \
+                       (self.max_tokens > 0 and new_size * new_max_length > self.max_tokens) or \
+                       (self.max_combinations > 0 and new_size * new_max_combination > self.max_combinations)
+            if exceeded and end > start:
+                batches.append(pool[start:end])
+                start = end
+                max_length, max_combination = length, combination
+            else:
+                max_length, max_combination = new_max_length, new_max_combination
+        batches.append(pool[start:])
+        return batches
+
+    def get_padding_report(self, batches: List[np.ndarray] = None) -> Dict[str, float]:
+        """
+        The ratio of padded positions over all the positions of the batches, for the tokens, the variables (pairs)
+        and the heights.
+        """
+        batches = self.get_batches() if batches is None else batches
+        report = {"batches": len(batches), "tokens": 0, "padded_tokens": 0, "combinations": 0,
+                  "padded_combinations": 0, "heights": 0, "padded_heights": 0}
+        for batch in batches:
+            lengths, heights = self.lengths[batch], self.heights[batch]
+            combinations = get_num_combinations(self.num_variables[batch] + self.constant_num)
+            report["tokens"] += int(lengths.sum())
+            report["padded_tokens"] += int(lengths.max()) * len(batch)
+            report["combinations"] += int(combinations.sum())
+            report["padded_combinations"] += int(combinations.max()) * len(batch)
+            report["heights"] += int(heights.sum())
+            report["padded_heights"] += int(heights.max()) * len(batch)
+        for key in ["tokens", "combinations", "heights"]:
+            report[f"{key}_waste"] = 1 - report[key] / report[f"padded_{key}"] if report[f"padded_{key}"] > 0 else 0.0
+        return report
+
+    def __iter__(self) -> Iterator[List[int]]:
+        batches = self.get_batches()
+        for batch in batches:
+            yield batch.tolist()
+        ## a new order for the next epoch even if `set_epoch` is not called
+        self.set_epoch(self.epoch + 1)
+
+    def __len__(self) -> int:
+        if self.max_tokens <= 0 and self.max_combinations <= 0:
+            return math.ceil(len(self.lengths) / self.batch_size)
+        return len(self.get_batches())
+
+
+def get_random_padding_report(sampler: BucketBatchSampler) -> Dict[str, float]:
+    """
+    Padding waste of the plain shuffled batches with the same batch size, for comparison.
+    """
+    order = np.random.default_rng(sampler.seed + sampler.epoch).permutation(len(sampler.lengths))
+    batches = [order[i:i + sampler.batch_size] for i in range(0, len(order), sampler.batch_size)]
+    return sampler.get_padding_report(batches)
@@ -1,39 +1,179 @@
 import traceback
 
 import torch
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from typing import List, Union
-from transformers import PreTrainedTokenizerFast, BertTokenizerFast, BertTokenizer, RobertaTokenizer, RobertaTokenizerFast
+from transformers import PreTrainedTokenizerFast, AddedToken, BertTokenizerFast, BertTokenizer, RobertaTokenizer, RobertaTokenizerFast
 from tqdm import tqdm
 from torch.utils.data._utils.collate import default_collate
 import numpy as np
-from src.utils import read_data, write_data
+from src.utils import read_data, iter_data, write_data
 import collections
+import collections.abc
 import re
 from src.eval.utils import compute_value_for_incremental_equations
 import math
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 from collections import Counter
 import logging
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import itertools
+import time
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-## "<quant>" token will be split into different subwords in different tokenizers
-class_name_2_quant_list = {
-    "bert-base-cased": ['<', 'q', '##uant', '>'],
-    "roberta-base": ['Ġ<', 'quant', '>'],
-    "coref-roberta-base": ['Ġ<', 'quant', '>'],
-    "roberta-large": ['Ġ<', 'quant', '>'],
-    "bert-base-multilingual-cased": ['<', 'quant', '>'],
-    "xlm-roberta-base": ['▁<', 'quant', '>'],
-    'bert-base-chinese': ['<', 'q', '##uan', '##t', '>'],
-    'hfl/chinese-bert-wwm-ext': ['<', 'q', '##uan', '##t', '>'],
-    'hfl/chinese-roberta-wwm-ext': ['<', 'q', '##uan', '##t', '>'],
-}
-
-UniFeature = collections.namedtuple('UniFeature', 'input_ids attention_mask token_type_ids variable_indexs_start variable_indexs_end num_variables variable_index_mask')
-UniFeature.__new__.__defaults__ = (None,) * 7
+## the quantities are written as temp_a ... temp_z in the text, each of them is replaced by "<quant>"
+QUANT_PATTERN = re.compile(r"temp_[a-z]")
+
+UniFeature = collections.namedtuple('UniFeature', 'input_ids attention_mask token_type_ids variable_indexs_start variable_indexs_end num_variables variable_index_mask var_hidden_states')
+UniFeature.__new__.__defaults__ = (None,) * 8
+
+## bump it whenever the tokenization below changes, so that stale caches are rebuilt
+FEATURE_CACHE_VERSION = 3
+## flat arrays of the feature cache, the ``*_offsets`` arrays have one more element than the instances
+FEATURE_CACHE_ARRAYS = ['input_ids', 'input_offsets', 'var_starts', 'var_ends', 'var_offsets', 'heights', 'raw_indices', 'insts', 'inst_offsets']
+
+
+class InstanceStore(collections.abc.Sequence):
+    """
+    The raw json instances, kept as one utf-8 byte array with offsets and only decoded when accessed.
+    Unlike a list of dicts, the store has no per-instance Python objects, so the forked DataLoader workers share its
+    pages instead of copying them when touching the reference counts; with the feature cache it is memory-mapped and
+    never read by the workers at all.
+    A decoded instance is a new dict, changes on it are not kept in the store.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray) -> None:
+        """
+        :param blob: uint8 array of the json encoded instances
+        :param offsets: the start of each instance in `blob`, with one more element for the end
+        """
+        self.blob = blob
+        self.offsets = offsets
+
+    @classmethod
+    def from_instances(cls, insts: List[Dict]) -> "InstanceStore":
+        encoded = [json.dumps(inst, ensure_ascii=False).encode("utf-8") for inst in insts]
+        offsets = np.concatenate([[0], np.cumsum([len(inst) for inst in encoded], dtype=np.int64)])
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"instance index out of range: {idx}")
+        start, end = self.offsets[idx:idx + 2].tolist()
+        return json.loads(self.blob[start:end].tobytes().decode("utf-8"))
+
+
+def add_quant_special_token(tokenizer: PreTrainedTokenizerFast) -> List[int]:
+    """
+    Add "<quant>" as a single special token, the spaces before it are stripped so that it is always the same token.
+    :return: the subword ids of "<quant>" before it is added, to initialize its embedding
+    """
+    subword_ids = UniversalDataset.get_quant_ids(tokenizer).tolist()
+    tokenizer.add_special_tokens({"additional_special_tokens": [AddedToken("<quant>", lstrip=True)]},
+                                 replace_additional_special_tokens=False)
+    return subword_ids
+
+
+def get_file_digest(file: str) -> str:
+    digest = hashlib.sha1()
+    with open(file, "rb") as read_file:
+        for chunk in iter(lambda: read_file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_tokenizer_digest(tokenizer: PreTrainedTokenizerFast) -> str:
+    """
+    Hash of the tokenizer class, name and the full vocabulary/normalization pipeline.
+    """
+    digest = hashlib.sha1()
+    digest.update(f"{tokenizer.__class__.__name__}|{tokenizer.name_or_path}".encode("utf-8"))
+    if getattr(tokenizer, "is_fast", False):
+        digest.update(tokenizer.backend_tokenizer.to_str().encode("utf-8"))
+    else:
+        digest.update(json.dumps(tokenizer.get_vocab(), sort_keys=True, ensure_ascii=False).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_input_text(ori_text: str) -> str:
+    ## replace the variable with <quant>
+    mapped_text = QUANT_PATTERN.sub(" <quant> ", ori_text)
+    ## obtain the text string
+    input_text = ""
+    for word in mapped_text.split():
+        if word == "<quant>":
+            input_text += " <quant> "
+        elif word == "," or word == "，":
+            input_text += word + " "
+        else:
+            input_text += word
+    return " " + input_text
+
+
+def tokenize_instances(tokenizer: PreTrainedTokenizerFast, quant_ids: np.ndarray, insts: List[Dict],
+                       chunk_size: int = 1024) -> Dict[str, np.ndarray]:
+    """
+    Tokenize the instances in chunks with one (batched) tokenizer call each, and locate the "<quant>" token ids
+    over the flattened ids of all the instances.
+    :return: the flat int32 token ids and variable start/end positions, with the int64 offsets of each instance
+    """
+    input_ids = []
+    for chunk_start in tqdm(range(0, len(insts), chunk_size), desc='Tokenization', disable=len(insts) <= chunk_size):
+        texts = [get_input_text(obj["ori_text"]) for obj in insts[chunk_start:chunk_start + chunk_size]]
+        input_ids.extend(tokenizer(texts, add_special_tokens=True, return_attention_mask=False, return_token_type_ids=False)["input_ids"])
+    input_lengths = np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=len(input_ids))
+    assert (input_lengths < 512).all() ## make sure no error in tokenization
+    input_offsets = np.concatenate([[0], np.cumsum(input_lengths)])
+    flat_input_ids = np.fromiter(itertools.chain.from_iterable(input_ids), dtype=np.int32, count=int(input_offsets[-1]))
+
+    # obtain the start and end position of "<quant>" token, a match cannot cross instances as it would contain the special tokens
+    quant_num = len(quant_ids)
+    if len(flat_input_ids) >= quant_num:
+        windows = np.lib.stride_tricks.sliding_window_view(flat_input_ids, quant_num)
+        flat_var_starts = np.flatnonzero((windows == quant_ids).all(axis=1))
+    else:
+        flat_var_starts = np.zeros(0, dtype=np.int64)
+    var_inst_idxs = np.searchsorted(input_offsets, flat_var_starts, side="right") - 1
+    num_variables = np.bincount(var_inst_idxs, minlength=len(insts))
+    assert (num_variables == np.asarray([len(obj["num_list"]) for obj in insts], dtype=np.int64)).all()
+    var_starts = (flat_var_starts - input_offsets[var_inst_idxs]).astype(np.int32)
+    return {
+        "input_ids": flat_input_ids,
+        "input_offsets": input_offsets,
+        "var_starts": var_starts,
+        "var_ends": var_starts + (quant_num - 1),
+        "var_offsets": np.concatenate([[0], np.cumsum(num_variables)]),
+    }
+
+
+def get_feature(arrays: Dict[str, np.ndarray], idx: int) -> UniFeature:
+    """
+    The token ids and variable positions are views on the flat arrays, the attention mask, token type ids and
+    variable mask are constant and left as None, they are built by `collate_function`.
+    The variable hidden states are only there after `UniversalDataset.set_hidden_states`.
+    """
+    input_start, input_end = arrays["input_offsets"][idx:idx + 2].tolist()
+    var_start, var_end = arrays["var_offsets"][idx:idx + 2].tolist()
+    var_hidden_states = arrays["var_hidden_states"][var_start:var_end] if "var_hidden_states" in arrays else None
+    return UniFeature(input_ids=arrays["input_ids"][input_start:input_end],
+                      variable_indexs_start=arrays["var_starts"][var_start:var_end],
+                      variable_indexs_end=arrays["var_ends"][var_start:var_end],
+                      num_variables=var_end - var_start,
+                      var_hidden_states=var_hidden_states)
+
 
 class UniversalDataset(Dataset):
 
@@ -45,105 +185,175 @@ class UniversalDataset(Dataset):
                  filtered_steps: List = None,
                  constant2id: Dict[str, int] = None,
                  constant_values: List[float] = None,
-                 data_max_height: int = 100) -> None:
+                 data_max_height: int = 100,
+                 feature_cache_dir: str = None) -> None:
+        """
+        :param feature_cache_dir: folder of the pre-tokenized feature cache, None/""/"none" means no cache.
+            The cache is keyed on the file content, the tokenizer and the constants, and rebuilt when any of them changes.
+        """
         self.tokenizer = tokenizer
         self.constant2id = constant2id
         self.constant_values = constant_values
         self.constant_num = len(self.constant2id) if self.constant2id else 0
         self.data_max_height = data_max_height
         self.uni_labels = uni_labels
-        self.quant_list = class_name_2_quant_list[pretrained_model_name]
+        self.pin_memory = False ## allocate the collated batches in pinned memory
+        self.quant_ids = self.get_quant_ids(tokenizer)
         filtered_steps = [int(v) for v in filtered_steps] if filtered_steps is not None else None
-        self.read_math23k_file(file, tokenizer, number, filtered_steps)
+        if feature_cache_dir is None or feature_cache_dir == "" or feature_cache_dir == "none":
+            self.read_math23k_file(file, tokenizer, number, filtered_steps)
+        else:
+            self.read_math23k_file_with_cache(file, tokenizer, feature_cache_dir, number, filtered_steps)
+
+    @staticmethod
+    def get_quant_ids(tokenizer: PreTrainedTokenizerFast) -> np.ndarray:
+        """
+        "<quant>" token will be split into different subwords in different tokenizers (e.g., ['<', 'q', '##uan', '##t', '>']
+        or ['Ġ<', 'quant', '>']), the leading space is kept as it is always preceded by a space in the input text.
+        """
+        return np.asarray(tokenizer(" <quant>", add_special_tokens=False)["input_ids"], dtype=np.int32)
+
+    def get_feature_cache_key(self, file: str, tokenizer: PreTrainedTokenizerFast) -> str:
+        key = {
+            "version": FEATURE_CACHE_VERSION,
+            "file": get_file_digest(file),
+            "tokenizer": get_tokenizer_digest(tokenizer),
+            "quant_ids": self.quant_ids.tolist(),
+            "constant2id": self.constant2id,
+            "constant_values": self.constant_values,
+        }
+        return hashlib.sha1(json.dumps(key, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def read_math23k_file_with_cache(self, file: str,
+                                     tokenizer: PreTrainedTokenizerFast,
+                                     feature_cache_dir: str,
+                                     number: int = -1,
+                                     filtered_steps: List = None) -> None:
+        """
+        Same as `read_math23k_file`, but the features of the whole file are tokenized once and saved as flat int32 arrays,
+        later runs only memory-map them. `number` is applied on the cached features.
+        """
+        cache_key = self.get_feature_cache_key(file, tokenizer)
+        cache_folder = os.path.join(feature_cache_dir, f"{os.path.splitext(os.path.basename(file))[0]}.{cache_key[:16]}")
+        if not os.path.exists(os.path.join(cache_folder, "meta.json")):
+            logger.info(f"[Data Info] building feature cache: {cache_folder}")
+            self.read_math23k_file(file, tokenizer, number=-1, filtered_steps=filtered_steps)
+            try:
+                self.save_feature_cache(cache_folder, cache_key)
+            except OSError as error:
+                logger.warning(f"[Data Info] cannot write the feature cache ({error}), the features are kept in memory")
+        else:
+            logger.info(f"[Data Info] loading feature cache: {cache_folder}")
+        if os.path.exists(os.path.join(cache_folder, "meta.json")):
+            with open(os.path.join(cache_folder, "meta.json"), "r", encoding="utf-8") as read_file:
+                meta = json.load(read_file)
+            arrays = {name: np.load(os.path.join(cache_folder, f"{name}.npy"), mmap_mode="r") for name in FEATURE_CACHE_ARRAYS}
+            num_raw_instances = meta["num_raw_instances"]
+        else:
+            arrays = {name: self._arrays[name] for name in FEATURE_CACHE_ARRAYS}
+            num_raw_instances = self.num_raw_instances
+        if number > 0 and number < num_raw_instances:
+            num_raw_instances = number
+            num_instances = int(np.searchsorted(arrays["raw_indices"], number))
+            for name in ["input_offsets", "var_offsets", "inst_offsets"]:
+                arrays[name] = arrays[name][:num_instances + 1]
+            for name in ["heights", "raw_indices"]:
+                arrays[name] = arrays[name][:num_instances]
+        self._arrays = arrays
+        self.insts = InstanceStore(arrays["insts"], arrays["inst_offsets"])
+        self.number_instances_remove = num_raw_instances - len(self.insts)
+        logger.info(f", total number instances: {len(self.insts)} (before filter: {num_raw_instances})")
+        logger.info(f"number of instances removed: {self.number_instances_remove}")
+
+    def save_feature_cache(self, cache_folder: str, cache_key: str) -> None:
+        """
+        Write the arrays into a temporary folder and rename it, so that concurrent runs never see a partial cache.
+        """
+        os.makedirs(os.path.dirname(os.path.abspath(cache_folder)), exist_ok=True)
+        tmp_folder = tempfile.mkdtemp(prefix=".tmp.", dir=os.path.dirname(os.path.abspath(cache_folder)))
+        try:
+            for name in FEATURE_CACHE_ARRAYS:
+                np.save(os.path.join(tmp_folder, f"{name}.npy"), self._arrays[name])
+            write_data(file=os.path.join(tmp_folder, "meta.json"), data={
+                "key": cache_key,
+                "version": FEATURE_CACHE_VERSION,
+                "num_raw_instances": self.num_raw_instances,
+                "num_instances": len(self),
+            })
+        except OSError:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            raise
+        try:
+            os.rename(tmp_folder, cache_folder)
+        except OSError:
+            ## another process has written the same cache
+            shutil.rmtree(tmp_folder, ignore_errors=True)
 
 
     def read_math23k_file(self, file: Union[str, None],
                  tokenizer: PreTrainedTokenizerFast,
                  number: int = -1,
-                 filtered_steps: List = None) -> None:
-        data = read_data(file=file)
-        if number > 0:
-            data = data[:number]
-        # ## tokenization
-        self._features = []
-        max_num_steps = 0
-        self.insts = []
-        num_step_count = Counter()
-        equation_layer_num = 0
-        equation_layer_num_count = Counter()
-        var_num_all =0
-        var_num_count = Counter()
-        sent_len_all = 0
+                 filtered_steps: List = None,
+                 chunk_size: int = 1024) -> None:
+        ## the file is parsed incrementally, so only the first `number` instances are read
+        data = list(itertools.islice(iter_data(file=file), number)) if number > 0 else read_data(file=file)
         filter_type_count = Counter()
-        found_duplication_inst_num = 0
-        filter_step_count = 0
-        for obj in tqdm(data, desc='Tokenization', total=len(data)):
-            mapped_text = obj["ori_text"]
-            sent_len = len(mapped_text.split())
-            ## replace the variable with <quant>
-            for k in range(ord('a'), ord('a') + 26):
-                mapped_text = mapped_text.replace(f"temp_{chr(k)}", " <quant> ")
-            ## obtain the text string
-            
-            mapped_text = mapped_text.split()
-            input_text = ""
-            for idx, word in enumerate(mapped_text):
-                if word.strip() == "<quant>":
-                    input_text += " <quant> "
-                elif word == "," or word == "，":
-                    input_text += word + " "
-                else:
-                    input_text += word
-
-            res = tokenizer.encode_plus(" " + input_text, add_special_tokens=True, return_attention_mask=True)
-            input_ids = res["input_ids"]
-            attention_mask = res["attention_mask"]
-            tokens = tokenizer.convert_ids_to_tokens(input_ids)
-            var_starts = []
-            var_ends = []
-            quant_num = len(self.quant_list)
-            # quants = ['<', 'q', '##uan', '##t', '>'] if not is_roberta_tokenizer else ['Ġ<', 'quant', '>']
-            # obtain the start and end position of "<quant>" token
-            for k, token in enumerate(tokens):
-                if (token == self.quant_list[0]) and tokens[k:k + quant_num] == self.quant_list:
-                    var_starts.append(k)
-                    var_ends.append(k + quant_num - 1)
-
-            assert len(input_ids) < 512 ## make sure no error in tokenization
-            num_variable = len(var_starts)
-            assert len(var_starts) == len(obj["num_list"])
+        raw_indices = []
+        for raw_idx, obj in enumerate(data):
             if len(obj["num_list"]) == 0:
                 filter_type_count["no detected variable"] += 1
                 obj['type_str'] = "no detected variable"
                 continue
-            var_mask = [1] * num_variable
-           
-       
-            var_num_all += len(obj["num_list"])
-            var_num_count[len(obj["num_list"])] += 1
-            self._features.append(
-                UniFeature(input_ids=input_ids,
-                           attention_mask=attention_mask,
-                           token_type_ids = [0] * len(input_ids),
-                           variable_indexs_start=var_starts,
-                           variable_indexs_end=var_ends,
-                           num_variables=num_variable,
-                           variable_index_mask=var_mask)
-            )
-            self.insts.append(obj)
-        logger.info(f", total number instances: {len(self._features)} (before filter: {len(data)}), max num steps: {max_num_steps}")
+            raw_indices.append(raw_idx)
+        insts = [data[raw_idx] for raw_idx in raw_indices]
+        start_time = time.time()
+        arrays = tokenize_instances(tokenizer, self.quant_ids, insts, chunk_size=chunk_size)
+        elapsed = time.time() - start_time
+        logger.info(f"tokenized {len(arrays['input_ids'])} tokens in {elapsed:.2f}s ({len(arrays['input_ids']) / max(elapsed, 1e-6):.0f} tokens/s)")
+        self.insts = InstanceStore.from_instances(insts)
+        arrays["heights"] = np.asarray([len(obj.get("equation_layer", [])) for obj in insts], dtype=np.int32)
+        arrays["raw_indices"] = np.asarray(raw_indices, dtype=np.int32)
+        arrays["insts"] = self.insts.blob
+        arrays["inst_offsets"] = self.insts.offsets
+        self._arrays = arrays
+        self.num_raw_instances = len(data)
+        logger.info(f", total number instances: {len(self.insts)} (before filter: {len(data)}), variable number counter: {Counter(np.diff(arrays['var_offsets']).tolist())}")
         self.number_instances_remove = sum(filter_type_count.values())
         logger.info(f"filtered type counter: {filter_type_count}")
         logger.info(f"number of instances removed: {self.number_instances_remove}")
-        assert self.number_instances_remove == len(data) - len(self._features)
-        if found_duplication_inst_num:
-            logger.warning(f"[WARNING] find duplication num: {found_duplication_inst_num} (not removed)")
+        assert self.number_instances_remove == len(data) - len(self.insts)
+
+    def get_sizes(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        :return: the wordpiece lengths, the number of variables (constants excluded) and the equation heights
+            (0 if the instance has no "equation_layer") of the instances
+        """
+        lengths = np.diff(self._arrays["input_offsets"])
+        num_variables = np.diff(self._arrays["var_offsets"])
+        return lengths, num_variables, np.asarray(self._arrays["heights"])
+
+    def get_feature_digest(self) -> str:
+        """
+        Hash of the token ids and variable positions of the instances, i.e. of everything the encoder sees.
+        """
+        digest = hashlib.sha1()
+        for name in ["input_ids", "input_offsets", "var_starts", "var_ends", "var_offsets"]:
+            digest.update(np.ascontiguousarray(self._arrays[name]).tobytes())
+        return digest.hexdigest()
+
+    def set_hidden_states(self, var_hidden_states: np.ndarray) -> None:
+        """
+        :param var_hidden_states: (total number of variables, hidden_size) the encoder representation of the
+            variables of all the instances in order, returned with the features and collated into `var_hidden_states`
+        """
+        assert len(var_hidden_states) == self._arrays["var_offsets"][-1]
+        self._arrays["var_hidden_states"] = var_hidden_states
 
     def __len__(self) -> int:
-        return len(self._features)
+        return len(self._arrays["raw_indices"])
 
     def __getitem__(self, idx) -> UniFeature:
-        return self._features[idx]
+        return get_feature(self._arrays, idx)
 
     def get_label_ids_incremental(self, equation_layers: List, add_replacement: bool) -> Union[List[List[int]], None]:
         # in this data, only have one or zero bracket
@@ -236,34 +446,57 @@ class UniversalDataset(Dataset):
                         label_ids.append([right_var_idx, left_var_idx, op_idx, is_stop])
         return label_ids
 
-    def collate_function(self, batch: List[UniFeature]):
-
-        max_wordpiece_length = max([len(feature.input_ids)  for feature in batch])
-        max_num_variable = max([feature.num_variables  for feature in batch])
+    def collate_function(self, batch: List[UniFeature]) -> UniFeature:
+        """
+        Pad the batch into one preallocated buffer per field, filled with slice copies of the instance arrays.
+        The buffers are allocated in pinned memory if `self.pin_memory` is set and we are in the main process
+        (the DataLoader pins the batches of the workers itself).
+        """
+        batch_size = len(batch)
+        lengths = np.fromiter((len(feature.input_ids) for feature in batch), dtype=np.int64, count=batch_size)
+        num_variables = np.fromiter((feature.num_variables for feature in batch), dtype=np.int64, count=batch_size)
+        max_wordpiece_length = int(lengths.max())
+        max_num_variable = int(num_variables.max())
+        pin_memory = self.pin_memory and torch.utils.data.get_worker_info() is None
 
-        padding_value = [0,0,0,0]
+        input_ids = torch.empty((batch_size, max_wordpiece_length), dtype=torch.long, pin_memory=pin_memory)
+        var_starts = torch.empty((batch_size, max_num_variable), dtype=torch.long, pin_memory=pin_memory)
+        var_ends = torch.empty((batch_size, max_num_variable), dtype=torch.long, pin_memory=pin_memory)
+        ## numpy views share the memory of the tensors
+        input_ids_buffer = input_ids.numpy()
+        var_starts_buffer = var_starts.numpy()
+        var_ends_buffer = var_ends.numpy()
+        input_ids_buffer.fill(self.tokenizer.pad_token_id)
+        var_starts_buffer.fill(0)
+        var_ends_buffer.fill(0)
         for i, feature in enumerate(batch):
-            padding_length = max_wordpiece_length - len(feature.input_ids)
-            input_ids = feature.input_ids + [self.tokenizer.pad_token_id] * padding_length
-            attn_mask = feature.attention_mask + [0]* padding_length
-            token_type_ids = feature.token_type_ids + [0]* padding_length
-            padded_variable_idx_len = max_num_variable - feature.num_variables
-            var_starts = feature.variable_indexs_start + [0] * padded_variable_idx_len
-            var_ends = feature.variable_indexs_end + [0] * padded_variable_idx_len
-            variable_index_mask = feature.variable_index_mask + [0] * padded_variable_idx_len
+            input_ids_buffer[i, :lengths[i]] = feature.input_ids
+            var_starts_buffer[i, :num_variables[i]] = feature.variable_indexs_start
+            var_ends_buffer[i, :num_variables[i]] = feature.variable_indexs_end
 
-
-
-
-            batch[i] = UniFeature(input_ids=np.asarray(input_ids),
-                                attention_mask=np.asarray(attn_mask),
-                                  token_type_ids=np.asarray(token_type_ids),
-                                 variable_indexs_start=np.asarray(var_starts),
-                                 variable_indexs_end=np.asarray(var_ends),
-                                 num_variables=np.asarray(feature.num_variables),
-                                 variable_index_mask=np.asarray(variable_index_mask))
-        results = UniFeature(*(default_collate(samples) for samples in zip(*batch)))
-        return results
+        attention_mask = torch.from_numpy(np.arange(max_wordpiece_length) < lengths[:, None]).long()
+        variable_index_mask = torch.from_numpy(np.arange(max_num_variable) < num_variables[:, None]).long()
+        token_type_ids = torch.zeros((batch_size, max_wordpiece_length), dtype=torch.long)
+        var_hidden_states = None
+        if batch[0].var_hidden_states is not None:
+            ## stored in fp16, padded with zeros
+            var_hidden_states = torch.zeros((batch_size, max_num_variable, batch[0].var_hidden_states.shape[-1]), dtype=torch.float,
+                                            pin_memory=pin_memory)
+            var_hidden_states_buffer = var_hidden_states.numpy()
+            for i, feature in enumerate(batch):
+                var_hidden_states_buffer[i, :num_variables[i]] = feature.var_hidden_states
+        num_variables = torch.from_numpy(num_variables)
+        if pin_memory:
+            attention_mask, variable_index_mask = attention_mask.pin_memory(), variable_index_mask.pin_memory()
+            token_type_ids, num_variables = token_type_ids.pin_memory(), num_variables.pin_memory()
+        return UniFeature(input_ids=input_ids,
+                          attention_mask=attention_mask,
+                          token_type_ids=token_type_ids,
+                          variable_indexs_start=var_starts,
+                          variable_indexs_end=var_ends,
+                          num_variables=num_variables,
+                          variable_index_mask=variable_index_mask,
+                          var_hidden_states=var_hidden_states)
 
 
 def main_for_mawps():
@@ -357,6 +590,173 @@ def main_for_mathqa():
                      constant2id=constant2id, constant_values=constant_values,
                      pretrained_model_name=pretrained_language_moel)
 
+class StreamingInstances:
+    """
+    Re-iterable view on the kept instances of a `StreamingUniversalDataset`, in file order, read again at each iteration.
+    """
+
+    def __init__(self, dataset: "StreamingUniversalDataset") -> None:
+        self.dataset = dataset
+
+    def __iter__(self):
+        for _, obj in self.dataset.iter_instances():
+            yield obj
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+
+class StreamingUniversalDataset(IterableDataset):
+    """
+    Streaming version of `UniversalDataset` for large corpora: the json array/jsonl file is parsed incrementally and
+    the instances are tokenized on the fly, `number` stops the reading early.
+
+    With DataLoader workers, the kept instances are split into shards of `shard_size` consecutive instances, assigned to
+    the workers in turn. As the DataLoader also takes the batches from the workers in turn, the batches come in the file
+    order when `shard_size` equals the batch size, so `insts` stays aligned with the predictions in `evaluate`.
+    """
+
+    def __init__(self, file: str,
+                 tokenizer: PreTrainedTokenizerFast,
+                 uni_labels: List[str],
+                 pretrained_model_name: str,
+                 number: int = -1,
+                 constant2id: Dict[str, int] = None,
+                 constant_values: List[float] = None,
+                 shard_size: int = 30,
+                 chunk_size: int = 1024,
+                 counts_cache_dir: str = None) -> None:
+        """
+        :param shard_size: the number of consecutive instances read by one worker, should be the batch size
+        :param chunk_size: the number of instances tokenized in one call
+        :param counts_cache_dir: folder where the instance counts of the file are kept, so that `len()` only reads the
+            file once across runs, None/""/"none" means no cache
+        """
+        self.file = file
+        self.tokenizer = tokenizer
+        self.uni_labels = uni_labels
+        self.number = number
+        self.constant2id = constant2id
+        self.constant_values = constant_values
+        self.constant_num = len(self.constant2id) if self.constant2id else 0
+        self.shard_size = shard_size
+        self.chunk_size = max(chunk_size // shard_size, 1) * shard_size
+        self.pin_memory = False
+        self.quant_ids = UniversalDataset.get_quant_ids(tokenizer)
+        self.counts_cache_dir = counts_cache_dir
+        self._counts = None
+
+    def iter_instances(self):
+        """
+        Yield (raw index, instance) of the instances with variables, among the first `number` instances of the file.
+        """
+        raw_data = iter_data(file=self.file)
+        if self.number > 0:
+            raw_data = itertools.islice(raw_data, self.number)
+        for raw_idx, obj in enumerate(raw_data):
+            if len(obj["num_list"]) > 0:
+                yield raw_idx, obj
+
+    def get_counts(self) -> Tuple[int, int]:
+        """
+        Only computed when asked (by `len()` or `number_instances_remove`): one pass on the file without tokenization,
+        unless the counts of the same file (size and modification time) and `number` are in `counts_cache_dir`.
+        :return: the number of kept instances and of removed instances ("no detected variable")
+        """
+        if self._counts is not None:
+            return self._counts
+        counts_file = None
+        stat = os.stat(self.file)
+        key = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "number": self.number}
+        if self.counts_cache_dir is not None and self.counts_cache_dir != "" and self.counts_cache_dir != "none":
+            file_key = hashlib.sha1(f"{os.path.abspath(self.file)}|{self.number}".encode("utf-8")).hexdigest()[:16]
+            counts_file = os.path.join(self.counts_cache_dir, f"{os.path.basename(self.file)}.{file_key}.counts.json")
+            if os.path.exists(counts_file):
+                with open(counts_file, "r", encoding="utf-8") as read_file:
+                    meta = json.load(read_file)
+                if meta["key"] == key:
+                    self._counts = (meta["num_instances"], meta["number_instances_remove"])
+                    return self._counts
+        logger.info(f"[Data Info] counting the instances of {self.file}")
+        num_raw_instances = num_instances = 0
+        raw_data = iter_data(file=self.file)
+        if self.number > 0:
+            raw_data = itertools.islice(raw_data, self.number)
+        for obj in raw_data:
+            num_raw_instances += 1
+            num_instances += 1 if len(obj["num_list"]) > 0 else 0
+        self._counts = (num_instances, num_raw_instances - num_instances)
+        if counts_file is not None:
+            ## written then renamed, concurrent runs never read a partial file
+            tmp_file = f"{counts_file}.{os.getpid()}.tmp"
+            try:
+                os.makedirs(self.counts_cache_dir, exist_ok=True)
+                write_data(file=tmp_file, data={"key": key, "num_instances": num_instances, "number_instances_remove": self._counts[1]})
+                os.replace(tmp_file, counts_file)
+            except OSError as error:
+                logger.warning(f"[Data Info] cannot write the instance counts ({error}), they are counted again at the next run")
+        return self._counts
+
+    @property
+    def insts(self) -> StreamingInstances:
+        return StreamingInstances(self)
+
+    @property
+    def number_instances_remove(self) -> int:
+        return self.get_counts()[1]
+
+    def __len__(self) -> int:
+        return self.get_counts()[0]
+
+    def __iter__(self) -> Iterator[UniFeature]:
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info is not None else (0, 1)
+        chunk = []
+        for inst_idx, (_, obj) in enumerate(self.iter_instances()):
+            if (inst_idx // self.shard_size) % num_workers != worker_id:
+                continue
+            chunk.append(obj)
+            if len(chunk) == self.chunk_size:
+                yield from self.tokenize_chunk(chunk)
+                chunk = []
+        if len(chunk) > 0:
+            yield from self.tokenize_chunk(chunk)
+
+    def tokenize_chunk(self, chunk: List[Dict]) -> Iterator[UniFeature]:
+        arrays = tokenize_instances(self.tokenizer, self.quant_ids, chunk, chunk_size=self.chunk_size)
+        for idx in range(len(chunk)):
+            yield get_feature(arrays, idx)
+
+    collate_function = UniversalDataset.collate_function
+
+
+def benchmark_collate(dataset: UniversalDataset, batch_sizes: List[int] = (30, 64, 128, 256, 512), num_batches: int = 20,
+                      min_seconds: float = 1.0, seed: int = 0) -> Dict[int, float]:
+    """
+    Batches per second of `__getitem__` + `collate_function` on random batches of each size.
+    """
+    rng = np.random.default_rng(seed)
+    results = {}
+    for batch_size in batch_sizes:
+        batch_idxs = [rng.choice(len(dataset), min(batch_size, len(dataset)), replace=False).tolist() for _ in range(num_batches)]
+        num_collated = 0
+        start_time = time.perf_counter()
+        while time.perf_counter() - start_time < min_seconds:
+            for idxs in batch_idxs:
+                dataset.collate_function([dataset[idx] for idx in idxs])
+            num_collated += num_batches
+        results[batch_size] = num_collated / (time.perf_counter() - start_time)
+        logger.info(f"batch size: {batch_size}, {results[batch_size]:.1f} batches/sec")
+    return results
+
+def main_for_collate_benchmark():
+    pretrained_language_model = 'hfl/chinese-bert-wwm-ext'
+    tokenizer = BertTokenizerFast.from_pretrained(pretrained_language_model)
+    dataset = UniversalDataset(file="../../data/task_dataset/math23k_test.json", tokenizer=tokenizer, uni_labels=['+', '-', '-_rev', '*', '/', '/_rev'],
+                               constant2id={"1": 0, "PI": 1}, constant_values=[1.0, 3.14],
+                               pretrained_model_name=pretrained_language_model)
+    benchmark_collate(dataset)
+
 if __name__ == '__main__':
     logger.addHandler(logging.StreamHandler())
     from transformers import BertTokenizer, RobertaTokenizerFast, XLMRobertaTokenizerFast
@@ -373,6 +773,7 @@ if __name__ == '__main__':
     # main_for_svamp()
     # main_for_mawps()
     # main_for_mathqa()
+    # main_for_collate_benchmark()
     main_for_math23k()
 
 
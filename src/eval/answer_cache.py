@@ -0,0 +1,137 @@
+import collections
+import glob
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import numpy as np
+from typing import Dict, List, Optional, Tuple
+from transformers import PreTrainedTokenizerBase
+from src.config import Config
+from src.data.universal_dataset import get_input_text, get_tokenizer_digest, get_file_digest
+
+
+def get_model_id(model_dir: str, tokenizer: PreTrainedTokenizerBase, uni_labels: List[str], constant_values: List[float], **settings) -> str:
+    """
+    Hash of everything that decides the predicted equations besides the text: the checkpoint files, the tokenizer,
+    the labels and constants, and the decoding settings (`get_decoding_settings`).
+    """
+    digest = hashlib.sha1()
+    for file in sorted(glob.glob(os.path.join(model_dir, "*.bin")) + glob.glob(os.path.join(model_dir, "*.safetensors")) +
+                       glob.glob(os.path.join(model_dir, "config.json"))):
+        digest.update(f"{os.path.basename(file)}:{get_file_digest(file)}".encode("utf-8"))
+    digest.update(get_tokenizer_digest(tokenizer).encode("utf-8"))
+    digest.update(json.dumps([uni_labels, constant_values, sorted(settings.items())]).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def get_decoding_settings(conf: Config) -> Dict:
+    """
+    The flags that change the predicted equations of a checkpoint, for `get_model_id`. `early_exit` is left out, it
+    only drops the finished instances from the later heights and gives the same equations.
+    """
+    return {"height": conf.height, "quantize": conf.quantize, "var_update_mode": conf.var_update_mode,
+            "factorized_scoring": conf.factorized_scoring, "incremental_scoring": conf.incremental_scoring,
+            "quant_special_token": conf.quant_special_token, "fp16": bool(conf.fp16), "device": conf.device.type}
+
+
+def pad_steps(steps_list: List[np.ndarray]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param steps_list: the (num_steps, 4) predicted steps of each instance
+    :return: (batch_size, max_num_steps, 4) padded with -1, and the number of steps of each instance
+    """
+    lengths = np.array([len(steps) for steps in steps_list], dtype=np.int64)
+    padded_steps = np.full((len(steps_list), max(int(lengths.max(initial=0)), 1), 4), -1, dtype=np.int64)
+    for b_idx, steps in enumerate(steps_list):
+        padded_steps[b_idx, :len(steps)] = steps
+    return padded_steps, lengths
+
+
+class AnswerCache:
+    """
+    LRU cache of the predicted steps, keyed on the model id and the text with the quantities replaced by <quant>.
+    The model input does not depend on the values in `num_list`, so the cached equations are reused for any numbers and
+    only the (cheap) equation execution is run again.
+    With `disk_file` the entries are also written to a sqlite database, which is read on a memory miss and kept across
+    restarts. Entries older than `ttl` seconds are dropped from both tiers, 0 means no expiry.
+    """
+
+    def __init__(self, model_id: str, max_size: int = 100000, ttl: float = 0.0, disk_file: str = None) -> None:
+        self.model_id = model_id
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.disk = None
+        if disk_file:
+            os.makedirs(os.path.dirname(os.path.abspath(disk_file)), exist_ok=True)
+            self.disk = sqlite3.connect(disk_file, check_same_thread=False)
+            self.disk.execute("CREATE TABLE IF NOT EXISTS answers (key TEXT PRIMARY KEY, steps BLOB, created REAL)")
+            if self.ttl > 0:
+                self.disk.execute("DELETE FROM answers WHERE created < ?", (time.time() - self.ttl,))
+            self.disk.commit()
+
+    def get_keys(self, insts: List[Dict]) -> List[str]:
+        return [hashlib.sha1(f"{self.model_id}|{get_input_text(inst['ori_text'])}".encode("utf-8")).hexdigest() for inst in insts]
+
+    def get_many(self, keys: List[str]) -> List[Optional[np.ndarray]]:
+        """
+        :return: the (num_steps, 4) cached steps of each key, None for a miss
+        """
+        now = time.time()
+        results = []
+        with self.lock:
+            for key in keys:
+                steps = None
+                entry = self.entries.get(key)
+                if entry is not None:
+                    if self.ttl > 0 and now - entry[1] > self.ttl:
+                        del self.entries[key]
+                        self.expired += 1
+                    else:
+                        self.entries.move_to_end(key)
+                        self.hits += 1
+                        steps = entry[0]
+                if steps is None and self.disk is not None:
+                    row = self.disk.execute("SELECT steps, created FROM answers WHERE key = ?", (key,)).fetchone()
+                    if row is not None and (self.ttl <= 0 or now - row[1] <= self.ttl):
+                        steps = np.frombuffer(row[0], dtype=np.int16).reshape(-1, 4).astype(np.int64)
+                        self.set_entry(key, steps, row[1])
+                        self.disk_hits += 1
+                if steps is None:
+                    self.misses += 1
+                results.append(steps)
+        return results
+
+    def put_many(self, keys: List[str], steps_list: List[np.ndarray]) -> None:
+        now = time.time()
+        with self.lock:
+            for key, steps in zip(keys, steps_list):
+                self.set_entry(key, np.array(steps, dtype=np.int64), now)
+            if self.disk is not None:
+                self.disk.executemany("INSERT OR REPLACE INTO answers VALUES (?, ?, ?)",
+                                      [(key, np.asarray(steps, dtype=np.int16).tobytes(), now) for key, steps in zip(keys, steps_list)])
+                self.disk.commit()
+
+    def set_entry(self, key: str, steps: np.ndarray, created: float) -> None:
+        steps.flags.writeable = False
+        self.entries[key] = (steps, created)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.disk_hits + self.misses
+        return {"size": len(self.entries), "hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "expired": self.expired, "hit_rate": (self.hits + self.disk_hits) / lookups if lookups > 0 else 0.0}
+
+    def close(self) -> None:
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
@@ -1,5 +1,6 @@
 import math
-from typing import List
+import numpy as np
+from typing import List, Tuple
 
 
 def compute(left: float, right:float, op:str):
@@ -60,6 +61,82 @@ def compute_value_for_incremental_equations(equations, num_list, num_constant, u
         store_values.append(current_value)
     return current_value, grounded_equations
 
+def _divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    return numerator * 1.0 / np.where(denominator != 0, denominator, 0.001)
+
+def _power(base: np.ndarray, exponent: np.ndarray) -> np.ndarray:
+    ## element-wise math.pow, np.power can differ in the last digit, and failures are 0 as in `compute`
+    return np.asarray([compute(left, right, "^") for left, right in zip(base.tolist(), exponent.tolist())], dtype=np.float64)
+
+## vectorized version of `compute`, keyed on the labels in uni_labels
+batched_op_functions = {
+    "+": lambda left, right: left + right,
+    "-": lambda left, right: left - right,
+    "*": lambda left, right: left * right,
+    "/": lambda left, right: _divide(left, right),
+    "-_rev": lambda left, right: right - left,
+    "/_rev": lambda left, right: _divide(right, left),
+    "^": lambda left, right: _power(left, right),
+    "^_rev": lambda left, right: _power(right, left),
+}
+
+def get_num_matrix(num_lists: List[List[float]]) -> np.ndarray:
+    """
+    :return: (batch_size, max_num_variable) the quantities of every instance padded with 0
+    """
+    max_num_variable = max([len(num_list) for num_list in num_lists] + [0])
+    num_matrix = np.zeros((len(num_lists), max_num_variable), dtype=np.float64)
+    for b_idx, num_list in enumerate(num_lists):
+        num_matrix[b_idx, :len(num_list)] = num_list
+    return num_matrix
+
+def compute_values_for_batched_equations(padded_steps: np.ndarray, lengths: np.ndarray, num_matrix: np.ndarray, uni_labels: List[str],
+                                         constant_values: List[float] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Batched version of `compute_value_for_incremental_equations`.
+    The variables are read from a table of [intermediate values of the steps (reversed), constants, quantities],
+    the variable index v at step t is the column (height - t + v) and the value of step t is written to the column (height - 1 - t).
+    :param padded_steps: (batch_size, height, 4) (left_var_index, right_var_index, label_index, stop_label), padded with -1
+    :param lengths: (batch_size) the number of steps of each instance
+    :param num_matrix: (batch_size, max_num_variable), from `get_num_matrix`
+    :return: values: (batch_size) the value of the last step, 0 if no step
+             step_results: (batch_size, height, 3) (left_number, right_number, value) of each step
+    """
+    batch_size, height, _ = padded_steps.shape
+    constant_values = constant_values if constant_values is not None else []
+    constants = np.broadcast_to(np.asarray(constant_values, dtype=np.float64), (batch_size, len(constant_values)))
+    table = np.concatenate([np.zeros((batch_size, height)), constants, num_matrix.astype(np.float64)], axis=1)
+    step_results = np.zeros((batch_size, height, 3), dtype=np.float64)
+    b_idxs = np.arange(batch_size)
+    with np.errstate(all='ignore'):
+        for t in range(height):
+            valid = t < lengths
+            left_idxs = np.clip(height - t + padded_steps[:, t, 0], 0, table.shape[1] - 1)
+            right_idxs = np.clip(height - t + padded_steps[:, t, 1], 0, table.shape[1] - 1)
+            left_numbers = table[b_idxs, left_idxs]
+            right_numbers = table[b_idxs, right_idxs]
+            values = np.zeros(batch_size, dtype=np.float64)
+            for op_idx, op in enumerate(uni_labels):
+                op_mask = valid & (padded_steps[:, t, 2] == op_idx)
+                if op_mask.any():
+                    values[op_mask] = batched_op_functions[op](left_numbers[op_mask], right_numbers[op_mask])
+            table[:, height - 1 - t] = values
+            step_results[:, t, 0] = left_numbers
+            step_results[:, t, 1] = right_numbers
+            step_results[:, t, 2] = values
+    last_steps = np.clip(lengths - 1, 0, max(height - 1, 0))
+    values = np.where(lengths > 0, step_results[b_idxs, last_steps, 2], 0.0) if height > 0 else np.zeros(batch_size)
+    return values, step_results
+
+def get_grounded_equations(step_results: np.ndarray, steps: np.ndarray, length: int, uni_labels: List[str]) -> List[List]:
+    """
+    :param step_results: (height, 3) of one instance from `compute_values_for_batched_equations`
+    :param steps: (height, 4) of one instance
+    :return: [left_number, right_number, op, value] of each step, same as `compute_value_for_incremental_equations`
+    """
+    return [[float(left), float(right), uni_labels[op_idx], float(value)]
+            for (left, right, value), op_idx in zip(step_results[:length].tolist(), steps[:length, 2].tolist())]
+
 def is_value_correct(predictions, labels):
     if math.fabs((predictions - labels)) < 1e-4:
         return True
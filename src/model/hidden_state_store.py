@@ -0,0 +1,96 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.utils.data import DataLoader
+from tqdm import tqdm
+from src.data.universal_dataset import UniversalDataset
+from src.model.universal_model import get_var_hidden_states
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+## bump when the way the variable representations are computed changes
+HIDDEN_STATE_STORE_VERSION = 1
+
+
+def get_encoder_digest(model: nn.Module) -> str:
+    """
+    Hash of the encoder weights and config, the stored hidden states are only valid for exactly this encoder.
+    """
+    digest = hashlib.sha1()
+    digest.update(model.base_model.config.to_json_string(use_diff=False).encode("utf-8"))
+    for name, tensor in model.base_model.state_dict().items():
+        digest.update(name.encode("utf-8"))
+        digest.update(tensor.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_hidden_state_store(model: nn.Module, dataset: UniversalDataset, cache_dir: str, name: str,
+                           batch_size: int = 64, device: torch.device = torch.device("cpu")) -> np.ndarray:
+    """
+    Encode the dataset once with the (frozen) encoder and keep the representation of each variable in a float16
+    memory-mapped file, keyed on the encoder weights and the features. The later runs with the same encoder only map it.
+    :return: (total number of variables, hidden_size), in the order of the variables of the dataset
+    """
+    key = hashlib.sha1(json.dumps({
+        "version": HIDDEN_STATE_STORE_VERSION,
+        "encoder": get_encoder_digest(model),
+        "features": dataset.get_feature_digest(),
+        "quant_special_token": bool(model.quant_special_token),
+    }, sort_keys=True).encode("utf-8")).hexdigest()
+    store_folder = os.path.join(cache_dir, f"{name}.{key[:16]}")
+    if not os.path.exists(os.path.join(store_folder, "meta.json")):
+        logger.info(f"[Model Info] building hidden state store: {store_folder}")
+        build_hidden_state_store(model, dataset, store_folder, key, batch_size, device)
+    else:
+        logger.info(f"[Model Info] loading hidden state store: {store_folder}")
+    return np.load(os.path.join(store_folder, "var_hidden_states.npy"), mmap_mode="r")
+
+
+def build_hidden_state_store(model: nn.Module, dataset: UniversalDataset, store_folder: str, key: str,
+                             batch_size: int, device: torch.device) -> None:
+    """
+    Written into a temporary folder and renamed, so that concurrent runs never see a partial store.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(store_folder)), exist_ok=True)
+    tmp_folder = tempfile.mkdtemp(prefix=".tmp.", dir=os.path.dirname(os.path.abspath(store_folder)))
+    hidden_size = model.base_model.config.hidden_size
+    total_num_variables = int(dataset.get_sizes()[1].sum())
+    store = np.lib.format.open_memmap(os.path.join(tmp_folder, "var_hidden_states.npy"), mode="w+", dtype=np.float16,
+                                      shape=(total_num_variables, hidden_size))
+    ## in order, the rows of each batch follow the previous one
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=dataset.collate_function)
+    was_training = model.training
+    model.eval()
+    offset = 0
+    with torch.no_grad():
+        for feature in tqdm(loader, desc="--encoding batch", total=len(loader)):
+            var_hidden_states = get_var_hidden_states(model, model.base_model,
+                                                      input_ids=feature.input_ids.to(device),
+                                                      attention_mask=feature.attention_mask.to(device),
+                                                      token_type_ids=feature.token_type_ids.to(device),
+                                                      position_ids=None,
+                                                      variable_indexs_start=feature.variable_indexs_start.to(device),
+                                                      variable_indexs_end=feature.variable_indexs_end.to(device),
+                                                      return_dict=True)
+            rows = var_hidden_states[feature.variable_index_mask.to(device).bool()].cpu().numpy()
+            store[offset:offset + len(rows)] = rows
+            offset += len(rows)
+    model.train(was_training)
+    assert offset == total_num_variables
+    store.flush()
+    del store
+    with open(os.path.join(tmp_folder, "meta.json"), "w", encoding="utf-8") as write_file:
+        json.dump({"key": key, "version": HIDDEN_STATE_STORE_VERSION, "num_variables": total_num_variables,
+                   "hidden_size": hidden_size}, write_file)
+    try:
+        os.rename(tmp_folder, store_folder)
+    except OSError:
+        ## another process has written the same store
+        shutil.rmtree(tmp_folder, ignore_errors=True)
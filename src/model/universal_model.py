@@ -1,5 +1,7 @@
 from transformers.models.bert.modeling_bert import BertModel, BertPreTrainedModel, BertConfig
-from transformers import RobertaModel, RobertaConfig, RobertaPreTrainedModel
+from transformers import RobertaModel, RobertaConfig, RobertaPreTrainedModel, PreTrainedModel, PreTrainedTokenizerBase
+from transformers.modeling_utils import no_init_weights
+from safetensors.torch import load_file as load_safetensors
 import torch.nn as nn
 import torch
 import torch.utils.checkpoint
@@ -7,7 +9,16 @@ from transformers.modeling_outputs import (
     ModelOutput,
 )
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Optional, List, Tuple
+import collections
+import glob
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
 
 @dataclass
 class UniversalOutput(ModelOutput):
@@ -19,25 +30,197 @@ class UniversalOutput(ModelOutput):
             Classification (or regression if config.num_labels==1) loss.
         logits (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, config.num_labels)`):
             Classification (or regression if config.num_labels==1) scores (before SoftMax).
+        all_logits (:obj:`List[torch.FloatTensor]` of shape :obj:`(batch_size, num_combinations, num_labels, 2)`):
+            Scores of every height, only returned in training.
+        predictions (:obj:`torch.LongTensor` of shape :obj:`(batch_size, height, 4)`, `optional`, returned at inference):
+            (left_var_index, right_var_index, label_index, stop_label) of the best combination at each height.
+            Under `early_exit`, the heights after the first stop of an instance are left as zeros.
     """
 
     loss: Optional[torch.FloatTensor] = None
     all_logits: List[torch.FloatTensor] = None
+    predictions: Optional[torch.LongTensor] = None
 
 def get_combination_mask(batched_num_variables: torch.Tensor, combination: torch.Tensor):
     """
 
     :param batched_num_variables: (batch_size)
-    :param combination: (num_combinations, 2) 6,2
+    :param combination: (num_combinations, 2) 6,2, left index is never larger than the right index
     :return: batched_comb_mask: (batch_size, num_combinations)
     """
-    batch_size, = batched_num_variables.size() ## [ 2,]
-    num_combinations, _ = combination.size() ## 6
-    batched_num_variables = batched_num_variables.unsqueeze(1).unsqueeze(2).expand(batch_size, num_combinations, 2) ## (2) -> (2,6,2)
-    batched_combination = combination.unsqueeze(0).expand(batch_size, num_combinations, 2)## (6, 2) -> (2,6,2)
-    batched_comb_mask = torch.lt(batched_combination, batched_num_variables) ## batch_size, num_combinations, 2
+    ## a combination is valid iff its right (larger) variable index is valid
+    return torch.lt(combination[:, 1].unsqueeze(0), batched_num_variables.unsqueeze(1))
+
+
+class CombinationCache(nn.Module):
+    """
+    LRU cache of the combination tables, keyed by (num_variables, device).
+    The tables are registered as non-persistent buffers, so they move with the model and are not saved in checkpoints.
+    """
+
+    def __init__(self, max_size: int = 32):
+        super().__init__()
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()  ## (num_variables, device) -> buffer names
+
+    def _lookup(self, key):
+        names = self._entries.get(key)
+        if names is None or any(name not in self._buffers for name in names):
+            return None
+        tables = tuple(self._buffers[name] for name in names)
+        ## the buffers were moved together with the model
+        return tables if tables[0].device == key[1] else None
+
+    def get(self, num_variables: int, device: torch.device):
+        """
+        :return: combination: (num_combinations, 2), every (left, right) pair with left <= right,
+                     `combination.view(-1)` is the gather index over the variables
+                 pair2comb: (num_variables, num_variables), the combination id of a pair in either order
+        """
+        key = (num_variables, torch.device(device))
+        tables = self._lookup(key)
+        if tables is not None:
+            self._entries.move_to_end(key)
+            return tables
+        num_var_range = torch.arange(0, num_variables, device=device)
+        combination = torch.combinations(num_var_range, r=2, with_replacement=True)  ##number_of_combinations x 2
+        num_combinations, _ = combination.size()
+        comb_ids = torch.arange(0, num_combinations, device=device)
+        pair2comb = torch.full((num_variables, num_variables), -1, dtype=torch.long, device=device)
+        pair2comb[combination[:, 0], combination[:, 1]] = comb_ids
+        pair2comb[combination[:, 1], combination[:, 0]] = comb_ids
+        suffix = f"{num_variables}_{key[1].type}{'' if key[1].index is None else key[1].index}"
+        names = (f"combination_{suffix}", f"pair2comb_{suffix}")
+        for name, table in zip(names, (combination, pair2comb)):
+            self.register_buffer(name, table, persistent=False)
+        self._entries[key] = names
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            _, old_names = self._entries.popitem(last=False)
+            for name in old_names:
+                self._buffers.pop(name, None)
+        return combination, pair2comb
+
+
+LABEL_PROJECTION_OLD_KEYS = [r"linears\.\d+\.[02]\.(weight|bias)"]
+LABEL_PROJECTION_NEW_KEYS = [r"linears\.(dense\.weight|dense\.bias|norm_weight|norm_bias)"]
+
+
+class LabelProjection(nn.Module):
+    """
+    The per-label (Linear, ReLU, LayerNorm, Dropout) blocks fused into one input_size -> num_labels * hidden_size
+    projection followed by a LayerNorm grouped by label, the output is viewed as (..., num_labels, hidden_size).
+    Checkpoints saved with the `nn.ModuleList` version (`linears.{i}.0` / `linears.{i}.2`) are converted on loading.
+    """
 
-    return batched_comb_mask[:,:, 0] * batched_comb_mask[:,:, 1]
+    def __init__(self, input_size: int, hidden_size: int, num_labels: int, layer_norm_eps: float, dropout_prob: float):
+        super().__init__()
+        self.hidden_size = hidden_size
+        self.num_labels = num_labels
+        self.layer_norm_eps = layer_norm_eps
+        self.dense = nn.Linear(input_size, num_labels * hidden_size)
+        self.norm_weight = nn.Parameter(torch.ones(num_labels, hidden_size))
+        self.norm_bias = nn.Parameter(torch.zeros(num_labels, hidden_size))
+        self.dropout = nn.Dropout(dropout_prob)
+
+    def activate(self, projected: torch.Tensor) -> torch.Tensor:
+        """
+        :param projected: (..., num_labels * hidden_size), output of `dense`
+        :return: (..., num_labels, hidden_size)
+        """
+        projected = projected.view(*projected.size()[:-1], self.num_labels, self.hidden_size)
+        normalized = nn.functional.layer_norm(nn.functional.relu(projected), (self.hidden_size,), eps=self.layer_norm_eps)
+        return self.dropout(torch.addcmul(self.norm_bias, normalized, self.norm_weight))
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return self.activate(self.dense(hidden_states))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if f"{prefix}0.0.weight" in state_dict:
+            ## old layout: linears.{i} = Sequential(Linear, ReLU, LayerNorm, Dropout)
+            for name, (module_idx, param_name) in {"dense.weight": (0, "weight"), "dense.bias": (0, "bias"),
+                                                   "norm_weight": (2, "weight"), "norm_bias": (2, "bias")}.items():
+                params = [state_dict.pop(f"{prefix}{i}.{module_idx}.{param_name}") for i in range(self.num_labels)]
+                state_dict[f"{prefix}{name}"] = torch.cat(params, dim=0) if name.startswith("dense") else torch.stack(params, dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+
+def get_label_rep(cls, var_hidden_states: torch.Tensor, combination: torch.Tensor):
+    """
+    Label representations for every variable pair, [a, b, a*b] -> hidden for each label.
+    With `cls.factorized_scoring`, the `a` and `b` blocks of the 3h -> h projection are applied once per variable
+    and only the `a*b` block is computed per pair, the output is the same as the concatenation version.
+    :param var_hidden_states: (batch_size, num_variables, hidden_size)
+    :param combination: (num_combinations, 2)
+    :return: label_rep: (batch_size, num_combinations, num_labels, hidden_size)
+    """
+    batch_size, _, hidden_size = var_hidden_states.size()
+    num_combinations, _ = combination.size()
+    var_comb_hidden_states = torch.gather(var_hidden_states, 1,
+                                          combination.view(-1).unsqueeze(0).unsqueeze(-1).expand(batch_size, num_combinations * 2, hidden_size))
+    expanded_var_comb_hidden_states = var_comb_hidden_states.view(batch_size, num_combinations, 2, hidden_size)
+    left_hidden_states = expanded_var_comb_hidden_states[:, :, 0, :]
+    right_hidden_states = expanded_var_comb_hidden_states[:, :, 1, :]
+    if not cls.factorized_scoring:
+        comb_hidden_states = torch.cat([left_hidden_states, right_hidden_states, left_hidden_states * right_hidden_states], dim=-1)
+        return cls.linears(comb_hidden_states)
+
+    ## (num_labels * hidden_size, 3 * hidden_size)
+    left_weight, right_weight, prod_weight = cls.linears.dense.weight.split(hidden_size, dim=-1)
+    ## batch_size, num_variables, num_labels * hidden_size
+    left_proj = nn.functional.linear(var_hidden_states, left_weight)
+    right_proj = nn.functional.linear(var_hidden_states, right_weight, cls.linears.dense.bias)
+    proj_size = left_proj.size(-1)
+    comb_proj = torch.gather(left_proj, 1, combination[:, 0].unsqueeze(0).unsqueeze(-1).expand(batch_size, num_combinations, proj_size)) + \
+                torch.gather(right_proj, 1, combination[:, 1].unsqueeze(0).unsqueeze(-1).expand(batch_size, num_combinations, proj_size)) + \
+                nn.functional.linear(left_hidden_states * right_hidden_states, prod_weight)
+    return cls.linears.activate(comb_proj)
+
+
+def score_combinations(cls, var_hidden_states: torch.Tensor, combination: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    The scores of one height for every variable pair.
+    :return: label_rep: (batch_size, num_combinations, num_labels, hidden_size),
+        label_scores: (batch_size, num_combinations, num_labels, 1),
+        stopper_logits: (batch_size, num_combinations, num_labels, 2),
+        var_scores: (batch_size, num_variables)
+    """
+    label_rep = get_label_rep(cls, var_hidden_states, combination)
+    label_scores = cls.label_rep2label(label_rep)
+    stopper_logits = cls.stopper(cls.stopper_transformation(label_rep))
+    var_scores = cls.variable_scorer(var_hidden_states).squeeze(-1)
+    return label_rep, label_scores, stopper_logits, var_scores
+
+
+def get_var_hidden_states(cls, encoder, input_ids, attention_mask, token_type_ids, position_ids,
+                          variable_indexs_start, variable_indexs_end, head_mask=None, inputs_embeds=None,
+                          output_attentions=None, output_hidden_states=None, return_dict=None) -> torch.Tensor:
+    """
+    Encode the text and gather the representation of each variable (constants excluded).
+    :return: (batch_size, max_num_variable, hidden_size)
+    """
+    outputs = encoder(  # batch_size, sent_len, hidden_size,
+        input_ids,
+        attention_mask=attention_mask,
+        token_type_ids=token_type_ids,
+        position_ids=position_ids,
+        head_mask=head_mask,
+        inputs_embeds=inputs_embeds,
+        output_attentions=output_attentions,
+        output_hidden_states=output_hidden_states,
+        return_dict=return_dict,
+    )
+    batch_size, sent_len, hidden_size = outputs.last_hidden_state.size()
+    _, max_num_variable = variable_indexs_start.size()
+
+    var_start_hidden_states = torch.gather(outputs.last_hidden_state, 1, variable_indexs_start.unsqueeze(-1).expand(batch_size, max_num_variable, hidden_size))
+    if cls.quant_special_token:
+        ## "<quant>" is a single token, start and end are the same
+        return var_start_hidden_states
+    ## if add <NUM>, we can just choose one as hidden_states, the check stays on device to avoid a host sync
+    has_var_span = (variable_indexs_start != variable_indexs_end).any()
+    var_end_hidden_states = torch.gather(outputs.last_hidden_state, 1, variable_indexs_end.unsqueeze(-1).expand(batch_size, max_num_variable, hidden_size))
+    return var_start_hidden_states + var_end_hidden_states * has_var_span.to(var_end_hidden_states.dtype)
 
 
 def deductive_forward(cls,
@@ -58,41 +241,32 @@ def deductive_forward(cls,
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
-        is_eval=False):
+        is_eval=False,
+        early_exit=False,
+        var_hidden_states=None):
     r"""
     labels (:obj:`torch.LongTensor` of shape :obj:`(batch_size,)`, `optional`):
         Labels for computing the sequence classification/regression loss. Indices should be in :obj:`[0, ...,
         config.num_labels - 1]`. If :obj:`config.num_labels == 1` a regression loss is computed (Mean-Square loss),
         If :obj:`config.num_labels > 1` a classification loss is computed (Cross-Entropy).
+    early_exit (:obj:`bool`): at inference, drop the instances that predicted stop from the later heights
+        and stop once every instance is finished.
+    var_hidden_states (:obj:`torch.FloatTensor` of shape :obj:`(batch_size, num_variable, hidden_size)`, `optional`):
+        the gathered variable representations of `get_var_hidden_states`, precomputed with a frozen encoder,
+        the encoder is not run when given.
     """
     return_dict = return_dict if return_dict is not None else cls.config.use_return_dict
-    outputs = encoder(  # batch_size, sent_len, hidden_size,
-        input_ids,
-        attention_mask=attention_mask,
-        token_type_ids=token_type_ids,
-        position_ids=position_ids,
-        head_mask=head_mask,
-        inputs_embeds=inputs_embeds,
-        output_attentions=output_attentions,
-        output_hidden_states=output_hidden_states,
-        return_dict=return_dict,
-    )
-    batch_size, sent_len, hidden_size = outputs.last_hidden_state.size()
+    if var_hidden_states is None:
+        var_hidden_states = get_var_hidden_states(cls, encoder, input_ids, attention_mask, token_type_ids, position_ids,
+                                                  variable_indexs_start, variable_indexs_end, head_mask, inputs_embeds,
+                                                  output_attentions, output_hidden_states, return_dict)
+    batch_size, max_num_variable, hidden_size = var_hidden_states.size()
     if labels is not None and not is_eval:
         # is_train
         _, max_height, _ = labels.size()
     else:
         max_height = cls.max_height
 
-    _, max_num_variable = variable_indexs_start.size()
-
-    var_sum = (variable_indexs_start - variable_indexs_end).sum()  ## if add <NUM>, we can just choose one as hidden_states
-    var_start_hidden_states = torch.gather(outputs.last_hidden_state, 1, variable_indexs_start.unsqueeze(-1).expand(batch_size, max_num_variable, hidden_size))
-    if var_sum != 0:
-        var_end_hidden_states = torch.gather(outputs.last_hidden_state, 1, variable_indexs_end.unsqueeze(-1).expand(batch_size, max_num_variable, hidden_size))
-        var_hidden_states = var_start_hidden_states + var_end_hidden_states
-    else:
-        var_hidden_states = var_start_hidden_states
     if cls.constant_num > 0:
         constant_hidden_states = cls.const_rep.unsqueeze(0).expand(batch_size, cls.constant_num, hidden_size)
         var_hidden_states = torch.cat([constant_hidden_states, var_hidden_states], dim=1)
@@ -108,70 +282,18 @@ def deductive_forward(cls,
     loss = 0
     all_logits = []
     best_mi_scores = None
+    b_idxs = torch.arange(0, batch_size, device=variable_indexs_start.device)
+    predictions = None
+    if labels is None or is_eval:
+        ## (batch_size, max_height, 4): (left_var_index, right_var_index, label_index, stop_label) of each height
+        predictions = torch.zeros((batch_size, max_height, 4), dtype=torch.long, device=variable_indexs_start.device)
+    ## the original batch index of each remaining row, rows are dropped once they predict stop under `early_exit`
+    active_b_idxs = b_idxs
+    ## reuse the pair scores of the previous height when the variable states are not updated
+    incremental_scoring = cls.incremental_scoring and cls.var_update_mode == -1
 
     for i in range(max_height):
-        linear_modules = cls.linears
-        if i == 0:
-            ## max_num_variable = 4. -> [0,1,2,3]
-            num_var_range = torch.arange(0, max_num_variable, device=variable_indexs_start.device)
-            ## 6x2 matrix
-            combination = torch.combinations(num_var_range, r=2, with_replacement=True)  ##number_of_combinations x 2
-            num_combinations, _ = combination.size()  # number_of_combinations x 2
-            # batch_size x num_combinations. 2*6
-            batched_combination_mask = get_combination_mask(batched_num_variables=num_variables, combination=combination)  # batch_size, num_combinations
-
-            var_comb_hidden_states = torch.gather(var_hidden_states, 1,
-                                                  combination.view(-1).unsqueeze(0).unsqueeze(-1).expand(batch_size, num_combinations * 2, hidden_size))
-            # m0_hidden_states = var_comb_hidden_states.unsqueeze(-2).view(batch_size, num_combinations, 2, hidden_size * 3).sum(dim=-2)
-            expanded_var_comb_hidden_states = var_comb_hidden_states.unsqueeze(-2).view(batch_size, num_combinations, 2, hidden_size)
-            m0_hidden_states = torch.cat([expanded_var_comb_hidden_states[:, :, 0, :], expanded_var_comb_hidden_states[:, :, 1, :],
-                                          expanded_var_comb_hidden_states[:, :, 0, :] * expanded_var_comb_hidden_states[:, :, 1, :]], dim=-1)
-            # batch_size, num_combinations/num_m0, hidden_size: 2,6,768
-
-            ## batch_size, num_combinations/num_m0, num_labels, hidden_size
-            m0_label_rep = torch.stack([layer(m0_hidden_states) for layer in linear_modules], dim=2)
-            ## batch_size, num_combinations/num_m0, num_labels
-            m0_logits = cls.label_rep2label(m0_label_rep).expand(batch_size, num_combinations, cls.num_labels, 2)
-            m0_logits = m0_logits + batched_combination_mask.unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels, 2).float().log()
-            ## batch_size, num_combinations/num_m0, num_labels, 2
-            m0_stopper_logits = cls.stopper(cls.stopper_transformation(m0_label_rep))
-
-            var_scores = cls.variable_scorer(var_hidden_states).squeeze(-1)  ## batch_size x max_num_variable
-            expanded_var_scores = torch.gather(var_scores, 1, combination.unsqueeze(0).expand(batch_size, num_combinations, 2).view(batch_size, -1)).unsqueeze(
-                -1).view(batch_size, num_combinations, 2)
-            expanded_var_scores = expanded_var_scores.sum(dim=-1).unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels, 2)
-
-            ## batch_size, num_combinations/num_m0, num_labels, 2
-            m0_combined_logits = m0_logits + m0_stopper_logits + expanded_var_scores
-
-            all_logits.append(m0_combined_logits)
-            best_temp_logits, best_stop_label = m0_combined_logits.max(dim=-1)  ## batch_size, num_combinations/num_m0, num_labels
-            best_temp_score, best_temp_label = best_temp_logits.max(dim=-1)  ## batch_size, num_combinations
-            best_m0_score, best_comb = best_temp_score.max(dim=-1)  ## batch_size
-            best_label = torch.gather(best_temp_label, 1, best_comb.unsqueeze(-1)).squeeze(-1)  ## batch_size
-
-            b_idxs = [k for k in range(batch_size)]
-            # best_m0_label_rep = m0_label_rep[b_idxs, best_comb, best_label] # batch_size x hidden_size
-            # best_mi_label_rep = best_m0_label_rep
-            ## NOTE: add loosss
-            if labels is not None and not is_eval:
-                m0_gold_labels = labels[:, i, :]  ## batch_size x 4 (left_var_index, right_var_index, label_index, stop_id)
-                m0_gold_comb = m0_gold_labels[:, :2].unsqueeze(1).expand(batch_size, num_combinations, 2)
-                batched_comb = combination.unsqueeze(0).expand(batch_size, num_combinations, 2)
-                judge = m0_gold_comb == batched_comb
-                judge = judge[:, :, 0] * judge[:, :, 1]  # batch_size, num_combinations
-                judge = judge.nonzero()[:, 1]  # batch_size
-
-                m0_gold_scores = m0_combined_logits[b_idxs, judge, m0_gold_labels[:, 2], m0_gold_labels[:, 3]]  ## batch_size
-                loss = loss + (best_m0_score - m0_gold_scores).sum()
-
-                best_mi_label_rep = m0_label_rep[b_idxs, judge, m0_gold_labels[:, 2]]  ## teacher-forcing.
-                best_mi_scores = m0_logits[b_idxs, judge, m0_gold_labels[:, 2]][:, 0]  # batch_size
-            else:
-                best_m0_label_rep = m0_label_rep[b_idxs, best_comb, best_label]  # batch_size x hidden_size
-                best_mi_label_rep = best_m0_label_rep
-                best_mi_scores = m0_logits[b_idxs, best_comb, best_label][:, 0]  # batch_size
-        else:
+        if i > 0:
             if cls.var_update_mode == 0:
                 ## update hidden_state (gated hidden state)
                 init_h = best_mi_label_rep.unsqueeze(1).expand(batch_size, max_num_variable + i - 1, hidden_size).contiguous().view(-1, hidden_size)
@@ -184,72 +306,109 @@ def deductive_forward(cls,
                 temp_mask[0, :] = 1
                 updated_all_states, _ = cls.variable_gru(temp_states, temp_states, temp_states, attn_mask=1 - temp_mask)
                 var_hidden_states = updated_all_states[:, 1:, :]
-
-            num_var_range = torch.arange(0, max_num_variable + i, device=variable_indexs_start.device)
-            ## 6x2 matrix
-            combination = torch.combinations(num_var_range, r=2, with_replacement=True)  ##number_of_combinations x 2
-            num_combinations, _ = combination.size()  # number_of_combinations x 2
-            batched_combination_mask = get_combination_mask(batched_num_variables=num_variables + i, combination=combination)
-
             var_hidden_states = torch.cat([best_mi_label_rep.unsqueeze(1), var_hidden_states], dim=1)  ## batch_size x (num_var + i) x hidden_size
-            var_comb_hidden_states = torch.gather(var_hidden_states, 1,
-                                                  combination.view(-1).unsqueeze(0).unsqueeze(-1).expand(batch_size, num_combinations * 2, hidden_size))
-            expanded_var_comb_hidden_states = var_comb_hidden_states.unsqueeze(-2).view(batch_size, num_combinations, 2, hidden_size)
-            mi_hidden_states = torch.cat([expanded_var_comb_hidden_states[:, :, 0, :], expanded_var_comb_hidden_states[:, :, 1, :],
-                                          expanded_var_comb_hidden_states[:, :, 0, :] * expanded_var_comb_hidden_states[:, :, 1, :]], dim=-1)
-            mi_label_rep = torch.stack([layer(mi_hidden_states) for layer in linear_modules], dim=2)
-            mi_logits = cls.label_rep2label(mi_label_rep).expand(batch_size, num_combinations, cls.num_labels, 2)
-            mi_logits = mi_logits + batched_combination_mask.unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels,
-                                                                                                2).float().log()
-
-            mi_stopper_logits = cls.stopper(cls.stopper_transformation(mi_label_rep))
-            var_scores = cls.variable_scorer(var_hidden_states).squeeze(-1)  ## batch_size x max_num_variable
-            expanded_var_scores = torch.gather(var_scores, 1,
-                                               combination.unsqueeze(0).expand(batch_size, num_combinations, 2).view(batch_size, -1)).unsqueeze(-1).view(
-                batch_size, num_combinations, 2)
-            expanded_var_scores = expanded_var_scores.sum(dim=-1).unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels, 2)
 
+        ## max_num_variable = 4. -> 10x2 matrix of [0,1,2,3] pairs
+        combination, pair2comb = cls.combination_cache.get(max_num_variable + i, variable_indexs_start.device)
+        num_combinations, _ = combination.size()  # number_of_combinations x 2
+        # batch_size x num_combinations. 2*6
+        batched_combination_mask = get_combination_mask(batched_num_variables=num_variables + i, combination=combination)  # batch_size, num_combinations
+
+        if incremental_scoring and i > 0:
+            ## the old variables are unchanged and shifted by one, so the old pairs keep their scores and follow
+            ## the first (max_num_variable + i) combinations, which are the pairs with the new variable m_i
+            new_label_rep = get_label_rep(cls, var_hidden_states, combination[:max_num_variable + i])
+            mi_label_rep = torch.cat([new_label_rep, mi_label_rep], dim=1)
+            mi_label_scores = torch.cat([cls.label_rep2label(new_label_rep), mi_label_scores], dim=1)
+            mi_stopper_logits = torch.cat([cls.stopper(cls.stopper_transformation(new_label_rep)), mi_stopper_logits], dim=1)
+            var_scores = torch.cat([cls.variable_scorer(best_mi_label_rep).squeeze(-1).unsqueeze(1), var_scores], dim=1)
+        elif cls.head_checkpoint and cls.training and torch.is_grad_enabled():
+            ## only the inputs are kept for backward, the (batch_size, num_combinations, num_labels, hidden_size)
+            ## intermediate states of the block are recomputed
+            mi_label_rep, mi_label_scores, mi_stopper_logits, var_scores = torch.utils.checkpoint.checkpoint(
+                score_combinations, cls, var_hidden_states, combination, use_reentrant=False)
+        else:
+            mi_label_rep, mi_label_scores, mi_stopper_logits, var_scores = score_combinations(cls, var_hidden_states, combination)
+        ## batch_size, num_combinations/num_mi
+        mask_logits = batched_combination_mask.float().log()
+        var_pair_scores = torch.gather(var_scores, 1, combination.view(-1).unsqueeze(0).expand(batch_size, num_combinations * 2)).view(
+            batch_size, num_combinations, 2).sum(dim=-1)
+
+        ## NOTE: add loosss
+        if labels is not None and not is_eval:
+            ## batch_size, num_combinations/num_mi, num_labels, 2
+            mi_logits = mi_label_scores.expand(batch_size, num_combinations, cls.num_labels, 2)
+            mi_logits = mi_logits + mask_logits.unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels, 2)
+            expanded_var_scores = var_pair_scores.unsqueeze(-1).unsqueeze(-1).expand(batch_size, num_combinations, cls.num_labels, 2)
             mi_combined_logits = mi_logits + mi_stopper_logits + expanded_var_scores
-            all_logits.append(mi_combined_logits)
-            best_temp_logits, best_stop_label = mi_combined_logits.max(dim=-1)  ## batch_size, num_combinations/num_m0, num_labels
-            best_temp_score, best_temp_label = best_temp_logits.max(dim=-1)  ## batch_size, num_combinations
-            best_mi_score, best_comb = best_temp_score.max(dim=-1)  ## batch_size
-            best_label = torch.gather(best_temp_label, 1, best_comb.unsqueeze(-1)).squeeze(-1)  ## batch_size
-
-            ## NOTE: add loosss
-            if labels is not None and not is_eval:
-                mi_gold_labels = labels[:, i, :]  ## batch_size x 4 (left_var_index, right_var_index, label_index, stop_id)
-                mi_gold_comb = mi_gold_labels[:, :2].unsqueeze(1).expand(batch_size, num_combinations, 2)
-                batched_comb = combination.unsqueeze(0).expand(batch_size, num_combinations, 2)
-                judge = mi_gold_comb == batched_comb
-                judge = judge[:, :, 0] * judge[:, :, 1]  # batch_size, num_combinations
-                judge = judge.nonzero()[:, 1]  # batch_size
-
-                mi_gold_scores = mi_combined_logits[b_idxs, judge, mi_gold_labels[:, 2], mi_gold_labels[:, 3]]  ## batch_size
-                height_mask = label_height_mask[:, i]  ## batch_size
-                current_loss = (best_mi_score - mi_gold_scores) * height_mask  ## avoid compute loss for unnecessary height
-                loss = loss + current_loss.sum()
-                best_mi_label_rep = mi_label_rep[b_idxs, judge, mi_gold_labels[:, 2]]  ## teacher-forcing.
-                best_mi_scores = mi_logits[b_idxs, judge, mi_gold_labels[:, 2]][:, 0]  # batch_size
-            else:
-                best_mi_label_rep = mi_label_rep[b_idxs, best_comb, best_label]  # batch_size x hidden_size
-                best_mi_scores = mi_logits[b_idxs, best_comb, best_label][:, 0]
-
-    return UniversalOutput(loss=loss, all_logits=all_logits)
 
+            best_mi_score, _ = mi_combined_logits.view(batch_size, -1).max(dim=-1)  ## batch_size
 
-def initialize_param(cls, config, constant_num, height, var_update_mode):
+            all_logits.append(mi_combined_logits)
+            mi_gold_labels = labels[:, i, :]  ## batch_size x 4 (left_var_index, right_var_index, label_index, stop_id)
+            judge = pair2comb[mi_gold_labels[:, 0], mi_gold_labels[:, 1]]  # batch_size, gold combination id
 
+            mi_gold_scores = mi_combined_logits[b_idxs, judge, mi_gold_labels[:, 2], mi_gold_labels[:, 3]]  ## batch_size
+            current_loss = best_mi_score - mi_gold_scores
+            if i > 0:
+                height_mask = label_height_mask[:, i]  ## batch_size
+                current_loss = current_loss * height_mask  ## avoid compute loss for unnecessary height
+            loss = loss + current_loss.sum()
+            best_mi_label_rep = mi_label_rep[b_idxs, judge, mi_gold_labels[:, 2]]  ## teacher-forcing.
+            best_mi_scores = mi_logits[b_idxs, judge, mi_gold_labels[:, 2]][:, 0]  # batch_size
+        else:
+            ## the max over the stop labels only involves the stopper logits, so the
+            ## (batch_size, num_combinations, num_labels, 2) logits are never built at inference
+            best_stop_logits, best_stop_label = mi_stopper_logits.max(dim=-1)  ## batch_size, num_combinations/num_mi, num_labels
+            ## batch_size, num_combinations/num_mi, num_labels
+            mi_logits = mi_label_scores.squeeze(-1) + mask_logits.unsqueeze(-1)
+            mi_scores = mi_logits + best_stop_logits + var_pair_scores.unsqueeze(-1)
+            _, best_idx = mi_scores.view(batch_size, -1).max(dim=-1)  ## batch_size
+            best_comb = torch.div(best_idx, cls.num_labels, rounding_mode='floor')
+            best_label = best_idx % cls.num_labels
+
+            best_mi_label_rep = mi_label_rep[b_idxs, best_comb, best_label]  # batch_size x hidden_size
+            best_mi_scores = mi_logits[b_idxs, best_comb, best_label]  # batch_size
+            best_stop = best_stop_label[b_idxs, best_comb, best_label]  # batch_size
+            predictions[active_b_idxs, i] = torch.stack([combination[best_comb, 0], combination[best_comb, 1], best_label, best_stop], dim=-1)
+            if not early_exit:
+                continue
+            ## drop the finished rows from the later heights
+            unfinished = (best_stop == 0).nonzero().squeeze(-1)
+            if unfinished.size(0) == 0:
+                break
+            if unfinished.size(0) < batch_size:
+                batch_size = unfinished.size(0)
+                b_idxs = b_idxs[:batch_size]
+                active_b_idxs = active_b_idxs[unfinished]
+                var_hidden_states = var_hidden_states[unfinished]
+                best_mi_label_rep = best_mi_label_rep[unfinished]
+                best_mi_scores = best_mi_scores[unfinished]
+                num_variables = num_variables[unfinished]
+                if incremental_scoring:
+                    mi_label_rep = mi_label_rep[unfinished]
+                    mi_label_scores = mi_label_scores[unfinished]
+                    mi_stopper_logits = mi_stopper_logits[unfinished]
+                    var_scores = var_scores[unfinished]
+
+    return UniversalOutput(loss=loss, all_logits=all_logits, predictions=predictions)
+
+
+def initialize_param(cls, config, constant_num, height, var_update_mode, factorized_scoring=False, incremental_scoring=False,
+                     quant_special_token=False):
+
+    cls.factorized_scoring = factorized_scoring
+    cls.incremental_scoring = incremental_scoring
+    cls.quant_special_token = quant_special_token
+    cls.head_checkpoint = False ## set by `enable_grad_checkpoint`
+    cls.combination_cache = CombinationCache()
     cls.label_rep2label = nn.Linear(config.hidden_size, 1)  # 0 or 1
     cls.max_height = height  ## 3 operation
-    cls.linears = nn.ModuleList()
-    for i in range(cls.num_labels):
-        cls.linears.append(nn.Sequential(
-            nn.Linear(3 * config.hidden_size, config.hidden_size),
-            nn.ReLU(),
-            nn.LayerNorm(config.hidden_size, eps=config.layer_norm_eps),
-            nn.Dropout(config.hidden_dropout_prob)
-        ))
+    cls.linears = LabelProjection(input_size=3 * config.hidden_size,
+                                  hidden_size=config.hidden_size,
+                                  num_labels=cls.num_labels,
+                                  layer_norm_eps=config.layer_norm_eps,
+                                  dropout_prob=config.hidden_dropout_prob)
 
     cls.stopper_transformation = nn.Sequential(
         nn.Linear(config.hidden_size, config.hidden_size),
@@ -291,17 +450,26 @@ def initialize_param(cls, config, constant_num, height, var_update_mode):
     cls.init_weights()
 
 class UniversalModel(BertPreTrainedModel):
+    ## `linears` of old checkpoints are converted by `LabelProjection._load_from_state_dict`
+    _keys_to_ignore_on_load_unexpected = LABEL_PROJECTION_OLD_KEYS
+    _keys_to_ignore_on_load_missing = LABEL_PROJECTION_NEW_KEYS
 
     def __init__(self, config: BertConfig,
                  height: int = 4,
                  constant_num: int = 0,
-                 var_update_mode: str= 'gru'):
+                 var_update_mode: str= 'gru',
+                 factorized_scoring: bool = False,
+                 incremental_scoring: bool = False,
+                 quant_special_token: bool = False):
         """
         Constructor for model function
         :param config:
         :param diff_param_for_height: whether we want to use different layers/parameters for different height
         :param height: the maximum number of height we want to use
         :param constant_num: the number of constant we consider
+        :param factorized_scoring: project the variables once and only compute the product term for each pair
+        :param incremental_scoring: without variable update, only score the pairs with the new intermediate variable at each height
+        :param quant_special_token: "<quant>" is a single added token, so only the start positions of the variables are gathered
         """
         super().__init__(config)
         self.num_labels = config.num_labels ## should be 6
@@ -313,7 +481,10 @@ class UniversalModel(BertPreTrainedModel):
                          config=config,
                          constant_num=constant_num,
                          height=height,
-                         var_update_mode=var_update_mode)
+                         var_update_mode=var_update_mode,
+                         factorized_scoring=factorized_scoring,
+                         incremental_scoring=incremental_scoring,
+                         quant_special_token=quant_special_token)
 
 
     def forward(self,
@@ -333,7 +504,9 @@ class UniversalModel(BertPreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
-        is_eval=False
+        is_eval=False,
+        early_exit=False,
+        var_hidden_states=None
     ):
         return deductive_forward(
             self,
@@ -353,16 +526,23 @@ class UniversalModel(BertPreTrainedModel):
             output_attentions,
             output_hidden_states,
             return_dict,
-            is_eval
+            is_eval,
+            early_exit,
+            var_hidden_states
         )
 
 
 class UniversalModel_Roberta(RobertaPreTrainedModel):
+    _keys_to_ignore_on_load_unexpected = LABEL_PROJECTION_OLD_KEYS
+    _keys_to_ignore_on_load_missing = LABEL_PROJECTION_NEW_KEYS
 
     def __init__(self, config: RobertaConfig,
                  height: int = 4,
                  constant_num: int = 0,
-                 var_update_mode: str= 'gru'):
+                 var_update_mode: str= 'gru',
+                 factorized_scoring: bool = False,
+                 incremental_scoring: bool = False,
+                 quant_special_token: bool = False):
         super().__init__(config)
         self.num_labels = config.num_labels  ## should be 6
         assert self.num_labels == 6 or self.num_labels == 8
@@ -373,7 +553,10 @@ class UniversalModel_Roberta(RobertaPreTrainedModel):
                          config=config,
                          constant_num=constant_num,
                          height=height,
-                         var_update_mode=var_update_mode)
+                         var_update_mode=var_update_mode,
+                         factorized_scoring=factorized_scoring,
+                         incremental_scoring=incremental_scoring,
+                         quant_special_token=quant_special_token)
 
 
     def forward(self,
@@ -393,7 +576,9 @@ class UniversalModel_Roberta(RobertaPreTrainedModel):
         output_attentions=None,
         output_hidden_states=None,
         return_dict=None,
-        is_eval=False
+        is_eval=False,
+        early_exit=False,
+        var_hidden_states=None
     ):
         return deductive_forward(
             self,
@@ -413,9 +598,129 @@ class UniversalModel_Roberta(RobertaPreTrainedModel):
             output_attentions,
             output_hidden_states,
             return_dict,
-            is_eval
+            is_eval,
+            early_exit,
+            var_hidden_states
         )
 
 
+def resize_quant_embedding(model: PreTrainedModel, tokenizer: PreTrainedTokenizerBase, subword_ids: List[int]) -> None:
+    """
+    Resize the word embeddings after "<quant>" is added to the tokenizer, and initialize it with the mean embedding of
+    the subwords it used to be split into.
+    :param subword_ids: the ids of "<quant>" before it is added
+    """
+    quant_id = tokenizer.convert_tokens_to_ids("<quant>")
+    model.resize_token_embeddings(max(len(tokenizer), model.get_input_embeddings().num_embeddings))
+    with torch.no_grad():
+        word_embeddings = model.get_input_embeddings().weight
+        word_embeddings[quant_id] = word_embeddings[subword_ids].mean(dim=0)
+
+
+GRAD_CHECKPOINT_MODES = ["none", "encoder", "head", "all"]
+
+
+def enable_grad_checkpoint(model: PreTrainedModel, mode: str) -> None:
+    """
+    Recompute the activations during backward instead of keeping them: the encoder layers ("encoder"), the pair
+    scoring block of each height ("head") or both ("all"). Only applies in training mode.
+    """
+    assert mode in GRAD_CHECKPOINT_MODES
+    if mode in ["encoder", "all"]:
+        model.base_model.gradient_checkpointing_enable(gradient_checkpointing_kwargs={"use_reentrant": False})
+    elif model.base_model.is_gradient_checkpointing:
+        model.base_model.gradient_checkpointing_disable()
+    model.head_checkpoint = mode in ["head", "all"]
+
+
+## `save_pretrained` cannot serialize the packed int8 weights, the quantized checkpoint is a plain state dict
+QUANTIZED_FORMAT_VERSION = 1
+
+
+def quantize_model(model: PreTrainedModel) -> PreTrainedModel:
+    """
+    Dynamic int8 quantization (CPU only) of the Linear layers of the encoder and of the deductive head
+    (`linears`, `stopper_transformation`, `variable_scorer`): the weights are stored in int8 and the activations are
+    quantized on the fly. The factorized scoring is turned off, it reads the float weight of `linears.dense`.
+    """
+    if model.factorized_scoring:
+        logger.warning("factorized scoring is not supported by the quantized model, using the full pair scoring")
+        model.factorized_scoring = False
+    model = model.to("cpu").eval()
+    for module in [model.base_model, model.linears, model.stopper_transformation, model.variable_scorer]:
+        torch.ao.quantization.quantize_dynamic(module, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def save_quantized_model(model: PreTrainedModel, quantized_file: str) -> None:
+    ## written then renamed, concurrent runs never load a partial file
+    os.makedirs(os.path.dirname(os.path.abspath(quantized_file)), exist_ok=True)
+    tmp_file = f"{quantized_file}.{os.getpid()}.tmp"
+    torch.save(model.state_dict(), tmp_file)
+    os.replace(tmp_file, quantized_file)
+
+
+def get_quantized_file(model_dir: str, quantized_cache_dir: str, **kwargs) -> str:
+    """
+    The quantized checkpoint of `model_dir` in `quantized_cache_dir`, keyed on the content of the fp32 checkpoint
+    files and on the model arguments, so that it is never reused for other weights or another configuration.
+    """
+    digest = hashlib.sha1()
+    for file in sorted(glob.glob(os.path.join(model_dir, "pytorch_model*.bin")) + glob.glob(os.path.join(model_dir, "*.safetensors")) +
+                       glob.glob(os.path.join(model_dir, "config.json"))):
+        digest.update(os.path.basename(file).encode("utf-8"))
+        with open(file, "rb") as read_file:
+            for block in iter(lambda: read_file.read(1 << 20), b""):
+                digest.update(block)
+    digest.update(json.dumps({"version": QUANTIZED_FORMAT_VERSION, "torch": torch.__version__, "kwargs": kwargs},
+                             sort_keys=True, default=str).encode("utf-8"))
+    return os.path.join(quantized_cache_dir, f"{os.path.basename(os.path.normpath(model_dir))}.{digest.hexdigest()[:16]}.int8.pt")
+
+
+def load_pretrained_fast(model_class, model_dir: str, **kwargs) -> PreTrainedModel:
+    """
+    `from_pretrained` for inference: the model is built without initializing its weights, and the tensors of the
+    memory-mapped safetensors file become its parameters instead of being copied into them.
+    Falls back to `from_pretrained` for the other checkpoint formats, or if the file does not have all the weights.
+    """
+    weights_file = os.path.join(model_dir, "model.safetensors")
+    if not os.path.exists(weights_file):
+        return model_class.from_pretrained(model_dir, **kwargs)
+    config, model_kwargs = model_class.config_class.from_pretrained(model_dir, return_unused_kwargs=True, **kwargs)
+    with no_init_weights():
+        model = model_class(config, **model_kwargs)
+    result = model.load_state_dict(load_safetensors(weights_file), strict=False, assign=True)
+    if len(result.missing_keys) > 0 or len(result.unexpected_keys) > 0:
+        return model_class.from_pretrained(model_dir, **kwargs)
+    return model.eval()
+
+
+def load_inference_model(model_class, model_dir: str, quantize: str = "none", quantized_cache_dir: str = None, **kwargs) -> PreTrainedModel:
+    """
+    Load the model for inference, the checkpoint folder is only read. With `quantize="int8"`, the fp32 model is
+    quantized when loaded (a fraction of a second). With `quantized_cache_dir`, the quantized checkpoint is saved
+    there and loaded by the later runs with the same weights and arguments instead.
+    :param quantized_cache_dir: folder of the quantized checkpoints, None/""/"none" means no cache
+    :param kwargs: the arguments of `from_pretrained`, config attributes (e.g. `num_labels`) and model arguments
+    """
+    if quantize == "none":
+        return load_pretrained_fast(model_class, model_dir, **kwargs)
+    assert quantize == "int8", f"unknown quantization: {quantize}"
+    if quantized_cache_dir is None or quantized_cache_dir == "" or quantized_cache_dir == "none":
+        return quantize_model(load_pretrained_fast(model_class, model_dir, **kwargs))
+    quantized_file = get_quantized_file(model_dir, quantized_cache_dir, **kwargs)
+    if os.path.exists(quantized_file):
+        logger.info(f"[Model Info] loading quantized checkpoint: {quantized_file}")
+        config, model_kwargs = model_class.config_class.from_pretrained(model_dir, return_unused_kwargs=True, **kwargs)
+        with no_init_weights():
+            model = quantize_model(model_class(config, **model_kwargs))
+        model.load_state_dict(torch.load(quantized_file, map_location="cpu", weights_only=True))
+        return model
+    model = quantize_model(load_pretrained_fast(model_class, model_dir, **kwargs))
+    logger.info(f"[Model Info] saving quantized checkpoint: {quantized_file}")
+    save_quantized_model(model, quantized_file)
+    return model
+
+
 if __name__ == '__main__':
     pass
\ No newline at end of file
@@ -1,9 +1,14 @@
 import json
 from src.config import  Config
 import torch.nn as nn
-from typing import Tuple
+from typing import List, Tuple
 import torch
-from transformers import AdamW, get_linear_schedule_with_warmup
+import gzip
+import queue
+import threading
+import time
+import contextlib
+import os
 
 def write_data(file:str, data) -> None:
 	with open(file, "w", encoding="utf-8") as write_file:
@@ -12,22 +17,114 @@ def write_data(file:str, data) -> None:
 		json.dump(data, write_file, ensure_ascii=False, indent=4)
 
 def read_data(file:str):
+	if file.endswith(".jsonl"):
+		return list(iter_data(file))
 	with open(file, "r", encoding='utf-8') as read_file:
 		data = json.load(read_file)
 	return data
 
+class JsonlWriter:
+	"""
+	Write the records as compact json lines from a background thread, so that the encoding, compression and disk
+	writes overlap with the caller. The file is gzip compressed if it ends with ".gz".
+	"""
+
+	def __init__(self, file: str, max_queue_size: int = 64):
+		self.file = file
+		self._queue = queue.Queue(maxsize=max_queue_size)
+		self._error = None
+		self._thread = threading.Thread(target=self._run, daemon=True)
+		self._thread.start()
+
+	def _run(self) -> None:
+		opener = gzip.open if self.file.endswith(".gz") else open
+		try:
+			with opener(self.file, "wt", encoding="utf-8") as write_file:
+				while True:
+					records = self._queue.get()
+					if records is None:
+						break
+					write_file.write("".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records))
+		except BaseException as error:
+			self._error = error
+			## keep consuming so that the producer never blocks on a full queue
+			while self._queue.get() is not None:
+				pass
+
+	def write(self, records: List) -> None:
+		if self._error is not None:
+			raise self._error
+		self._queue.put(records)
+
+	def close(self) -> None:
+		self._queue.put(None)
+		self._thread.join()
+		if self._error is not None:
+			raise self._error
+
+	def __enter__(self) -> "JsonlWriter":
+		return self
+
+	def __exit__(self, *exc) -> None:
+		self.close()
+
+def iter_data(file:str, chunk_size: int = 1 << 20):
+	"""
+	Yield the instances one by one without loading the whole file: one json object per line for ".jsonl" files,
+	otherwise the elements of a json array, decoded incrementally from chunks of `chunk_size` characters.
+	"""
+	with open(file, "r", encoding='utf-8') as read_file:
+		if file.endswith(".jsonl"):
+			for line in read_file:
+				if line.strip():
+					yield json.loads(line)
+			return
+		decoder = json.JSONDecoder()
+		buffer, pos, eof = "", 0, False
+		started = False
+		while True:
+			## skip the whitespaces and the separators between the elements
+			while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ",")):
+				pos += 1
+			if pos < len(buffer) and not started:
+				if buffer[pos] != "[":
+					raise ValueError(f"{file} is not a json array")
+				started = True
+				pos += 1
+				continue
+			if pos < len(buffer) and buffer[pos] == "]":
+				return
+			try:
+				## an element is only complete when followed by more text, otherwise it can be a truncated number
+				if pos >= len(buffer) or (not eof and len(buffer) - pos < 2):
+					raise json.JSONDecodeError("need more data", buffer, pos)
+				obj, end = decoder.raw_decode(buffer, pos)
+				if end >= len(buffer) and not eof:
+					raise json.JSONDecodeError("need more data", buffer, pos)
+			except json.JSONDecodeError:
+				if eof:
+					raise
+				chunk = read_file.read(chunk_size)
+				eof = len(chunk) == 0
+				buffer, pos = buffer[pos:] + chunk, 0
+				continue
+			yield obj
+			pos = end
+
 
 def get_optimizers(config: Config, model: nn.Module, num_training_steps: int, weight_decay:float = 0.01,
 				   warmup_step: int = -1, eps:float = 1e-8) -> Tuple[torch.optim.Optimizer, torch.optim.lr_scheduler.LambdaLR]:
+	## only needed for training, not imported by the inference scripts
+	from transformers import AdamW, get_linear_schedule_with_warmup
 	# no_decay = ["b ias", "LayerNorm.weight", 'LayerNorm.bias']
 	no_decay = ["bias", "LayerNorm.weight"]
 	optimizer_grouped_parameters = [
 		{
-			"params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
+			"params": [p for n, p in model.named_parameters() if p.requires_grad and not any(nd in n for nd in no_decay)],
 			"weight_decay": weight_decay,
 		},
 		{
-			"params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)],
+			"params": [p for n, p in model.named_parameters() if p.requires_grad and any(nd in n for nd in no_decay)],
 			"weight_decay": 0.0,
 		},
 	]
@@ -51,7 +148,48 @@ def get_optimizers(config: Config, model: nn.Module, num_training_steps: int, we
 	return optimizer, scheduler
 
 
+def get_process_uptime() -> float:
+	"""
+	Seconds since the process started (interpreter start and imports included), None if /proc is not available.
+	"""
+	try:
+		with open("/proc/self/stat", "r") as stat_file:
+			## the fields after the command name, the start time (in clock ticks after boot) is the 22nd field
+			start_ticks = int(stat_file.read().rsplit(")", 1)[1].split()[19])
+		with open("/proc/uptime", "r") as uptime_file:
+			uptime = float(uptime_file.read().split()[0])
+		return uptime - start_ticks / os.sysconf("SC_CLK_TCK")
+	except (OSError, ValueError, IndexError):
+		return None
+
+
+class StartupProfiler:
+	"""
+	Wall time of the startup stages, the stages run in background threads overlap the others.
+	The first stage is the interpreter start and the module imports, from the process start time.
+	"""
+
+	def __init__(self):
+		self.start_time = time.perf_counter()
+		uptime = get_process_uptime()
+		self.stages = [("python + imports", uptime)] if uptime is not None else []
+		self.process_start_time = self.start_time - (uptime or 0.0)
+
+	@contextlib.contextmanager
+	def stage(self, name: str):
+		start_time = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.stages.append((name, time.perf_counter() - start_time))
+
+	def report(self) -> str:
+		lines = [f"{name:<24}{elapsed * 1000:>10.1f} ms" for name, elapsed in self.stages]
+		lines.append(f"{'total (wall)':<24}{(time.perf_counter() - self.process_start_time) * 1000:>10.1f} ms")
+		return "\n".join(lines)
+
+
 if __name__ == '__main__':
 
 	data = read_data("../data/tgt_data.json")
-	write_data(data=data, file="../data/tgt_data.json")
\ No newline at end of file
+	write_data(data=data, file="../data/tgt_data.json")
@@ -0,0 +1,116 @@
+"""
+Debug counter of the host-device synchronizations, used by tests/test_sync_free.py and benchmark_model.py.
+"""
+import warnings
+import torch
+from torch.utils._python_dispatch import TorchDispatchMode
+from transformers import BertConfig
+from src.model.universal_model import UniversalModel
+
+
+class HostSyncCounter(TorchDispatchMode):
+    """
+    Debug counter of the host-device synchronizations inside a `with` block, on any device.
+    The aten operators are inspected below autograd, so the implicit synchronizations are counted as well as the
+    explicit ones: the scalar reads (`.item()`, `bool(tensor)`, `if tensor:`), the operators with a data-dependent
+    output size (`nonzero`, `masked_select`, `unique`, `repeat_interleave` without `output_size`), the boolean mask
+    indexing and assignment, and the copies to the host. `tolist()`, `numpy()` and `cpu()` do not dispatch an
+    operator on a cpu tensor, they are counted on the python accessors.
+    Not detected: the synchronizations inside custom C++/CUDA extensions and the explicit stream or device
+    synchronization calls. On GPU, the synchronizations reported by the CUDA sync debug mode are counted too, so the
+    count can be higher there.
+    """
+    accessors = ["tolist", "numpy", "cpu"]
+    ## output size depends on the data, or the data is read on the host
+    sync_ops = {"_local_scalar_dense", "is_nonzero", "nonzero", "nonzero_static", "masked_select", "unique", "_unique",
+                "_unique2", "unique_dim", "unique_consecutive", "equal", "allclose", "_assert_async"}
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+        self.ops = []
+        self._originals = {}
+        self._catch_warnings = None
+        self._sync_debug_mode = None
+
+    def _record(self, name: str) -> None:
+        self.count += 1
+        self.ops.append(name)
+
+    def _wrap(self, name, original):
+        def counted(tensor, *args, **kwargs):
+            self._record(name)
+            return original(tensor, *args, **kwargs)
+        return counted
+
+    @staticmethod
+    def _has_mask_index(indices) -> bool:
+        return any(isinstance(index, torch.Tensor) and index.dtype in (torch.bool, torch.uint8) for index in indices)
+
+    def __torch_dispatch__(self, func, types, args=(), kwargs=None):
+        kwargs = kwargs or {}
+        name = func.overloadpacket.__name__
+        if name in self.sync_ops:
+            self._record(name)
+        elif name in ("index", "index_put", "index_put_", "_index_put_impl_") and len(args) > 1 and self._has_mask_index(args[1]):
+            self._record(f"{name} (mask)")
+        elif name == "repeat_interleave" and kwargs.get("output_size") is None and \
+                isinstance(args[0], torch.Tensor) and (len(args) == 1 or isinstance(args[1], torch.Tensor)):
+            self._record(name)
+        elif name in ("_to_copy", "copy_") and isinstance(args[0], torch.Tensor):
+            ## a copy between the host and the device
+            source = args[1] if name == "copy_" else args[0]
+            target_device = args[0].device if name == "copy_" else kwargs.get("device", source.device)
+            if isinstance(source, torch.Tensor) and torch.device(target_device).type == "cpu" and source.device.type != "cpu":
+                self._record(name)
+        return func(*args, **kwargs)
+
+    def __enter__(self):
+        for name in self.accessors:
+            self._originals[name] = getattr(torch.Tensor, name)
+            setattr(torch.Tensor, name, self._wrap(name, self._originals[name]))
+        if torch.cuda.is_available():
+            self._sync_debug_mode = torch.cuda.get_sync_debug_mode()
+            torch.cuda.set_sync_debug_mode("warn")
+            self._catch_warnings = warnings.catch_warnings(record=True)
+            self._records = self._catch_warnings.__enter__()
+            warnings.simplefilter("always")
+        return super().__enter__()
+
+    def __exit__(self, *exc):
+        super().__exit__(*exc)
+        for name, original in self._originals.items():
+            setattr(torch.Tensor, name, original)
+        if self._catch_warnings is not None:
+            torch.cuda.set_sync_debug_mode(self._sync_debug_mode)
+            self._catch_warnings.__exit__(*exc)
+            self.count += sum("synchroniz" in str(record.message) for record in self._records)
+        return False
+
+
+def count_training_step_syncs(var_update_mode: str = 'gru', device: str = "cpu") -> int:
+    """
+    Number of host-device synchronizations in one training step (forward, backward, gradient clipping and loss
+    accumulation) of a small random model, after a warm-up step that fills the combination cache.
+    The optimizer step is left out: torch keeps the step counters of Adam on the host.
+    """
+    config = BertConfig(hidden_size=48, num_labels=8, num_hidden_layers=1, num_attention_heads=4, intermediate_size=64, vocab_size=100)
+    model = UniversalModel(config, height=2, constant_num=2, var_update_mode=var_update_mode).to(device).train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    input_ids = torch.randint(1, 100, (2, 10), device=device)
+    variable_indexs_start = torch.tensor([[2, 5], [3, 0]], device=device)
+    batch = dict(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), token_type_ids=torch.zeros_like(input_ids),
+                 variable_indexs_start=variable_indexs_start, variable_indexs_end=variable_indexs_start + 1,
+                 num_variables=torch.tensor([2, 1], device=device), variable_index_mask=torch.tensor([[1, 1], [1, 0]], device=device),
+                 labels=torch.tensor([[[2, 3, 0, 0], [0, 1, 3, 1]], [[0, 2, 1, 1], [0, 0, 0, 0]]], device=device),
+                 label_height_mask=torch.tensor([[1, 1], [1, 0]], device=device))
+    total_loss = torch.zeros((), device=device)
+    for step in range(2):
+        optimizer.zero_grad()
+        with HostSyncCounter() as counter:
+            loss = model(**batch, return_dict=True).loss
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(model.parameters(), 1.0)
+            total_loss += loss.detach()
+        optimizer.step()
+    return counter.count
@@ -0,0 +1,60 @@
+import pytest
+import torch
+from transformers import BertConfig
+from src.model.universal_model import UniversalModel, get_label_rep
+
+
+def make_model(var_update_mode: str) -> UniversalModel:
+    config = BertConfig(hidden_size=48, num_labels=8, num_hidden_layers=1, num_attention_heads=4, intermediate_size=64, vocab_size=100)
+    torch.manual_seed(0)
+    ## eval mode: no dropout, so that both scorings see the same activations
+    return UniversalModel(config, height=3, constant_num=2, var_update_mode=var_update_mode).eval()
+
+
+def make_batch(num_variables: int, batch_size: int = 3, seq_len: int = 20):
+    generator = torch.Generator().manual_seed(num_variables)
+    input_ids = torch.randint(1, 100, (batch_size, seq_len), generator=generator)
+    variable_indexs_start = torch.stack([torch.randperm(seq_len - 2, generator=generator)[:num_variables] + 1 for _ in range(batch_size)])
+    ## the last instance has one variable less
+    num_variable_list = torch.tensor([num_variables] * (batch_size - 1) + [num_variables - 1])
+    variable_index_mask = (torch.arange(num_variables).unsqueeze(0) < num_variable_list.unsqueeze(1)).long()
+    ## height 0 combines two variables, the next heights the new intermediate variable (index 0) with another one
+    labels = torch.tensor([[[1, 2, 0, 0], [0, 1, 3, 0], [0, 2, 5, 1]]] * batch_size)
+    return dict(input_ids=input_ids, attention_mask=torch.ones_like(input_ids), token_type_ids=torch.zeros_like(input_ids),
+                variable_indexs_start=variable_indexs_start, variable_indexs_end=variable_indexs_start,
+                num_variables=num_variable_list, variable_index_mask=variable_index_mask,
+                labels=labels, label_height_mask=torch.ones((batch_size, 3), dtype=torch.long))
+
+
+@pytest.mark.parametrize("num_variables", [2, 5, 12])
+def test_label_rep_parity(num_variables):
+    model = make_model("gru")
+    var_hidden_states = torch.randn(4, num_variables, 48)
+    combination = torch.combinations(torch.arange(num_variables), r=2, with_replacement=True)
+    with torch.no_grad():
+        model.factorized_scoring = False
+        full_label_rep = get_label_rep(model, var_hidden_states, combination)
+        model.factorized_scoring = True
+        factorized_label_rep = get_label_rep(model, var_hidden_states, combination)
+    torch.testing.assert_close(factorized_label_rep, full_label_rep, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("var_update_mode", ["gru", "attn", "none"])
+@pytest.mark.parametrize("num_variables", [2, 5, 12])
+def test_forward_parity(var_update_mode, num_variables):
+    model = make_model(var_update_mode)
+    batch = make_batch(num_variables)
+    outputs = {}
+    with torch.no_grad():
+        for factorized_scoring in [False, True]:
+            model.factorized_scoring = factorized_scoring
+            train_output = model(**batch, return_dict=True)
+            eval_output = model(**{name: value for name, value in batch.items() if name not in ["labels", "label_height_mask"]},
+                                return_dict=True, is_eval=True)
+            outputs[factorized_scoring] = (train_output, eval_output)
+    (full_train, full_eval), (factorized_train, factorized_eval) = outputs[False], outputs[True]
+    torch.testing.assert_close(factorized_train.loss, full_train.loss, rtol=1e-4, atol=1e-4)
+    for factorized_logits, full_logits in zip(factorized_train.all_logits, full_train.all_logits):
+        ## the masked pairs are -inf in both
+        torch.testing.assert_close(factorized_logits, full_logits, rtol=1e-4, atol=1e-4)
+    assert torch.equal(factorized_eval.predictions, full_eval.predictions)
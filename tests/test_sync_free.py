@@ -0,0 +1,31 @@
+import pytest
+import torch
+from tests.sync_counter import HostSyncCounter, count_training_step_syncs
+
+
+@pytest.mark.parametrize("var_update_mode", ["gru", "attn", "none"])
+def test_training_step_has_no_host_sync(var_update_mode):
+    assert count_training_step_syncs(var_update_mode=var_update_mode) == 0
+
+
+@pytest.mark.parametrize("operation", [
+    lambda x: x.sum().item(),
+    lambda x: bool(x[0] > 0),
+    lambda x: x.nonzero(),
+    lambda x: torch.nonzero(x),
+    lambda x: x[x > 0],
+    lambda x: x.clone().masked_fill_(x > 0, 0.0).__setitem__(x > 0, 1.0),
+    lambda x: x.tolist(),
+])
+def test_counter_sees_syncs(operation):
+    x = torch.randn(6)
+    with HostSyncCounter() as counter:
+        operation(x)
+    assert counter.count > 0
+
+
+def test_counter_ignores_device_ops():
+    x = torch.randn(6, requires_grad=True)
+    with HostSyncCounter() as counter:
+        torch.gather(x * 2, 0, torch.tensor([0, 2])).sum().backward()
+    assert counter.count == 0
@@ -1,19 +1,24 @@
-from src.data.universal_dataset import UniversalDataset
+from src.data.universal_dataset import UniversalDataset, StreamingUniversalDataset, UniFeature, add_quant_special_token
 from src.config import Config
 from torch.utils.data import DataLoader
-from transformers import AutoTokenizer, PreTrainedTokenizerFast, AutoModel
+from transformers import AutoTokenizer, PreTrainedTokenizerFast
 from tqdm import tqdm
 import argparse
-from src.utils import get_optimizers, write_data
+from src.utils import get_optimizers, write_data, JsonlWriter, StartupProfiler
 import torch
 import torch.nn as nn
 import numpy as np
 import os
 import random
-from src.model.universal_model import UniversalModel, UniversalModel_Roberta
+import itertools
+import concurrent.futures
+import copy
+import math
+import time
+from src.model.universal_model import UniversalModel, UniversalModel_Roberta, resize_quant_embedding, load_pretrained_fast, GRAD_CHECKPOINT_MODES
 from collections import Counter
-from src.eval.utils import is_value_correct
-from typing import List, Tuple
+from src.eval.utils import is_value_correct, get_num_matrix, compute_values_for_batched_equations, get_grounded_equations
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Tuple
 import logging
 from transformers import set_seed
 
@@ -41,6 +46,10 @@ def parse_arguments(parser:argparse.ArgumentParser):
     # data Hyperparameters
     parser.add_argument('--device', type=str, default="cuda", choices=['cpu', 'cuda:0', 'cuda:1', 'cuda:2', 'cuda:3', 'cuda:4', 'cuda:5', 'cuda:6', 'cuda:7'], help="GPU/CPU devices")
     parser.add_argument('--batch_size', type=int, default=30)
+    parser.add_argument('--bucket_batches', type=int, default=0, choices=[0, 1], help="group the training instances by (length, number of variables, height)")
+    parser.add_argument('--max_batch_tokens', type=int, default=0, help="with bucketing, maximum padded tokens per batch, 0 means fixed batch size")
+    parser.add_argument('--max_batch_combinations', type=int, default=0, help="with bucketing, maximum padded variable pairs x heights per batch, 0 means no limit")
+    parser.add_argument('--pin_memory', type=int, default=0, choices=[0, 1], help="collate the batches into pinned memory for faster host to device copies")
     parser.add_argument('--train_num', type=int, default=-1, help="The number of training data, -1 means all data")
     parser.add_argument('--dev_num', type=int, default=-1, help="The number of development data, -1 means all data")
     parser.add_argument('--test_num', type=int, default=-1, help="The number of development data, -1 means all data")
@@ -50,6 +59,12 @@ def parse_arguments(parser:argparse.ArgumentParser):
     parser.add_argument('--dev_file', type=str, default="data/task_dataset/math23k_valset.json")
     parser.add_argument('--test_file', type=str, default="data/task_dataset/math23k_test.json")
 
+    parser.add_argument('--quant_special_token', type=int, default=0, choices=[0, 1], help="add \"<quant>\" as a single special token instead of its subwords")
+    parser.add_argument('--streaming', type=int, default=0, choices=[0, 1], help="read and tokenize the data files on the fly (json array or jsonl), for large corpora. The training instances are not shuffled, every epoch runs in the file order (shuffle the file beforehand); the file is read once more to count the instances for the learning rate schedule, the counts are kept in --feature_cache_dir if set")
+    parser.add_argument('--feature_cache_dir', type=str, default="none", help="folder of the pre-tokenized feature cache (e.g. cache/features), tokenized once and memory-mapped by the later runs; \"none\" tokenizes at every run")
+    parser.add_argument('--grad_checkpoint', type=str, default="none", choices=GRAD_CHECKPOINT_MODES, help="recompute the activations of the encoder layers, of the pair scoring of each height, or both, during backward to save memory")
+    parser.add_argument('--freeze_encoder', type=int, default=0, choices=[0, 1], help="freeze the encoder and only train the deductive head, on variable hidden states encoded once and cached")
+    parser.add_argument('--hidden_state_cache_dir', type=str, default="cache/hidden_states", help="folder of the cached variable hidden states of --freeze_encoder")
     parser.add_argument('--train_filtered_steps', default=None, nargs='+', help="some heights to filter")
     parser.add_argument('--test_filtered_steps', default=None, nargs='+', help="some heights to filter")
 
@@ -66,11 +81,18 @@ def parse_arguments(parser:argparse.ArgumentParser):
     parser.add_argument('--train_max_height', type=int, default=100, help="the maximum height for training data")
 
     parser.add_argument('--var_update_mode', type=str, default="gru", help="variable update mode")
+    parser.add_argument('--factorized_scoring', type=int, default=0, choices=[0, 1], help="project each variable once instead of every variable pair")
+    parser.add_argument('--incremental_scoring', type=int, default=0, choices=[0, 1], help="reuse the pair scores of previous heights, only without variable update")
+    parser.add_argument('--quantize', type=str, default="none", choices=["none", "int8"], help="dynamic int8 quantization of the Linear layers for CPU inference")
+    parser.add_argument('--quantized_cache_dir', type=str, default="none", help="folder of the saved int8 checkpoints, keyed on the fp32 weights and the model arguments, \"none\" quantizes at every load")
 
     # training
     parser.add_argument('--mode', type=str, default="train", choices=["train", "test"], help="learning rate of the AdamW optimizer")
     parser.add_argument('--learning_rate', type=float, default=2e-5, help="learning rate of the AdamW optimizer")
     parser.add_argument('--max_grad_norm', type=float, default=1.0, help="The maximum gradient norm")
+    parser.add_argument('--gradient_accumulation_steps', type=int, default=1, help="the number of batches per optimizer step")
+    parser.add_argument('--step_tokens', type=int, default=0, help="accumulate the batches until the step has this many (unpadded) tokens, 0 means no budget")
+    parser.add_argument('--step_combinations', type=int, default=0, help="accumulate the batches until the step has this many (unpadded) variable pairs x heights, 0 means no budget")
     parser.add_argument('--num_epochs', type=int, default=20, help="The number of epochs to run")
     parser.add_argument('--fp16', type=int, default=0, choices=[0,1], help="using fp16 to train the model")
 
@@ -78,10 +100,17 @@ def parse_arguments(parser:argparse.ArgumentParser):
 
     # testing a pretrained model
     parser.add_argument('--cut_off', type=float, default=-100, help="cut off probability that we don't want to answer")
+    parser.add_argument('--early_exit', type=int, default=0, choices=[0, 1], help="stop decoding a batch once every instance predicts stop")
     parser.add_argument('--print_error', type=int, default=0, choices=[0, 1], help="whether to print the errors")
     parser.add_argument('--error_file', type=str, default="results/error.json", help="The file to print the errors")
     parser.add_argument('--result_file', type=str, default="results/res.json",
                         help="The file to print the errors")
+    parser.add_argument('--gzip_results', type=int, default=0, choices=[0, 1], help="gzip the json lines of the results and errors")
+    parser.add_argument('--answer_cache_size', type=int, default=0, help="the number of predicted equations cached in memory for inference, 0 to disable")
+    parser.add_argument('--answer_cache_ttl', type=float, default=0, help="seconds before a cached equation expires, 0 means never")
+    parser.add_argument('--answer_cache_file', type=str, default="", help="sqlite file that keeps the cached equations across restarts, empty for memory only")
+    parser.add_argument('--quantize_report', type=int, default=0, choices=[0, 1], help="compare the answers and latency of the int8 model with fp32")
+    parser.add_argument('--profile_startup', type=int, default=0, choices=[0, 1], help="print the time of the startup stages before the inference")
 
     args = parser.parse_args()
     # Print out the arguments
@@ -90,26 +119,129 @@ def parse_arguments(parser:argparse.ArgumentParser):
     return args
 
 
+def get_dataset(config: Config, file: str, number: int, filtered_steps: List, data_max_height: int, **kwargs):
+    """
+    :param kwargs: tokenizer, uni_labels, constant2id, constant_values and pretrained_model_name of the dataset
+    """
+    if config.streaming:
+        ## one batch per shard, so the batches of the workers come in the file order
+        return StreamingUniversalDataset(file=file, number=number, shard_size=config.batch_size, counts_cache_dir=config.feature_cache_dir, **kwargs)
+    return UniversalDataset(file=file, number=number, filtered_steps=filtered_steps, data_max_height=data_max_height,
+                            feature_cache_dir=config.feature_cache_dir, **kwargs)
+
+def get_accumulation_setting(config: Config) -> str:
+    if config.step_tokens > 0 or config.step_combinations > 0:
+        budgets = [f"{budget} {name}" for budget, name in [(config.step_tokens, "tokens"), (config.step_combinations, "combinations")] if budget > 0]
+        return f"batches of {config.batch_size} accumulated up to {' or '.join(budgets)} per step"
+    return f"batches of {config.batch_size} x {config.gradient_accumulation_steps} per step"
+
+
+def group_micro_batches(micro_batches: Iterable, get_cost: Callable[[Any], Tuple[int, int]], config: Config) -> Iterator[List]:
+    """
+    Group the batches of each optimizer step: `gradient_accumulation_steps` batches or, with a budget, as many batches
+    as needed for the step to reach `step_tokens` tokens or `step_combinations` (pair x height). The last step of an
+    epoch can be smaller.
+    :param get_cost: the (tokens, combinations) of a batch
+    """
+    use_budget = config.step_tokens > 0 or config.step_combinations > 0
+    group = []
+    tokens = combinations = 0
+    for micro_batch in micro_batches:
+        group.append(micro_batch)
+        batch_tokens, batch_combinations = get_cost(micro_batch)
+        tokens += batch_tokens
+        combinations += batch_combinations
+        if use_budget:
+            complete = (config.step_tokens > 0 and tokens >= config.step_tokens) or \
+                       (config.step_combinations > 0 and combinations >= config.step_combinations)
+        else:
+            complete = len(group) >= config.gradient_accumulation_steps
+        if complete:
+            yield group
+            group = []
+            tokens = combinations = 0
+    if len(group) > 0:
+        yield group
+
+
+def get_feature_cost(feature: UniFeature, constant_num: int) -> Tuple[int, int]:
+    from src.data.bucket_sampler import get_instance_costs
+    ## from the host tensors of the collated batch, before they are copied to the device
+    tokens, combinations = get_instance_costs(feature.attention_mask.sum(dim=-1).numpy(), feature.num_variables.numpy(),
+                                              feature.label_height_mask.sum(dim=-1).numpy(), constant_num)
+    return int(tokens.sum()), int(combinations.sum())
+
+
+def get_num_training_steps(train_dataloader: DataLoader, num_epochs: int, config: Config, constant_num: int) -> Tuple[List[int], bool]:
+    """
+    The number of optimizer steps of each epoch, for the learning rate schedule.
+    The steps are exact without a budget or with the bucket batches (their order is known in advance), otherwise it is
+    an upper bound: every step but the last one of an epoch reaches one of the budgets.
+    :return: the steps of each epoch, and whether they are exact
+    """
+    from src.data.bucket_sampler import BucketBatchSampler, get_instance_costs
+    if config.step_tokens <= 0 and config.step_combinations <= 0:
+        return [math.ceil(len(train_dataloader) / config.gradient_accumulation_steps)] * num_epochs, True
+    sampler = train_dataloader.batch_sampler
+    if isinstance(sampler, BucketBatchSampler):
+        tokens, combinations = get_instance_costs(sampler.lengths, sampler.num_variables, sampler.heights, sampler.constant_num)
+        ## a copy, the epochs of the training sampler are not advanced
+        planner = copy.copy(sampler)
+        steps = []
+        for epoch in range(num_epochs):
+            planner.set_epoch(sampler.epoch + epoch)
+            steps.append(sum(1 for _ in group_micro_batches(planner.get_batches(), lambda batch: (int(tokens[batch].sum()), int(combinations[batch].sum())), config)))
+        return steps, True
+    max_steps = len(train_dataloader)
+    if isinstance(train_dataloader.dataset, UniversalDataset):
+        tokens, combinations = get_instance_costs(*train_dataloader.dataset.get_sizes(), constant_num)
+        max_steps = min(max_steps, 1 + (int(tokens.sum()) // config.step_tokens if config.step_tokens > 0 else 0) +
+                        (int(combinations.sum()) // config.step_combinations if config.step_combinations > 0 else 0))
+    return [max_steps] * num_epochs, False
+
+
 def train(config: Config, train_dataloader: DataLoader, num_epochs: int,
           bert_model_name: str, num_labels: int,
           dev: torch.device, tokenizer: PreTrainedTokenizerFast, valid_dataloader: DataLoader = None, test_dataloader: DataLoader = None,
           constant_values: List = None, res_file:str = None, error_file:str = None):
-
-    gradient_accumulation_steps = 1
-    t_total = int(len(train_dataloader) // gradient_accumulation_steps * num_epochs)
+    ## only needed for training, not imported by the test mode and the inference scripts
+    from src.data.bucket_sampler import BucketBatchSampler, get_random_padding_report
+    from src.model.hidden_state_store import get_hidden_state_store
+    from src.model.universal_model import enable_grad_checkpoint
 
     constant_num = len(constant_values) if constant_values else 0
+    accumulation_setting = get_accumulation_setting(config)
+    epoch_steps, exact_steps = get_num_training_steps(train_dataloader, num_epochs, config, constant_num)
+    t_total = sum(epoch_steps)
+    accumulate = config.gradient_accumulation_steps > 1 or config.step_tokens > 0 or config.step_combinations > 0
+    logger.info(f"[Train Info] {accumulation_setting}, {'' if exact_steps else 'at most '}{t_total} optimizer steps in {num_epochs} epochs")
     MODEL_CLASS = class_name_2_model[bert_model_name]
     model = MODEL_CLASS.from_pretrained(bert_model_name,
                                            num_labels=num_labels,
                                            height=config.height,
                                            constant_num=constant_num,
-                                            var_update_mode=config.var_update_mode, return_dict=True).to(dev)
+                                            var_update_mode=config.var_update_mode,
+                                            factorized_scoring=config.factorized_scoring,
+                                            incremental_scoring=config.incremental_scoring,
+                                            quant_special_token=config.quant_special_token, return_dict=True).to(dev)
+    if config.quant_special_token:
+        resize_quant_embedding(model, tokenizer, config.quant_subword_ids)
+    enable_grad_checkpoint(model, config.grad_checkpoint)
 
     scaler = None
     if config.fp16:
         scaler = torch.cuda.amp.GradScaler(enabled=bool(config.fp16))
 
+    if config.freeze_encoder:
+        ## the encoder only runs once over the training data, the head is trained on its stored variable representations
+        assert not config.streaming, "--freeze_encoder needs the in-memory dataset"
+        for param in model.base_model.parameters():
+            param.requires_grad = False
+        var_hidden_states = get_hidden_state_store(model, train_dataloader.dataset, config.hidden_state_cache_dir,
+                                                   name=os.path.splitext(os.path.basename(config.train_file))[0],
+                                                   batch_size=config.batch_size, device=dev)
+        train_dataloader.dataset.set_hidden_states(var_hidden_states)
+
     optimizer, scheduler = get_optimizers(config, model, t_total)
     model.zero_grad()
 
@@ -117,26 +249,51 @@ def train(config: Config, train_dataloader: DataLoader, num_epochs: int,
     os.makedirs(f"model_files/{config.model_folder}", exist_ok=True)
 
     for epoch in range(num_epochs):
-        total_loss = 0
+        ## accumulated on device, only copied to the host when logging
+        total_loss = torch.zeros((), device=dev)
         model.train()
-        for iter, feature in tqdm(enumerate(train_dataloader, 1), desc="--training batch", total=len(train_dataloader)):
-            optimizer.zero_grad()
-            with torch.cuda.amp.autocast(enabled=bool(config.fp16)):
-                loss = model(input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
-                             token_type_ids=feature.token_type_ids.to(dev),
-                             variable_indexs_start=feature.variable_indexs_start.to(dev),
-                             variable_indexs_end=feature.variable_indexs_end.to(dev),
-                             num_variables = feature.num_variables.to(dev),
-                             variable_index_mask= feature.variable_index_mask.to(dev),
-                             labels=feature.labels.to(dev), label_height_mask= feature.label_height_mask.to(dev),
-                             return_dict=True).loss
+        if isinstance(train_dataloader.batch_sampler, BucketBatchSampler):
+            batch_sampler = train_dataloader.batch_sampler
+            report = batch_sampler.get_padding_report()
+            logger.info(f"[Data Info] epoch {epoch} batches: {report['batches']}, padding waste: tokens {report['tokens_waste']:.2%}, "
+                        f"combinations {report['combinations_waste']:.2%}, heights {report['heights_waste']:.2%}")
+            if batch_sampler.pool_multiplier > 1:
+                ## pools of one batch are the shuffled batches already
+                random_report = get_random_padding_report(batch_sampler)
+                logger.info(f"[Data Info] epoch {epoch} shuffled batches of {batch_sampler.batch_size}, padding waste: tokens {random_report['tokens_waste']:.2%}, "
+                            f"combinations {random_report['combinations_waste']:.2%}, heights {random_report['heights_waste']:.2%}")
+        epoch_start = time.time()
+        num_steps = num_instances = num_tokens = iter = 0
+        for step_features in tqdm(group_micro_batches(train_dataloader, lambda feature: get_feature_cost(feature, constant_num), config),
+                                  desc="--training step", total=epoch_steps[epoch]):
+            ## the loss is summed over the instances, the accumulated loss is rescaled to the one of `batch_size` instances,
+            ## so that the gradient scale does not depend on how many instances fall into a step
+            step_instances = sum(len(feature.num_variables) for feature in step_features)
+            loss_scale = config.batch_size / step_instances if accumulate else 1.0
+            for feature in step_features:
+                iter += 1
+                with torch.cuda.amp.autocast(enabled=bool(config.fp16)):
+                    loss = model(input_ids=feature.input_ids.to(dev, non_blocking=True), attention_mask=feature.attention_mask.to(dev, non_blocking=True),
+                                 token_type_ids=feature.token_type_ids.to(dev, non_blocking=True),
+                                 variable_indexs_start=feature.variable_indexs_start.to(dev, non_blocking=True),
+                                 variable_indexs_end=feature.variable_indexs_end.to(dev, non_blocking=True),
+                                 num_variables = feature.num_variables.to(dev, non_blocking=True),
+                                 variable_index_mask= feature.variable_index_mask.to(dev, non_blocking=True),
+                                 labels=feature.labels.to(dev, non_blocking=True), label_height_mask= feature.label_height_mask.to(dev, non_blocking=True),
+                                 return_dict=True,
+                                 var_hidden_states=feature.var_hidden_states.to(dev, non_blocking=True) if feature.var_hidden_states is not None else None).loss
+                if config.fp16:
+                    scaler.scale(loss * loss_scale).backward()
+                else:
+                    (loss * loss_scale).backward()
+                total_loss += loss.detach()
+                num_tokens += int(feature.attention_mask.sum())
+                if iter % 1000 == 0:
+                    logger.info(f"epoch: {epoch}, iteration: {iter}, current mean loss: {total_loss.item()/iter:.2f}")
+            ## once per step, on the accumulated gradients
             if config.fp16:
-                scaler.scale(loss).backward()
                 scaler.unscale_(optimizer)
-            else:
-                loss.backward()
             torch.nn.utils.clip_grad_norm_(model.parameters(), config.max_grad_norm)
-            total_loss += loss.item()
             if config.fp16:
                 scaler.step(optimizer)
                 scaler.update()
@@ -144,15 +301,23 @@ def train(config: Config, train_dataloader: DataLoader, num_epochs: int,
                 optimizer.step()
             scheduler.step()
             model.zero_grad()
-            if iter % 1000 == 0:
-                logger.info(f"epoch: {epoch}, iteration: {iter}, current mean loss: {total_loss/iter:.2f}")
-        logger.info(f"Finish epoch: {epoch}, loss: {total_loss:.2f}, mean loss: {total_loss/len(train_dataloader):.2f}")
+            num_steps += 1
+            num_instances += step_instances
+        epoch_time = time.time() - epoch_start
+        total_loss = total_loss.item()
+        logger.info(f"Finish epoch: {epoch}, loss: {total_loss:.2f}, mean loss: {total_loss/max(iter, 1):.2f}")
+        logger.info(f"[Train Info] epoch {epoch} ({accumulation_setting}): {num_steps} optimizer steps, {iter} batches, "
+                    f"{num_instances / max(num_steps, 1):.1f} instances/step, {num_instances / epoch_time:.1f} instances/s, "
+                    f"{num_tokens / epoch_time:.0f} tokens/s")
         if valid_dataloader is not None:
-            equ_acc, val_acc_performance = evaluate(valid_dataloader, model, dev, uni_labels=config.uni_labels, fp16=bool(config.fp16), constant_values=constant_values)
+            equ_acc, val_acc_performance = evaluate(valid_dataloader, model, dev, uni_labels=config.uni_labels, fp16=bool(config.fp16), constant_values=constant_values,
+                                                    early_exit=config.early_exit)
             test_equ_acc, test_val_acc = -1, -1
             if test_dataloader is not None:
                 test_equ_acc, test_val_acc = evaluate(test_dataloader, model, dev, uni_labels=config.uni_labels, fp16=bool(config.fp16), constant_values=constant_values,
-                         res_file=res_file, err_file=error_file)
+                         res_file=res_file, err_file=error_file, early_exit=config.early_exit)
+            logger.info(f"[Train Info] epoch {epoch} ({accumulation_setting}): valid_equ: {equ_acc:.6f}, valid_val: {val_acc_performance:.6f}, "
+                        f"test_equ: {test_equ_acc:.6f}, test_val: {test_val_acc:.6f}")
             if val_acc_performance > best_val_acc_performance:
                 logger.info(f"[Model Info] Saving the best model with best valid val acc {val_acc_performance:.6f} at epoch {epoch} ("
                             f"valid_equ: {equ_acc:.6f}, valid_val: {val_acc_performance:.6f}"
@@ -166,118 +331,132 @@ def train(config: Config, train_dataloader: DataLoader, num_epochs: int,
     model = MODEL_CLASS.from_pretrained(f"model_files/{config.model_folder}",
                                            num_labels=num_labels,
                                            height=config.height,
-                                           constant_num=constant_num, var_update_mode=config.var_update_mode).to(dev)
+                                           constant_num=constant_num, var_update_mode=config.var_update_mode,
+                                           factorized_scoring=config.factorized_scoring,
+                                           incremental_scoring=config.incremental_scoring,
+                                           quant_special_token=config.quant_special_token).to(dev)
     if config.fp16:
         model.half()
         model.save_pretrained(f"model_files/{config.model_folder}")
         tokenizer.save_pretrained(f"model_files/{config.model_folder}")
     return model
 
-def get_batched_prediction_consider_multiple_m0(feature, all_logits: torch.FloatTensor, constant_num: int):
-    batch_size, max_num_variable = feature.variable_indexs_start.size()
-    device = feature.variable_indexs_start.device
-    batched_prediction = [[] for _ in range(batch_size)]
-    for k, logits in enumerate(all_logits):
-        current_max_num_variable = max_num_variable + constant_num + k
-        num_var_range = torch.arange(0, current_max_num_variable, device=feature.variable_indexs_start.device)
-        combination = torch.combinations(num_var_range, r=2, with_replacement=True)  ##number_of_combinations x 2
-        num_combinations, _ = combination.size()
-
-        best_temp_logits, best_temp_stop_label = logits.max(dim=-1)  ## batch_size, num_combinations/num_m0, num_labels
-        best_temp_score, best_temp_label = best_temp_logits.max(dim=-1)  ## batch_size, num_combinations
-        best_m0_score, best_comb = best_temp_score.max(dim=-1)  ## batch_size
-        best_label = torch.gather(best_temp_label, 1, best_comb.unsqueeze(-1)).squeeze(-1)  ## batch_size
-        b_idxs = [bidx for bidx in range(batch_size)]
-        best_stop_label = best_temp_stop_label[b_idxs, best_comb, best_label] ## batch size
-
-        # batch_size x 2
-        best_comb_var_idxs = torch.gather(combination.unsqueeze(0).expand(batch_size, num_combinations, 2), 1,
-                                          best_comb.unsqueeze(1).unsqueeze(2).expand(batch_size, 1, 2).to(device)).squeeze(1)
-        best_comb_var_idxs = best_comb_var_idxs.cpu().numpy()
-        best_labels = best_label.cpu().numpy()
-        curr_best_stop_labels = best_stop_label.cpu().numpy()
-        for b_idx, (best_comb_idx, best_label, stop_label) in enumerate(zip(best_comb_var_idxs, best_labels, curr_best_stop_labels)):  ## within each instances:
-            left, right = best_comb_idx
-            curr_label = [left, right, best_label, stop_label]
-            batched_prediction[b_idx].append(curr_label)
-    return batched_prediction
+def get_padded_steps(steps: torch.LongTensor) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Truncate the steps at the first stop on the device, then copy them to the host at once.
+    :param steps: (batch_size, height, 4) (left_var_index, right_var_index, label_index, stop_label)
+    :return: padded_steps: (batch_size, height, 4), the steps after the first stop are filled with -1
+             lengths: (batch_size), the number of steps up to the first stop (included), height if there is no stop
+    """
+    batch_size, height, _ = steps.size()
+    is_stop = steps[:, :, 3] == 1
+    lengths = torch.where(is_stop.any(dim=-1), is_stop.int().argmax(dim=-1) + 1, torch.full_like(steps[:, 0, 3], height))
+    step_range = torch.arange(0, height, device=steps.device)
+    padded_steps = steps.masked_fill((step_range.unsqueeze(0) >= lengths.unsqueeze(1)).unsqueeze(-1), -1)
+    ## single transfer of the steps and the lengths
+    packed = torch.cat([padded_steps.view(batch_size, -1), lengths.unsqueeze(-1)], dim=-1).cpu().numpy()
+    return packed[:, :-1].reshape(batch_size, height, 4), packed[:, -1]
+
+
+def concat_padded_steps(batched_steps: List[np.ndarray]) -> np.ndarray:
+    """
+    :param batched_steps: list of (batch_size, height, 4) padded with -1, height can differ between batches
+    :return: (total_size, max_height, 4) padded with -1
+    """
+    max_height = max(steps.shape[1] for steps in batched_steps)
+    return np.concatenate([np.pad(steps, ((0, 0), (0, max_height - steps.shape[1]), (0, 0)), constant_values=-1) for steps in batched_steps])
+
+
+def is_equation_correct(padded_predictions: np.ndarray, padded_labels: np.ndarray) -> np.ndarray:
+    """
+    :param padded_predictions: (batch_size, height, 4), padded with -1 after the first stop
+    :param padded_labels: (batch_size, label_height, 4), padded with -1 after the first stop
+    :return: (batch_size) whether all the predicted steps are the same as the labels
+    """
+    batch_size, height, _ = padded_predictions.shape
+    _, label_height, _ = padded_labels.shape
+    max_height = max(height, label_height)
+    padded_predictions = np.pad(padded_predictions, ((0, 0), (0, max_height - height), (0, 0)), constant_values=-1)
+    padded_labels = np.pad(padded_labels, ((0, 0), (0, max_height - label_height), (0, 0)), constant_values=-1)
+    return (padded_predictions == padded_labels).reshape(batch_size, -1).all(axis=-1)
+
+
+def get_batched_prediction_consider_multiple_m0(predictions: torch.LongTensor) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    :param predictions: (batch_size, height, 4) (left_var_index, right_var_index, label_index, stop_label), decoded by the model
+    :return: the predicted steps padded with -1 after the first stop, and the number of steps of each instance
+    """
+    return get_padded_steps(predictions)
 
 
 def evaluate(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device, fp16:bool, constant_values: List, uni_labels:List,
-             res_file: str= None, err_file:str = None) -> Tuple[float, float]:
+             res_file: str= None, err_file:str = None, early_exit: bool = False) -> Tuple[float, float]:
+    """
+    The predictions are scored batch by batch, the annotated instances are written to `res_file`/`err_file` as json lines
+    (gzip compressed for ".gz" files) by background writers, so that nothing is kept for the whole dataset.
+    """
     model.eval()
-    predictions = []
-    labels = []
-    constant_num = len(constant_values) if constant_values else 0
+    insts = iter(valid_dataloader.dataset.insts)
+    number_instances_remove = valid_dataloader.dataset.number_instances_remove
+    res_writer = JsonlWriter(res_file) if res_file is not None else None
+    err_writer = JsonlWriter(err_file) if err_file is not None else None
+    total = 0
+    corr = 0
+    val_corr = 0
+    num_label_step_corr = Counter()
+    num_label_step_total = Counter()
+    num_label_step_val_corr = Counter()
     with torch.no_grad():
         for index, feature in tqdm(enumerate(valid_dataloader), desc="--validation", total=len(valid_dataloader)):
             with torch.cuda.amp.autocast(enabled=fp16):
                 module = model.module if hasattr(model, 'module') else model
-                all_logits = module(input_ids=feature.input_ids.to(dev), attention_mask=feature.attention_mask.to(dev),
-                             token_type_ids=feature.token_type_ids.to(dev),
-                             variable_indexs_start=feature.variable_indexs_start.to(dev),
-                             variable_indexs_end=feature.variable_indexs_end.to(dev),
-                             num_variables = feature.num_variables.to(dev),
-                             variable_index_mask= feature.variable_index_mask.to(dev),
-                             labels=feature.labels.to(dev), label_height_mask= feature.label_height_mask.to(dev),
-                             return_dict=True, is_eval=True).all_logits
-                batched_prediction = get_batched_prediction_consider_multiple_m0(feature=feature, all_logits=all_logits, constant_num=constant_num)
-                for b, inst_predictions in enumerate(batched_prediction):
-                    for p, prediction_step in enumerate(inst_predictions):
-                        left, right, op_id, stop_id = prediction_step
-                        if stop_id == 1:
-                            batched_prediction[b] = batched_prediction[b][:(p+1)]
-                            break
-                batched_labels = feature.labels.cpu().numpy().tolist()
-                for b, inst_labels in enumerate(batched_labels):
-                    for p, label_step in enumerate(inst_labels):
-                        left, right, op_id, stop_id = label_step
-                        if stop_id == 1:
-                            batched_labels[b] = batched_labels[b][:(p+1)]
-                            break
-
-                predictions.extend(batched_prediction)
-                labels.extend(batched_labels)
-    corr = 0
-    num_label_step_corr = Counter()
-    num_label_step_total = Counter()
-    insts = valid_dataloader.dataset.insts
-    number_instances_remove = valid_dataloader.dataset.number_instances_remove
-    for inst_predictions, inst_labels in zip(predictions, labels):
-        num_label_step_total[len(inst_labels)] += 1
-        if len(inst_predictions) != len(inst_labels):
-            continue
-        is_correct = True
-        for prediction_step, label_step in zip(inst_predictions, inst_labels):
-            if prediction_step != label_step:
-                is_correct = False
-                break
-        if is_correct:
-            num_label_step_corr[len(inst_labels)] += 1
-            corr += 1
-    total = len(labels)
+                output = module(input_ids=feature.input_ids.to(dev, non_blocking=True), attention_mask=feature.attention_mask.to(dev, non_blocking=True),
+                             token_type_ids=feature.token_type_ids.to(dev, non_blocking=True),
+                             variable_indexs_start=feature.variable_indexs_start.to(dev, non_blocking=True),
+                             variable_indexs_end=feature.variable_indexs_end.to(dev, non_blocking=True),
+                             num_variables = feature.num_variables.to(dev, non_blocking=True),
+                             variable_index_mask= feature.variable_index_mask.to(dev, non_blocking=True),
+                             labels=feature.labels.to(dev, non_blocking=True), label_height_mask= feature.label_height_mask.to(dev, non_blocking=True),
+                             return_dict=True, is_eval=True, early_exit=early_exit)
+            predictions, prediction_lengths = get_batched_prediction_consider_multiple_m0(predictions=output.predictions)
+            labels, label_lengths = get_padded_steps(feature.labels)
+            equation_corrects = is_equation_correct(predictions, labels)
+
+            ##value accuarcy
+            batch_insts = list(itertools.islice(insts, len(prediction_lengths)))
+            num_matrix = get_num_matrix([inst["num_list"] for inst in batch_insts])
+            predict_values, pred_step_results = compute_values_for_batched_equations(predictions, prediction_lengths, num_matrix, uni_labels=uni_labels, constant_values=constant_values)
+            gold_values, gold_step_results = compute_values_for_batched_equations(labels, label_lengths, num_matrix, uni_labels=uni_labels, constant_values=constant_values)
+            err = []
+            for idx, inst in enumerate(batch_insts):
+                label_length = int(label_lengths[idx])
+                num_label_step_total[label_length] += 1
+                if equation_corrects[idx]:
+                    num_label_step_corr[label_length] += 1
+                    corr += 1
+                predict_value, gold_value = float(predict_values[idx]), float(gold_values[idx])
+                is_value_corr = is_value_correct(predict_value, gold_value)
+                if is_value_corr:
+                    num_label_step_val_corr[label_length] += 1
+                    val_corr += 1
+                else:
+                    err.append(inst)
+                inst["predict_value"] = predict_value
+                inst["gold_value"] = gold_value
+                inst['pred_ground_equation'] = get_grounded_equations(pred_step_results[idx], predictions[idx], prediction_lengths[idx], uni_labels)
+                inst['gold_ground_equation'] = get_grounded_equations(gold_step_results[idx], labels[idx], label_lengths[idx], uni_labels)
+            total += len(batch_insts)
+            if res_writer is not None:
+                res_writer.write(batch_insts)
+            if err_writer is not None and len(err) > 0:
+                err_writer.write(err)
+    if res_writer is not None:
+        res_writer.close()
+    if err_writer is not None:
+        err_writer.close()
     adjusted_total = total + number_instances_remove
     acc = corr*1.0/adjusted_total
     logger.info(f"[Info] Equation accuracy: {acc*100:.2f}%, total: {total}, corr: {corr}, adjusted_total: {adjusted_total}")
-
-    ##value accuarcy
-    val_corr = 0
-    num_label_step_val_corr = Counter()
-    err = []
-    corr = 0
-    for inst_predictions, inst_labels, inst in zip(predictions, labels, insts):
-        num_list = inst["num_list"]
-        is_value_corr, predict_value, gold_value, pred_ground_equation, gold_ground_equation = is_value_correct(inst_predictions, inst_labels, num_list, num_constant=constant_num, uni_labels=uni_labels, constant_values=constant_values)
-        val_corr += 1 if is_value_corr else 0
-        if is_value_corr:
-            num_label_step_val_corr[len(inst_labels)] += 1
-            corr += 1
-        else:
-            err.append(inst)
-        inst["predict_value"] = predict_value
-        inst["gold_value"] = gold_value
-        inst['pred_ground_equation'] = pred_ground_equation
-        inst['gold_ground_equation'] = gold_ground_equation
     val_acc = val_corr * 1.0 / adjusted_total
     logger.info(f"[Info] Value accuracy: {val_acc * 100:.2f}%, total: {total}, corr: {val_corr}, adjusted_total: {adjusted_total}")
     for key in num_label_step_total:
@@ -285,93 +464,131 @@ def evaluate(valid_dataloader: DataLoader, model: nn.Module, dev: torch.device,
         curr_val_corr = num_label_step_val_corr[key]
         curr_total = num_label_step_total[key]
         logger.info(f"[Info] step num: {key} Acc.:{curr_corr*1.0/curr_total * 100:.2f} ({curr_corr}/{curr_total}) val acc: {curr_val_corr*1.0/curr_total * 100:.2f} ({curr_val_corr}/{curr_total})")
-    if res_file is not None:
-        write_data(file=res_file, data=insts)
-    if err_file is not None:
-        write_data(file=err_file, data=err)
     return acc, val_acc
 
-def main():
-    parser = argparse.ArgumentParser(description="classificaton")
-    opt = parse_arguments(parser)
-    set_seed(opt.seed)
-    conf = Config(opt)
-    os.makedirs("results", exist_ok=True)
-    bert_model_name = conf.bert_model_name if conf.bert_folder == "" or conf.bert_folder=="none" else f"{conf.bert_folder}/{conf.bert_model_name}"
-
-    tokenizer = AutoTokenizer.from_pretrained(bert_model_name, use_fast=True)
-
-
+def get_task_constants(train_file: str) -> Tuple[List[str], Dict[str, int], List[float]]:
+    """
+    The operation labels and the constants of the dataset, decided by the name of the training file.
+    :return: uni_labels, constant2id and constant_values (None if the dataset has no constant)
+    """
     uni_labels = [
         '+', '-', '-_rev', '*', '/', '/_rev'
     ]
-    num_labels = 6
-    conf.uni_labels = uni_labels
-    if "23k" in conf.train_file:
+    if "23k" in train_file:
         constant2id = {"1": 0, "PI": 1}
-        conf.uni_labels = conf.uni_labels + ['^', '^_rev']
-        num_labels = len(conf.uni_labels)
+        uni_labels = uni_labels + ['^', '^_rev']
         constant_values = [1.0, 3.14]
-        constant_number = len(constant_values)
-    elif "svamp" in conf.train_file:
+    elif "svamp" in train_file:
         constants = ['1.0', '0.1', '3.0', '5.0', '0.5', '12.0', '4.0', '60.0', '25.0', '0.01', '0.05', '2.0',
                      '10.0', '0.25', '8.0', '7.0', '100.0']
         constant2id = {c: idx for idx, c in enumerate(constants)}
         constant_values = [float(c) for c in constants]
-        constant_number = len(constant_values)
-    elif "mawps" in conf.train_file:
+    elif "mawps" in train_file:
         constants = ['12.0', '1.0', '7.0', '60.0', '2.0', '5.0', '100.0', '8.0', '0.1', '0.5', '0.01', '25.0', '4.0', '3.0', '0.25']
-        if conf.train_file.split(".")[-2][-1] in ["0", "1", "2", "3", "4", "5"]:  ## 5 fold trainning
+        if train_file.split(".")[-2][-1] in ["0", "1", "2", "3", "4", "5"]:  ## 5 fold trainning
             constants += ['10.0', '0.05']
         constant2id = {c: idx for idx, c in enumerate(constants)}
         constant_values = [float(c) for c in constants]
-        constant_number = len(constant_values)
-    elif "MathQA" in conf.train_file:
+    elif "MathQA" in train_file:
         constants = ['100.0', '1.0', '2.0', '3.0', '4.0', '10.0', '1000.0', '60.0', '0.5', '3600.0', '12.0', '0.2778', '3.1416', '3.6', '0.25', '5.0', '6.0', '360.0', '52.0', '180.0']
-        conf.uni_labels = conf.uni_labels + ['^', '^_rev']
-        num_labels = len(conf.uni_labels)
+        uni_labels = uni_labels + ['^', '^_rev']
         constant2id = {c: idx for idx, c in enumerate(constants)}
         constant_values = [float(c) for c in constants]
-        constant_number = len(constant_values)
     else:
         constant2id = None
         constant_values = None
-        constant_number = 0
+    return uni_labels, constant2id, constant_values
+
+def main():
+    profiler = StartupProfiler()
+    parser = argparse.ArgumentParser(description="classificaton")
+    opt = parse_arguments(parser)
+    set_seed(opt.seed)
+    conf = Config(opt)
+    os.makedirs("results", exist_ok=True)
+    bert_model_name = conf.bert_model_name if conf.bert_folder == "" or conf.bert_folder=="none" else f"{conf.bert_folder}/{conf.bert_model_name}"
+
+    conf.uni_labels, constant2id, constant_values = get_task_constants(conf.train_file)
+    num_labels = len(conf.uni_labels)
+    constant_number = len(constant_values) if constant_values is not None else 0
     logger.info(f"[Data Info] constant info: {constant2id}")
 
+    if opt.mode == "test":
+        ## the model is loaded in the background while the tokenizer and the test data are loaded
+        MODEL_CLASS = class_name_2_model[bert_model_name]
+        def load_model() -> nn.Module:
+            with profiler.stage("model (background)"):
+                return load_pretrained_fast(MODEL_CLASS, f"model_files/{conf.model_folder}",
+                                            num_labels=num_labels,
+                                            height = conf.height,
+                                            constant_num = constant_number,
+                                            var_update_mode=conf.var_update_mode,
+                                            factorized_scoring=conf.factorized_scoring,
+                                            incremental_scoring=conf.incremental_scoring,
+                                            quant_special_token=conf.quant_special_token).to(conf.device)
+        model_loader = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        model_future = model_loader.submit(load_model)
+
+    with profiler.stage("tokenizer"):
+        tokenizer = AutoTokenizer.from_pretrained(bert_model_name, use_fast=True)
+        if conf.quant_special_token:
+            conf.quant_subword_ids = add_quant_special_token(tokenizer)
+
 
     # Read dataset
     if opt.mode == "train":
+        from src.data.bucket_sampler import BucketBatchSampler
         logger.info("[Data Info] Reading training data")
-        dataset = UniversalDataset(file=conf.train_file, tokenizer=tokenizer, uni_labels=conf.uni_labels, number=conf.train_num, filtered_steps=opt.train_filtered_steps,
-                                   constant2id=constant2id, constant_values=constant_values,
-                                   data_max_height=opt.train_max_height, pretrained_model_name=bert_model_name)
+        dataset = get_dataset(conf, file=conf.train_file, number=conf.train_num, filtered_steps=opt.train_filtered_steps, data_max_height=opt.train_max_height,
+                              tokenizer=tokenizer, uni_labels=conf.uni_labels, constant2id=constant2id, constant_values=constant_values,
+                              pretrained_model_name=bert_model_name)
         logger.info("[Data Info] Reading validation data")
-        eval_dataset = UniversalDataset(file=conf.dev_file, tokenizer=tokenizer, uni_labels=conf.uni_labels, number=conf.dev_num, filtered_steps=opt.test_filtered_steps,
-                                        constant2id=constant2id, constant_values=constant_values,
-                                        data_max_height=conf.height, pretrained_model_name=bert_model_name)
+        eval_dataset = get_dataset(conf, file=conf.dev_file, number=conf.dev_num, filtered_steps=opt.test_filtered_steps, data_max_height=conf.height,
+                                   tokenizer=tokenizer, uni_labels=conf.uni_labels, constant2id=constant2id, constant_values=constant_values,
+                                   pretrained_model_name=bert_model_name)
 
         logger.info("[Data Info] Reading Testing data data")
         test_dataset = None
         if os.path.exists(conf.test_file):
-            test_dataset = UniversalDataset(file=conf.test_file, tokenizer=tokenizer, uni_labels=conf.uni_labels,
-                                            number=conf.dev_num, filtered_steps=opt.test_filtered_steps,
-                                            constant2id=constant2id, constant_values=constant_values,
-                                            data_max_height=conf.height, pretrained_model_name=bert_model_name)
-        logger.info(f"[Data Info] Training instances: {len(dataset)}, Validation instances: {len(eval_dataset)}")
-        if test_dataset is not None:
-            logger.info(f"[Data Info] Testing instances: {len(test_dataset)}")
+            test_dataset = get_dataset(conf, file=conf.test_file, number=conf.dev_num, filtered_steps=opt.test_filtered_steps, data_max_height=conf.height,
+                                       tokenizer=tokenizer, uni_labels=conf.uni_labels, constant2id=constant2id, constant_values=constant_values,
+                                       pretrained_model_name=bert_model_name)
+        if not conf.streaming:
+            ## the streaming datasets are only counted when the number of batches is needed
+            logger.info(f"[Data Info] Training instances: {len(dataset)}, Validation instances: {len(eval_dataset)}")
+            if test_dataset is not None:
+                logger.info(f"[Data Info] Testing instances: {len(test_dataset)}")
         # Prepare data loader
         logger.info("[Data Info] Loading data")
-        train_dataloader = DataLoader(dataset, batch_size=conf.batch_size, shuffle=True, num_workers=conf.num_workers, collate_fn=dataset.collate_function)
-        valid_dataloader = DataLoader(eval_dataset, batch_size=conf.batch_size, shuffle=False, num_workers=conf.num_workers, collate_fn=eval_dataset.collate_function)
+        for data in [dataset, eval_dataset, test_dataset]:
+            if data is not None:
+                data.pin_memory = conf.pin_memory
+        if conf.streaming:
+            ## the instances come in the file order
+            train_dataloader = DataLoader(dataset, batch_size=conf.batch_size, num_workers=conf.num_workers, pin_memory=conf.pin_memory, collate_fn=dataset.collate_function)
+        elif conf.bucket_batches:
+            lengths, num_variables, heights = dataset.get_sizes()
+            batch_sampler = BucketBatchSampler(lengths, num_variables, heights, batch_size=conf.batch_size, constant_num=constant_number,
+                                               max_tokens=conf.max_batch_tokens, max_combinations=conf.max_batch_combinations, seed=opt.seed)
+            train_dataloader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=conf.num_workers, pin_memory=conf.pin_memory, collate_fn=dataset.collate_function)
+        elif conf.step_tokens > 0 or conf.step_combinations > 0:
+            ## plain shuffled batches (pools of one batch are not regrouped), in an order known in advance so that
+            ## the optimizer steps of the budgets can be counted for the learning rate schedule
+            lengths, num_variables, heights = dataset.get_sizes()
+            batch_sampler = BucketBatchSampler(lengths, num_variables, heights, batch_size=conf.batch_size, constant_num=constant_number,
+                                               pool_multiplier=1, seed=opt.seed)
+            train_dataloader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=conf.num_workers, pin_memory=conf.pin_memory, collate_fn=dataset.collate_function)
+        else:
+            train_dataloader = DataLoader(dataset, batch_size=conf.batch_size, shuffle=True, num_workers=conf.num_workers, pin_memory=conf.pin_memory, collate_fn=dataset.collate_function)
+        valid_dataloader = DataLoader(eval_dataset, batch_size=conf.batch_size, shuffle=False, num_workers=conf.num_workers, pin_memory=conf.pin_memory, collate_fn=eval_dataset.collate_function)
         test_loader = None
         if test_dataset is not None:
             logger.info("[Data Info] Loading Test data")
-            test_loader = DataLoader(test_dataset, batch_size=conf.batch_size, shuffle=False, num_workers=conf.num_workers, collate_fn=eval_dataset.collate_function)
+            test_loader = DataLoader(test_dataset, batch_size=conf.batch_size, shuffle=False, num_workers=conf.num_workers, pin_memory=conf.pin_memory, collate_fn=eval_dataset.collate_function)
 
-        res_file = f"results/{conf.model_folder}.res.json"
-        err_file = f"results/{conf.model_folder}.err.json"
+        result_suffix = ".jsonl.gz" if conf.gzip_results else ".jsonl"
+        res_file = f"results/{conf.model_folder}.res{result_suffix}"
+        err_file = f"results/{conf.model_folder}.err{result_suffix}"
         # Train the model
         model = train(conf, train_dataloader,
                       num_epochs= conf.num_epochs,
@@ -379,25 +596,29 @@ def main():
                       valid_dataloader = valid_dataloader, test_dataloader=test_loader,
                       dev=conf.device, tokenizer=tokenizer, num_labels=num_labels,
                       constant_values=constant_values, res_file=res_file, error_file=err_file)
-        evaluate(valid_dataloader, model, conf.device, fp16=bool(conf.fp16), constant_values=constant_values, uni_labels=conf.uni_labels)
+        evaluate(valid_dataloader, model, conf.device, fp16=bool(conf.fp16), constant_values=constant_values, uni_labels=conf.uni_labels,
+                 early_exit=conf.early_exit)
     else:
         logger.info(f"Testing the model now.")
-        MODEL_CLASS = class_name_2_model[bert_model_name]
-        model = MODEL_CLASS.from_pretrained(f"model_files/{conf.model_folder}",
-                                               num_labels=num_labels,
-                                               height = conf.height,
-                                               constant_num = constant_number,
-                                            var_update_mode=conf.var_update_mode).to(conf.device)
         logger.info("[Data Info] Reading test data")
-        eval_dataset = UniversalDataset(file=conf.test_file, tokenizer=tokenizer, uni_labels=conf.uni_labels, number=conf.dev_num, filtered_steps=opt.test_filtered_steps,
-                                        constant2id=constant2id, constant_values=constant_values, data_max_height=conf.height, pretrained_model_name=bert_model_name)
-        valid_dataloader = DataLoader(eval_dataset, batch_size=conf.batch_size, shuffle=False, num_workers=0,
+        with profiler.stage("test data"):
+            eval_dataset = get_dataset(conf, file=conf.test_file, number=conf.dev_num, filtered_steps=opt.test_filtered_steps, data_max_height=conf.height,
+                                       tokenizer=tokenizer, uni_labels=conf.uni_labels, constant2id=constant2id, constant_values=constant_values,
+                                       pretrained_model_name=bert_model_name)
+        with profiler.stage("wait for the model"):
+            model = model_future.result()
+        model_loader.shutdown()
+        if conf.profile_startup:
+            logger.info(f"[startup]\n{profiler.report()}")
+        eval_dataset.pin_memory = conf.pin_memory
+        valid_dataloader = DataLoader(eval_dataset, batch_size=conf.batch_size, shuffle=False, num_workers=0, pin_memory=conf.pin_memory,
                                       collate_fn=eval_dataset.collate_function)
         os.makedirs("results", exist_ok=True)
-        res_file= f"results/{conf.model_folder}.res.json"
-        err_file = f"results/{conf.model_folder}.err.json"
+        result_suffix = ".jsonl.gz" if conf.gzip_results else ".jsonl"
+        res_file = f"results/{conf.model_folder}.res{result_suffix}"
+        err_file = f"results/{conf.model_folder}.err{result_suffix}"
         evaluate(valid_dataloader, model, conf.device, uni_labels=conf.uni_labels, fp16=bool(conf.fp16), constant_values=constant_values,
-                 res_file=res_file, err_file=err_file)
+                 res_file=res_file, err_file=err_file, early_exit=conf.early_exit)
 
 if __name__ == "__main__":
     # logger.addHandler(logging.StreamHandler())